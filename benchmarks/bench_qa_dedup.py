@@ -0,0 +1,58 @@
+import time
+
+import numpy as np
+
+from database.qa_dedup import find_bank_duplicates, find_batch_duplicates, normalize_rows
+
+BANK_SIZE = 50000
+NEW_QUESTIONS = 5000
+DUPLICATES = 500
+# размерность эмбеддингов GigaChat
+DIMENSION = 1024
+THRESHOLD = 0.92
+
+
+def make_vectors(rng):
+    bank = normalize_rows(rng.standard_normal((BANK_SIZE, DIMENSION), dtype=np.float32))
+    new = normalize_rows(rng.standard_normal((NEW_QUESTIONS, DIMENSION), dtype=np.float32))
+    # часть новых вопросов - перефразированные вопросы банка: тот же вектор с небольшим шумом
+    originals = rng.choice(BANK_SIZE, DUPLICATES, replace=False)
+    noise = rng.standard_normal((DUPLICATES, DIMENSION), dtype=np.float32) * 0.01
+    new[:DUPLICATES] = normalize_rows(bank[originals] + noise)
+    return bank, new, originals
+
+
+def find_duplicates_one_by_one(new, bank):
+    # сравнение по одному вопросу: матрица банка умножается на каждый новый вектор отдельно
+    found = []
+    for vector in new:
+        similarity = bank @ vector
+        index = int(similarity.argmax())
+        found.append(index if similarity[index] >= THRESHOLD else -1)
+    return np.array(found)
+
+
+def main():
+    rng = np.random.default_rng(0)
+    bank, new, originals = make_vectors(rng)
+    bank_blocks = [bank[start:start + 4096] for start in range(0, BANK_SIZE, 4096)]
+
+    start = time.perf_counter()
+    old_found = find_duplicates_one_by_one(new, bank)
+    old_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    new_found, _ = find_bank_duplicates(new, bank_blocks, THRESHOLD)
+    find_batch_duplicates(new, THRESHOLD)
+    new_time = time.perf_counter() - start
+
+    assert (new_found == old_found).all()
+    assert (new_found[:DUPLICATES] == originals).all()
+    assert (new_found[DUPLICATES:] == -1).all()
+
+    print(f'{NEW_QUESTIONS} новых вопросов против банка из {BANK_SIZE}: по одному {old_time:.2f} с, '
+          f'блочная матрица {new_time:.2f} с; найдено повторов {int((new_found >= 0).sum())} из {DUPLICATES}')
+
+
+if __name__ == '__main__':
+    main()
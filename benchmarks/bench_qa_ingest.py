@@ -0,0 +1,79 @@
+import os
+import tempfile
+import time
+import redis
+from dotenv import load_dotenv
+
+from database.admin_redis_tools import clear_qa_bank, iter_qa_file, upload_qa_pairs
+from database.client_redis_tools import ANSWERS_BANK, BANK_NEXT_ID, QUESTIONS_BANK
+
+QUESTIONS = 100000
+
+
+def write_qa_file(path, count):
+    # нумерованный формат с отступом, как в example_qa.txt
+    with open(path, 'w', encoding='utf-8') as file:
+        for num in range(count):
+            file.write(f'{num + 1}. Вопрос: Какой ответ на вопрос номер {num}?\n'
+                       f'   Ответ: Ответ номер {num}.\n\n')
+
+
+def parse_qa_file_split(path):
+    # прежний разбор: файл целиком в память и split по пустым строкам
+    qa_pairs = []
+    with open(path, 'r', encoding='utf-8') as file:
+        for text in file.read().split('\n\n'):
+            if text.find('Вопрос:') != -1 and text.find('Ответ:') != -1:
+                question = text.splitlines()[0]
+                answer = text.splitlines()[1]
+                qa_pairs.append((question[question.find('Вопрос:') + 8:], answer[answer.find('Ответ:') + 7:]))
+    return qa_pairs
+
+
+def upload_qa_one_by_one(r_conn, qa_pairs):
+    # прежняя запись: по HSET на каждый вопрос и каждый ответ
+    for question, answer in qa_pairs:
+        num_qa = r_conn.incr(BANK_NEXT_ID) - 1
+        r_conn.hset(QUESTIONS_BANK, num_qa, question)
+        r_conn.hset(ANSWERS_BANK, num_qa, answer)
+
+
+def measure(upload, r_conn):
+    clear_qa_bank([], r_conn)
+    start = time.perf_counter()
+    upload()
+    elapsed = time.perf_counter() - start
+    assert r_conn.hlen(QUESTIONS_BANK) == QUESTIONS
+    return elapsed
+
+
+def main():
+    load_dotenv()
+    host = os.getenv('host')
+    port = os.getenv('port')
+    # отдельная база, чтобы не затронуть настоящий банк вопросов
+    db = int(os.getenv('BENCH_DB', 15))
+
+    r_conn = redis.Redis(
+        host=host,
+        port=port,
+        db=db,
+        charset='utf-8',
+        decode_responses=True
+    )
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench_qa.txt')
+        write_qa_file(path, QUESTIONS)
+
+        old_time = measure(lambda: upload_qa_one_by_one(r_conn, parse_qa_file_split(path)), r_conn)
+        new_time = measure(lambda: upload_qa_pairs(r_conn, iter_qa_file(path)), r_conn)
+
+    print(f'{QUESTIONS} вопросов: split + HSET по одному {old_time:.2f} с ({QUESTIONS / old_time:.0f} вопросов/с), '
+          f'построчный разбор + пачки HSET mapping {new_time:.2f} с ({QUESTIONS / new_time:.0f} вопросов/с)')
+
+    clear_qa_bank([], r_conn)
+
+
+if __name__ == '__main__':
+    main()
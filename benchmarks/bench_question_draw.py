@@ -0,0 +1,70 @@
+import os
+import random
+import time
+import redis
+from dotenv import load_dotenv
+
+from database.admin_redis_tools import add_qa_to_bank, clear_qa_bank
+from database.client_redis_tools import ANSWERS_BANK, QUESTIONS_BANK, draw_question
+
+USER_ID = -1
+DRAWS = 1000
+
+
+def draw_question_hkeys(user_id, r_conn):
+    # прежний способ: все ключи банка на каждый вопрос
+    pipe = r_conn.pipeline(transaction=False)
+    pipe.hkeys(QUESTIONS_BANK)
+    pipe.smembers(f'qa_served_id_{user_id}')
+    nums_question, served = pipe.execute()
+    nums_question = [num for num in nums_question if num not in served]
+    if not nums_question:
+        return None
+    num_qa = random.choice(nums_question)
+    pipe = r_conn.pipeline(transaction=False)
+    pipe.hget(QUESTIONS_BANK, num_qa)
+    pipe.hget(ANSWERS_BANK, num_qa)
+    pipe.sadd(f'qa_served_id_{user_id}', num_qa)
+    question, answer, _ = pipe.execute()
+    return num_qa, question, answer
+
+
+def measure(draw, r_conn):
+    r_conn.delete(f'qa_served_id_{USER_ID}', f'qa_progress_id_{USER_ID}')
+    start = time.perf_counter()
+    for _ in range(DRAWS):
+        draw(USER_ID, r_conn)
+    return (time.perf_counter() - start) / DRAWS * 1000
+
+
+def main():
+    load_dotenv()
+    host = os.getenv('host')
+    port = os.getenv('port')
+    # отдельная база, чтобы не затронуть настоящий банк вопросов
+    db = int(os.getenv('BENCH_DB', 15))
+
+    r_conn = redis.Redis(
+        host=host,
+        port=port,
+        db=db,
+        charset='utf-8',
+        decode_responses=True
+    )
+
+    for bank_size in [10000, 100000]:
+        clear_qa_bank([f'id_{USER_ID}'], r_conn)
+        chunk = 10000
+        for first in range(0, bank_size, chunk):
+            add_qa_to_bank(r_conn, [(f'Вопрос {num}?', f'Ответ {num}') for num in range(first, first + chunk)])
+
+        old_latency = measure(draw_question_hkeys, r_conn)
+        new_latency = measure(draw_question, r_conn)
+        print(f'банк {bank_size} вопросов: HKEYS + random.choice {old_latency:.3f} мс, '
+              f'перестановка с курсором {new_latency:.3f} мс на вопрос')
+
+    clear_qa_bank([f'id_{USER_ID}'], r_conn)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+import os
+import time
+import redis
+from dotenv import load_dotenv
+
+import vk_bot
+
+# тестовый пользователь, которого не бывает в реальной группе
+USER_ID = -1
+
+
+class FakeMessages:
+    def send(self, **kwargs):
+        return 0
+
+
+class FakeVk:
+    messages = FakeMessages()
+
+
+class FakeEvent:
+    def __init__(self, text):
+        self.obj = {'message': {'text': text, 'from_id': USER_ID, 'peer_id': USER_ID, 'attachments': []}}
+
+
+class RoundTripCounter:
+    # каждый вызов send_packed_command - один запрос к серверу (pipeline отправляется целиком)
+    def __init__(self):
+        self.count = 0
+        self._send = redis.connection.Connection.send_packed_command
+
+    def __enter__(self):
+        counter = self
+
+        def send_packed_command(connection, command, check_health=True):
+            counter.count += 1
+            return counter._send(connection, command, check_health)
+
+        redis.connection.Connection.send_packed_command = send_packed_command
+        return self
+
+    def __exit__(self, *args):
+        redis.connection.Connection.send_packed_command = self._send
+
+
+def run_scenario(vk, r_conn, messages, repeat):
+    events = [FakeEvent(text) for text in messages]
+    with RoundTripCounter() as counter:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for event in events:
+                vk_bot.handle_event(vk, event, r_conn, None, None)
+        elapsed = time.perf_counter() - start
+    total = repeat * len(events)
+    return counter.count / total, elapsed / total * 1000
+
+
+def main():
+    load_dotenv()
+    host = os.getenv('host')
+    port = os.getenv('port')
+    # отдельная база, чтобы не затронуть состояния настоящих пользователей
+    db = int(os.getenv('BENCH_DB', 15))
+
+    r_conn = redis.Redis(
+        host=host,
+        port=port,
+        db=db,
+        charset='utf-8',
+        decode_responses=True
+    )
+    vk = FakeVk()
+    repeat = 200
+
+    r_conn.hset('users_info', f'id_{USER_ID}', '{"account": 0}')
+    scenarios = {
+        'вход и выход из администратора': ['админ', 'ruzik_admin', '0000', 'выйти'],
+        'меню администратора': ['админ', 'ruzik_admin', '0000', 'Вопросы и ответы', 'Назад', 'выйти'],
+        'неверный пароль': ['админ', 'ruzik_admin', '1111', '1111', 'выйти'],
+    }
+
+    try:
+        for name, messages in scenarios.items():
+            r_conn.delete(f'admin_id_{USER_ID}')
+            r_conn.hdel('users_state', f'id_{USER_ID}')
+            round_trips, latency = run_scenario(vk, r_conn, messages, repeat)
+            print(f'{name}: {round_trips:.2f} обращений к redis на событие, {latency:.3f} мс на событие')
+
+        # обычное событие без смены состояния: одно чтение и ни одной записи
+        r_conn.hset('users_state', f'id_{USER_ID}', vk_bot.STATE_CHAT)
+        round_trips, latency = run_scenario(vk, r_conn, ['Стоп'], repeat)
+        print(f'стоп в режиме чата: {round_trips:.2f} обращений к redis на событие, {latency:.3f} мс на событие')
+    finally:
+        r_conn.delete(f'admin_id_{USER_ID}')
+        r_conn.hdel('users_state', f'id_{USER_ID}')
+        r_conn.hdel('users_info', f'id_{USER_ID}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import json
+import os
+import tempfile
+import time
+import redis
+from dotenv import load_dotenv
+
+import pandas as pd
+
+from database.client_redis_tools import ACCOUNTS, LEADERBOARD
+from database.users_info_io import (
+    USERS_INFO,
+    export_users_info_csv,
+    export_users_info_xlsx,
+    import_users_info
+)
+
+PLAYERS = int(os.getenv('BENCH_PLAYERS', 1000000))
+
+
+def fill_users_info(r_conn, count, chunk=10000):
+    r_conn.delete(USERS_INFO, ACCOUNTS, LEADERBOARD)
+    for first in range(0, count, chunk):
+        r_conn.hset(USERS_INFO, mapping={
+            f'id_{num}': json.dumps({'first_name': f'Имя {num}', 'last_name': f'Фамилия {num}',
+                                     'b_date': '1.1.2000', 'sex': 'жен', 'city': 'Москва',
+                                     'country': 'Россия', 'account': num % 1000})
+            for num in range(first, min(first + chunk, count))
+        })
+
+
+def export_with_pandas(r_conn, path):
+    # прежняя выгрузка: HGETALL всех игроков и apply по строкам
+    df = pd.DataFrame.from_dict(r_conn.hgetall(USERS_INFO), orient='index').reset_index()
+    df.columns = ['id', 0]
+    df_id = df['id']
+    df = df[0].apply(json.loads).apply(pd.Series)
+    df = pd.concat([df_id, df], axis=1)
+    df.to_excel(path)
+
+
+def measure(action):
+    start = time.perf_counter()
+    action()
+    return time.perf_counter() - start
+
+
+def main():
+    load_dotenv()
+    host = os.getenv('host')
+    port = os.getenv('port')
+    # отдельная база, чтобы не затронуть настоящих игроков
+    db = int(os.getenv('BENCH_DB', 15))
+
+    r_conn = redis.Redis(
+        host=host,
+        port=port,
+        db=db,
+        charset='utf-8',
+        decode_responses=True
+    )
+
+    fill_users_info(r_conn, PLAYERS)
+    with tempfile.TemporaryDirectory() as directory:
+        xlsx_path = os.path.join(directory, 'users_info.xlsx')
+        csv_path = os.path.join(directory, 'users_info.csv')
+
+        results = {
+            'выгрузка pandas apply + to_excel': measure(
+                lambda: export_with_pandas(r_conn, os.path.join(directory, 'old.xlsx'))),
+            'выгрузка HSCAN + write-only xlsx': measure(lambda: export_users_info_xlsx(r_conn, xlsx_path)),
+            'выгрузка HSCAN + csv': measure(lambda: export_users_info_csv(r_conn, csv_path)),
+        }
+        r_conn.delete(USERS_INFO, ACCOUNTS, LEADERBOARD)
+        results['загрузка read-only xlsx пачками'] = measure(lambda: import_users_info(r_conn, xlsx_path))
+        assert r_conn.hlen(USERS_INFO) == PLAYERS
+        r_conn.delete(USERS_INFO, ACCOUNTS, LEADERBOARD)
+        results['загрузка csv пачками'] = measure(lambda: import_users_info(r_conn, csv_path))
+        assert r_conn.hlen(USERS_INFO) == PLAYERS
+
+    for name, elapsed in results.items():
+        print(f'{PLAYERS} игроков, {name}: {elapsed:.1f} с')
+
+    r_conn.delete(USERS_INFO, ACCOUNTS, LEADERBOARD)
+
+
+if __name__ == '__main__':
+    main()
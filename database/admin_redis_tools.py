@@ -1,66 +1,334 @@
+import hashlib
+import logging
 import os
+import re
+import time
 import redis
 from dotenv import load_dotenv
 
-def get_last_num_of_questions(r_conn, user_id):
-    if not r_conn.hgetall('last_num_of_questions') or r_conn.hget('last_num_of_questions', user_id) is None:
-        return 0
-    return r_conn.hget('last_num_of_questions', user_id)
+from database.client_redis_tools import (
+    ANSWER_EMBEDDINGS,
+    ANSWERS_BANK,
+    BANK_FILES,
+    BANK_HASHES,
+    BANK_NEXT_ID,
+    QUESTION_EMBEDDINGS,
+    QUESTIONS_BANK,
+    encode_embedding,
+    normalize_correct_answer
+)
+from database.qa_dedup import create_question_deduplicator
+from giga_chat.clients import get_embeddings
 
-def set_last_num_of_questions(r_conn, user_id, num):
-    r_conn.hset('last_num_of_questions', user_id, num)
-def upload_all_files_of_qa(r_conn, directory_name='questions_data', user_id=0):
-    path_directory = os.path.abspath(f'./{directory_name}')
-    path_directory = path_directory.replace('\\', '/')
-    h_name = f'questions_{user_id}'
-    question_counter = r_conn.hlen(h_name)
-    for file_name in os.listdir(path_directory):
-        # "KOI8-R"
-        with open(f'{path_directory}/{file_name}', 'r', encoding='utf-8') as file:
-            file = file.read().split("\n\n")
-            for text in file:
-                if text.find('Вопрос:') != -1 and text.find('Ответ:')!= -1:
-                    question = text.splitlines()[0]
-                    start_index = question.strip().find('Вопрос:')
-                    scaled_question = ''.join(question[start_index+8:])
+logger = logging.getLogger('qa bank')
 
-                    answer = text.splitlines()[1]
-                    start_index = answer.find('Ответ:')
-                    scaled_answer = ''.join(answer[start_index+7:])
+# "1. Вопрос: ...", "   Ответ: ...", "- Ответ: ..." и просто "Вопрос: ..."
+QUESTION_LINE = re.compile(r'^\s*(?:\d+\s*[.)]\s*|[-*•]\s*)?Вопрос\s*:\s*(.*)$')
+ANSWER_LINE = re.compile(r'^\s*(?:\d+\s*[.)]\s*|[-*•]\s*)?Ответ\s*:\s*(.*)$')
 
-                    r_conn.hset(f'questions_id_{user_id}', f'{question_counter}', scaled_question)
-                    r_conn.hset(f'correct_answers_id_{user_id}', f'{question_counter}', scaled_answer)
+def iter_qa_file(path):
+    # файл читается построчно, пары отдаются по мере разбора
+    question, answer = None, None
+    with open(path, 'r', encoding='utf-8-sig') as file:
+        for line in file:
+            line = line.strip()
+            question_match = QUESTION_LINE.match(line)
+            answer_match = ANSWER_LINE.match(line) if question_match is None else None
+            if question_match is not None:
+                if question and answer:
+                    yield question, answer
+                question, answer = question_match.group(1).strip(), None
+            elif answer_match is not None and question is not None:
+                answer = answer_match.group(1).strip()
+            elif not line:
+                if question and answer:
+                    yield question, answer
+                    question, answer = None, None
+            # продолжение длинного вопроса или ответа на следующей строке
+            elif answer is not None:
+                answer = f'{answer} {line}'
+            elif question is not None:
+                question = f'{question} {line}'
+    if question and answer:
+        yield question, answer
 
-                    question_counter += 1
+def parse_qa_file(path):
+    return list(iter_qa_file(path))
 
-def upload_one_file_of_qa(users_id, r_conn, file_name):
-    directory_name = 'questions_data'
+def iter_chunks(items, chunk_size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def upload_answer_embeddings(r_conn, nums_qa, answers, sber_token, batch_size=100):
+    # правильные ответы известны при загрузке, поэтому их эмбеддинги считаются один раз
+    embeddings_client = get_embeddings(sber_token)
+    embeddings = []
+    for start in range(0, len(answers), batch_size):
+        batch = [normalize_correct_answer(answer) for answer in answers[start:start + batch_size]]
+        embeddings.extend(embeddings_client.embed_documents(texts=batch))
+
+    r_conn.hset(
+        ANSWER_EMBEDDINGS,
+        mapping={num_qa: encode_embedding(embedding) for num_qa, embedding in zip(nums_qa, embeddings)}
+    )
+    return embeddings
+
+def get_qa_hash(question, answer):
+    text = f'{normalize_correct_answer(question)}\n{normalize_correct_answer(answer)}'
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:32]
+
+def get_file_hash(path, block_size=1 << 20):
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+def add_qa_to_bank(r_conn, qa_pairs, sber_token=None, deduplicator=None, file_ids=None):
+    # в file_ids собираются id всех вопросов пачки - и новых, и уже бывших в банке
+    if not qa_pairs:
+        return []
+    # вопросы, которые уже есть в банке или повторяются в пачке, пропускаются
+    unique_pairs = {}
+    for question, answer in qa_pairs:
+        unique_pairs.setdefault(get_qa_hash(question, answer), (question, answer))
+    existing = r_conn.hmget(BANK_HASHES, list(unique_pairs))
+    if file_ids is not None:
+        file_ids.update(num_qa for num_qa in existing if num_qa is not None)
+    new_pairs = [(qa_hash, qa_pair) for (qa_hash, qa_pair), num_qa in zip(unique_pairs.items(), existing)
+                 if num_qa is None]
+    if not new_pairs:
+        return []
+
+    question_vectors = None
+    if deduplicator is not None and not deduplicator.disabled:
+        # вопросы, близкие по смыслу к вопросам банка или друг к другу, пропускаются
+        qa_hashes_by_pair = {qa_pair: qa_hash for qa_hash, qa_pair in new_pairs}
+        try:
+            kept_pairs, question_vectors = deduplicator.filter([qa_pair for _, qa_pair in new_pairs])
+        except Exception as exception:
+            # GigaChat недоступен - до конца загрузки остается только проверка по хэшу,
+            # иначе бот не запустится, пока не загрузит новые файлы
+            logger.error('the semantic dedup failed, only exact duplicates are skipped.')
+            logger.exception(exception)
+            deduplicator.disabled = True
+        else:
+            new_pairs = [(qa_hashes_by_pair[qa_pair], qa_pair) for qa_pair in kept_pairs]
+            if not new_pairs:
+                return []
+
+    # резервируем непрерывный диапазон id под все вопросы сразу
+    last_id = r_conn.incrby(BANK_NEXT_ID, len(new_pairs))
+    first_id = last_id - len(new_pairs)
+    questions = {}
+    answers = {}
+    qa_hashes = {}
+    for num, (qa_hash, (question, answer)) in enumerate(new_pairs):
+        questions[first_id + num] = question
+        answers[first_id + num] = answer
+        qa_hashes[qa_hash] = first_id + num
+
+    pipe = r_conn.pipeline(transaction=False)
+    pipe.hset(QUESTIONS_BANK, mapping=questions)
+    pipe.hset(ANSWERS_BANK, mapping=answers)
+    pipe.hset(BANK_HASHES, mapping=qa_hashes)
+    if question_vectors is not None:
+        pipe.hset(QUESTION_EMBEDDINGS, mapping={
+            num_qa: encode_embedding(vector) for num_qa, vector in zip(questions, question_vectors)
+        })
+    pipe.execute()
+    if question_vectors is not None:
+        deduplicator.add(list(questions.keys()), question_vectors)
+    if file_ids is not None:
+        file_ids.update(str(num_qa) for num_qa in questions)
+
+    if sber_token is not None:
+        try:
+            upload_answer_embeddings(r_conn, list(answers.keys()), list(answers.values()), sber_token)
+        except Exception as exception:
+            # вопросы уже записаны; без сохраненного эмбеддинга проверка посчитает его сама
+            logger.error('the answer embeddings upload failed.')
+            logger.exception(exception)
+    return list(questions.keys())
+
+def upload_qa_pairs(r_conn, qa_pairs, sber_token=None, chunk_size=1000, on_progress=None, on_duplicates=None,
+                    file_ids=None):
+    # пары пишутся пачками: на пачку один pipeline с HSET mapping на вопросы и ответы
+    deduplicator = create_question_deduplicator(r_conn, sber_token)
+    nums_qa = []
+    done = 0
+    for chunk in iter_chunks(qa_pairs, chunk_size):
+        nums_qa.extend(add_qa_to_bank(r_conn, chunk, sber_token, deduplicator=deduplicator, file_ids=file_ids))
+        done += len(chunk)
+        if on_progress is not None:
+            on_progress(done, None)
+    if file_ids is not None and deduplicator is not None:
+        # вопрос банка, похожий на вопрос файла, тоже остается за файлом
+        file_ids.update(str(num_qa) for kind, num_qa in deduplicator.clusters if kind == 'bank')
+    if deduplicator is not None and deduplicator.clusters:
+        logger.info(f'skipped {deduplicator.get_skipped_count()} near-duplicate questions.')
+        if on_duplicates is not None:
+            on_duplicates(deduplicator.get_clusters())
+    return nums_qa
+
+def rebuild_qa_hashes(r_conn, chunk_size=1000):
+    # банк загружен до появления хэшей вопросов - считаем их по уже загруженным вопросам
+    for chunk in iter_chunks(r_conn.hscan_iter(QUESTIONS_BANK, count=chunk_size), chunk_size):
+        answers = r_conn.hmget(ANSWERS_BANK, [num_qa for num_qa, _ in chunk])
+        r_conn.hset(BANK_HASHES, mapping={
+            get_qa_hash(question, answer): num_qa
+            for (num_qa, question), answer in zip(chunk, answers) if answer is not None
+        })
+
+def get_file_ids_key(file_name):
+    return f'qa_bank_file_ids_{file_name}'
+
+def retire_qa_from_bank(r_conn, nums_qa, chunk_size=1000):
+    # вопрос удаляется вместе с хэшем и эмбеддингами; выдача пропускает отсутствующие id
+    for chunk in iter_chunks(nums_qa, chunk_size):
+        pipe = r_conn.pipeline(transaction=False)
+        pipe.hmget(QUESTIONS_BANK, chunk)
+        pipe.hmget(ANSWERS_BANK, chunk)
+        questions, answers = pipe.execute()
+        qa_hashes = [get_qa_hash(question, answer) for question, answer in zip(questions, answers)
+                     if question is not None and answer is not None]
+        pipe = r_conn.pipeline(transaction=False)
+        for key in (QUESTIONS_BANK, ANSWERS_BANK, ANSWER_EMBEDDINGS, QUESTION_EMBEDDINGS):
+            pipe.hdel(key, *chunk)
+        if qa_hashes:
+            pipe.hdel(BANK_HASHES, *qa_hashes)
+        pipe.execute()
+
+def retire_stale_file_qa(r_conn, file_name, file_ids, chunk_size=1000):
+    # вопросы прошлой версии файла, которых нет ни в новой версии, ни в других файлах, удаляются;
+    # у файлов, загруженных до появления этих множеств, удалять нечего
+    ids_key = get_file_ids_key(file_name)
+    new_ids_key = f'{ids_key}:new'
+    r_conn.delete(new_ids_key)
+    for chunk in iter_chunks(file_ids, chunk_size):
+        r_conn.sadd(new_ids_key, *chunk)
+    other_keys = [get_file_ids_key(name) for name in r_conn.hkeys(BANK_FILES) if name != file_name]
+    stale = list(r_conn.sdiff(ids_key, new_ids_key, *other_keys))
+    retire_qa_from_bank(r_conn, stale, chunk_size)
+    if file_ids:
+        r_conn.rename(new_ids_key, ids_key)
+    else:
+        r_conn.delete(ids_key)
+    return stale
+
+def ingest_qa_file(r_conn, path, sber_token=None, on_progress=None, on_duplicates=None, claim_ttl=3600):
+    # файл с тем же содержимым повторно не разбирается
+    file_name = os.path.basename(path)
+    file_hash = get_file_hash(path)
+    if r_conn.hget(BANK_FILES, file_name) == file_hash:
+        return []
+    # файл, который уже разбирает другой процесс (загрузка администратора или слежение
+    # за папкой), пропускается: проверка повторов в add_qa_to_bank не атомарна
+    claim_key = f'qa_bank_file_claim_{file_name}:{file_hash}'
+    if not r_conn.set(claim_key, 1, nx=True, ex=claim_ttl):
+        logger.info(f'the file {file_name} is already being ingested.')
+        return []
+    try:
+        file_ids = set()
+        nums_qa = upload_qa_pairs(r_conn, iter_qa_file(path), sber_token,
+                                  on_progress=on_progress, on_duplicates=on_duplicates, file_ids=file_ids)
+        stale = retire_stale_file_qa(r_conn, file_name, file_ids)
+        if stale:
+            logger.info(f'the file {file_name} retired {len(stale)} questions no longer in it.')
+        r_conn.hset(BANK_FILES, file_name, file_hash)
+    finally:
+        # после записи в BANK_FILES файл пропускается по хэшу, после ошибки его можно разобрать снова
+        r_conn.delete(claim_key)
+    logger.info(f'the file {file_name} added {len(nums_qa)} new questions.')
+    return nums_qa
+
+def upload_all_files_of_qa(r_conn, directory_name='questions_data', sber_token=None):
     path_directory = os.path.abspath(f'./{directory_name}')
     path_directory = path_directory.replace('\\', '/')
+    if r_conn.exists(QUESTIONS_BANK) and not r_conn.exists(BANK_HASHES):
+        rebuild_qa_hashes(r_conn)
+    nums_qa = []
+    for file_name in os.listdir(path_directory):
+        if file_name.endswith('.txt'):
+            nums_qa.extend(ingest_qa_file(r_conn, f'{path_directory}/{file_name}', sber_token))
+    return nums_qa
 
-    for user_id in users_id:
-        h_name = f'questions_{user_id}'
-        question_counter = int(get_last_num_of_questions(r_conn, user_id))
+def watch_qa_directory(r_conn, directory_name='questions_data', sber_token=None, interval=5):
+    # новые и измененные файлы попадают в банк без перезапуска бота;
+    # файл разбирается, когда его размер и время изменения не менялись между проверками
+    path_directory = os.path.abspath(f'./{directory_name}')
+    path_directory = path_directory.replace('\\', '/')
+    snapshot = {}
+    ingested = {}
+    while True:
+        try:
+            current = {
+                entry.name: (entry.stat().st_mtime_ns, entry.stat().st_size)
+                for entry in os.scandir(path_directory)
+                if entry.is_file() and entry.name.endswith('.txt')
+            }
+            for file_name, stat in current.items():
+                if snapshot.get(file_name) == stat and ingested.get(file_name) != stat:
+                    ingest_qa_file(r_conn, f'{path_directory}/{file_name}', sber_token)
+                    ingested[file_name] = stat
+            snapshot = current
+        except Exception as exception:
+            logger.error('the question directory reload failed.')
+            logger.exception(exception)
+        time.sleep(interval)
 
-        with open(f'{path_directory}/{file_name}', 'r', encoding='utf-8') as file:
-            file = file.read().split("\n\n")
-            for text in file:
-                if text.find('Вопрос:') != -1 and text.find('Ответ:') != -1:
-                    question = text.splitlines()[0]
-                    start_index = question.strip().find('Вопрос:')
-                    scaled_question = ''.join(question[start_index+8:])
+def upload_one_file_of_qa(r_conn, file_name, sber_token=None, on_progress=None, on_duplicates=None):
+    directory_name = 'questions_data'
+    path_directory = os.path.abspath(f'./{directory_name}')
+    path_directory = path_directory.replace('\\', '/')
+    return ingest_qa_file(r_conn, f'{path_directory}/{file_name}', sber_token,
+                          on_progress=on_progress, on_duplicates=on_duplicates)
 
-                    answer = text.splitlines()[1]
-                    start_index = answer.find('Ответ:')
-                    scaled_answer = ''.join(answer[start_index+7:])
+# Ключи, в которых до общего банка хранилась копия вопросов каждого игрока
+LEGACY_QA_PATTERNS = ['questions_*', 'correct_answers_*']
+LEGACY_QA_MIGRATED = 'qa_legacy_migrated'
 
-                    # print(scaled_question)
-                    # print(scaled_answer)
+def migrate_legacy_user_qa(r_conn, chunk_size=1000):
+    # раньше questions_id_{id} хранил еще не выданные игроку вопросы, выданные из него удалялись;
+    # все вопросы банка, которых в нем нет, переносятся в qa_served_id_{id}, чтобы игрок
+    # не получал их повторно, а старые копии удаляются
+    if r_conn.exists(LEGACY_QA_MIGRATED):
+        return 0
+    bank_ids = r_conn.hkeys(QUESTIONS_BANK)
+    migrated = 0
+    for chunk in iter_chunks(r_conn.hscan_iter('users_info', count=chunk_size), chunk_size):
+        for user_field, _ in chunk:
+            user_id = user_field[len('id_'):]
+            questions = r_conn.hgetall(f'questions_id_{user_id}')
+            if questions:
+                answers = r_conn.hgetall(f'correct_answers_id_{user_id}')
+                qa_hashes = [get_qa_hash(question, answers.get(num, '')) for num, question in questions.items()]
+                remaining = set(num_qa for num_qa in r_conn.hmget(BANK_HASHES, qa_hashes) if num_qa is not None)
+            elif r_conn.hexists('num_of_last_question', user_field):
+                # копия пуста - игрок прошел все вопросы
+                remaining = set()
+            else:
+                continue
+            served = [num_qa for num_qa in bank_ids if num_qa not in remaining]
+            pipe = r_conn.pipeline(transaction=False)
+            for served_chunk in iter_chunks(served, chunk_size):
+                pipe.sadd(f'qa_served_{user_field}', *served_chunk)
+            pipe.execute()
+            migrated += 1
 
-                    r_conn.hset(f'questions_{user_id}', f'{question_counter}', scaled_question)
-                    r_conn.hset(f'correct_answers_{user_id}', f'{question_counter}', scaled_answer)
-                    question_counter += 1
-        set_last_num_of_questions(r_conn, user_id, question_counter)
+    for pattern in LEGACY_QA_PATTERNS:
+        for keys in iter_chunks(r_conn.scan_iter(match=pattern, count=chunk_size), chunk_size):
+            r_conn.delete(*keys)
+    r_conn.delete('last_num_of_questions')
+    r_conn.set(LEGACY_QA_MIGRATED, 1)
+    logger.info(f'migrated the question progress of {migrated} players from the per-player copies.')
+    return migrated
 
 def change_admin_login(new_login, r_conn):
     r_conn.hset('admin', 'login', new_login)
@@ -68,19 +336,14 @@ def change_admin_login(new_login, r_conn):
 def change_admin_password(new_password, r_conn):
     r_conn.hset('admin', 'password', new_password)
 
-def delete_all_questions(user_id, r_conn):
-    r_conn.delete(f'questions_{user_id}')
-
-def delete_all_correct_answers(user_id, r_conn):
-    r_conn.delete(f'correct_answers_{user_id}')
-
-def clear_questions(users_id, r_conn):
-    for user_id in users_id:
-        set_last_num_of_questions(r_conn, user_id, 0)
-        delete_all_questions(user_id, r_conn)
-def clear_answers(users_id, r_conn):
+def clear_qa_bank(users_id, r_conn):
+    file_ids_keys = [get_file_ids_key(file_name) for file_name in r_conn.hkeys(BANK_FILES)]
+    pipe = r_conn.pipeline(transaction=False)
+    pipe.delete(QUESTIONS_BANK, ANSWERS_BANK, ANSWER_EMBEDDINGS, QUESTION_EMBEDDINGS,
+                BANK_NEXT_ID, BANK_FILES, BANK_HASHES, *file_ids_keys)
     for user_id in users_id:
-        delete_all_correct_answers(user_id, r_conn)
+        pipe.delete(f'qa_served_{user_id}', f'qa_progress_{user_id}')
+    pipe.execute()
 
 def clear_qa_from_dir(directory_name='questions_data'):
     path_directory = os.path.abspath(f'./{directory_name}')
@@ -88,12 +351,6 @@ def clear_qa_from_dir(directory_name='questions_data'):
     for file_name in os.listdir(path_directory):
         os.remove(f'{path_directory}/{file_name}')
 
-def delete_select_question(user_id, key, r_conn):
-    r_conn.hdel(f'questions_id_{user_id}', key)
-
-def delete_select_correct_answer(user_id, key, r_conn):
-    r_conn.hdel(f'correct_answers_id_{user_id}', key)
-
 
 def main():
     load_dotenv()
@@ -0,0 +1,65 @@
+import json
+
+LEGACY_CHAT_MESSAGES = 'ruzik_chat_messages'
+
+
+def get_chat_history_key(user_id):
+    return f'ruzik_chat_history_id_{user_id}'
+
+
+def estimate_tokens(text):
+    # у GigaChat на русском тексте в среднем около трех символов на токен
+    return len(text) // 3 + 1
+
+
+def migrate_chat_history(user_id, r_conn, max_len=50):
+    # переносим старую историю из общего json в список пользователя, один раз
+    value = r_conn.hget(LEGACY_CHAT_MESSAGES, f'id_{user_id}')
+    if value is None:
+        return []
+    messages = [
+        message for message in json.loads(value).get('messages', [])
+        if message['role'] != 'system'
+    ][-max_len:]
+
+    pipe = r_conn.pipeline()
+    if messages:
+        pipe.rpush(get_chat_history_key(user_id), *[json.dumps(message, ensure_ascii=False) for message in messages])
+    pipe.hdel(LEGACY_CHAT_MESSAGES, f'id_{user_id}')
+    pipe.execute()
+    return messages
+
+
+def load_chat_history(user_id, r_conn, token_budget=1500, max_len=50):
+    values = r_conn.lrange(get_chat_history_key(user_id), -max_len, -1)
+    if values:
+        messages = [json.loads(value) for value in values]
+    else:
+        messages = migrate_chat_history(user_id, r_conn, max_len)
+
+    # берем последние сообщения, пока они укладываются в бюджет токенов
+    window = []
+    tokens = 0
+    for message in reversed(messages):
+        tokens += estimate_tokens(message['content'])
+        if tokens > token_budget:
+            break
+        window.append(message)
+    window.reverse()
+
+    # окно должно начинаться с вопроса пользователя, а не с ответа модели
+    while window and window[0]['role'] != 'user':
+        window.pop(0)
+    return window
+
+
+def append_chat_history(user_id, messages, r_conn, max_len=50):
+    key = get_chat_history_key(user_id)
+    pipe = r_conn.pipeline()
+    pipe.rpush(key, *[json.dumps(message, ensure_ascii=False) for message in messages])
+    pipe.ltrim(key, -max_len, -1)
+    pipe.execute()
+
+
+def clear_chat_history(user_id, r_conn):
+    r_conn.delete(get_chat_history_key(user_id))
@@ -1,8 +1,133 @@
+import base64
 import re
 import json
+import random
+import time
+
+import numpy as np
+
+QUESTIONS_BANK = 'qa_bank_questions'
+ANSWERS_BANK = 'qa_bank_answers'
+ANSWER_EMBEDDINGS = 'qa_bank_answer_embeddings'
+QUESTION_EMBEDDINGS = 'qa_bank_question_embeddings'
+BANK_NEXT_ID = 'qa_bank_next_id'
+# хэш содержимого каждого загруженного файла и хэш каждого вопроса банка
+BANK_FILES = 'qa_bank_files'
+BANK_HASHES = 'qa_bank_hashes'
+ACCOUNTS = 'accounts'
+LEADERBOARD = 'leaderboard'
+
 
 def scale_text(answer):
     return re.sub(r'[\(\[].*?[\)\]]', "", answer).strip()
+
+def normalize_correct_answer(answer):
+    return scale_text(answer).lower().strip('.')
+
+def encode_embedding(embedding):
+    # float32 в base64: соединение с redis работает с decode_responses=True
+    return base64.b64encode(np.asarray(embedding, dtype=np.float32).tobytes()).decode('ascii')
+
+def decode_embedding(value):
+    return np.frombuffer(base64.b64decode(value), dtype=np.float32)
+
+def get_answer_embedding(num_qa, r_conn):
+    if num_qa is None:
+        return None
+    value = r_conn.hget(ANSWER_EMBEDDINGS, num_qa)
+    if value is None:
+        return None
+    return decode_embedding(value)
+# Выдает случайный еще не выданный вопрос за одно обращение к redis.
+# Вопросы банка нумеруются подряд, поэтому порядок выдачи задается
+# псевдослучайной перестановкой (сеть Фейстеля) отрезка [base, base + size)
+# и курсором в ней: на пользователя хранится только base, size, cursor и ключи.
+# Когда отрезок пройден, начинается новый из вопросов, добавленных позже.
+DRAW_QUESTION_SCRIPT = """
+local progress_key, served_key, questions_key, answers_key, next_id_key = KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5]
+local last_num_key, last_question_key, last_answer_key = KEYS[6], KEYS[7], KEYS[8]
+local user_field = ARGV[1]
+
+local function feistel(x, half_bits, mask, keys)
+    local left = bit.rshift(x, half_bits)
+    local right = bit.band(x, mask)
+    for i = 1, 3 do
+        local h = ((right + keys[i]) * 2654435761) % 4294967296
+        h = bit.bxor(h, bit.rshift(h, 15))
+        left, right = right, bit.band(bit.bxor(left, h), mask)
+    end
+    return left * (mask + 1) + right
+end
+
+local total = tonumber(redis.call('GET', next_id_key) or '0')
+local p = redis.call('HMGET', progress_key, 'base', 'size', 'cursor', 'k1', 'k2', 'k3')
+local base, size, cursor = tonumber(p[1] or '0'), tonumber(p[2] or '0'), tonumber(p[3] or '0')
+local keys = {tonumber(p[4] or '0'), tonumber(p[5] or '0'), tonumber(p[6] or '0')}
+if base + size > total then
+    -- банк был очищен, начинаем сначала
+    base, size, cursor = 0, 0, 0
+end
+
+local result = false
+for attempt = 1, tonumber(ARGV[5]) do
+    if cursor >= size then
+        if base + size >= total then
+            break
+        end
+        base, size, cursor = base + size, total - (base + size), 0
+        keys = {tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])}
+    end
+
+    local half_bits = 1
+    while 2 ^ (2 * half_bits) < size do
+        half_bits = half_bits + 1
+    end
+    local mask = 2 ^ half_bits - 1
+    local x = cursor
+    repeat
+        x = feistel(x, half_bits, mask, keys)
+    until x < size
+    cursor = cursor + 1
+
+    local num_qa = tostring(base + x)
+    if redis.call('SISMEMBER', served_key, num_qa) == 0 then
+        local question = redis.call('HGET', questions_key, num_qa)
+        if question then
+            local answer = redis.call('HGET', answers_key, num_qa)
+            redis.call('SADD', served_key, num_qa)
+            redis.call('HSET', last_num_key, user_field, num_qa)
+            redis.call('HSET', last_question_key, user_field, question)
+            redis.call('HSET', last_answer_key, user_field, answer)
+            result = {num_qa, question, answer}
+            break
+        end
+    end
+end
+
+redis.call('HSET', progress_key, 'base', base, 'size', size, 'cursor', cursor,
+           'k1', keys[1], 'k2', keys[2], 'k3', keys[3])
+return result
+"""
+
+def draw_question(user_id, r_conn, max_skips=1000):
+    draw_script = r_conn.register_script(DRAW_QUESTION_SCRIPT)
+    while True:
+        result = draw_script(
+            keys=[f'qa_progress_id_{user_id}', f'qa_served_id_{user_id}',
+                  QUESTIONS_BANK, ANSWERS_BANK, BANK_NEXT_ID,
+                  'num_of_last_question', 'last_question', 'last_correct_answer'],
+            args=[f'id_{user_id}', random.randrange(65536), random.randrange(65536),
+                  random.randrange(65536), max_skips]
+        )
+        if result:
+            num_qa, question, answer = result
+            return num_qa, question, answer
+        # скрипт пропустил max_skips уже выданных вопросов - проверяем, остались ли еще
+        progress = r_conn.hmget(f'qa_progress_id_{user_id}', 'base', 'size', 'cursor')
+        base, size, cursor = (int(value or 0) for value in progress)
+        if cursor >= size and base + size >= int(r_conn.get(BANK_NEXT_ID) or 0):
+            return None
+
 def upload_last_question(user_id, question, r_conn):
     r_conn.hset(
         'last_question',
@@ -26,34 +151,147 @@ def get_last_correct_answer(user_id, r_conn):
 
     return correct_answer
 
+def get_last_qa(user_id, r_conn):
+    pipe = r_conn.pipeline(transaction=False)
+    pipe.hget('num_of_last_question', f'id_{user_id}')
+    pipe.hget('last_question', f'id_{user_id}')
+    pipe.hget('last_correct_answer', f'id_{user_id}')
+    num_qa, question, correct_answer = pipe.execute()
+
+    return num_qa, question, correct_answer
+
 def get_users_info(r_conn):
     return r_conn.hgetall('users_info')
 
 def get_user_qa(user_id, r_conn):
-    return r_conn.hgetall(f'questions_{user_id}'), r_conn.hgetall(f'correct_answers_{user_id}')
-def upload_account(bonus, user_id, r_conn):
-    user_info_dict = json.loads(
-        r_conn.hget('users_info', f'id_{user_id}')
-    )
+    # вопросы общего банка, которые пользователь еще не получал
+    pipe = r_conn.pipeline(transaction=False)
+    pipe.hgetall(QUESTIONS_BANK)
+    pipe.hgetall(ANSWERS_BANK)
+    pipe.smembers(f'qa_served_{user_id}')
+    questions, answers, served = pipe.execute()
+    questions = {key: value for key, value in questions.items() if key not in served}
+    answers = {key: value for key, value in answers.items() if key in questions}
+    return questions, answers
 
-    if r_conn.hget('users_info', f'id_{user_id}') is not None:
-        total_account = int(user_info_dict['account'])
-        total_account += bonus
-    else:
-        total_account = bonus
+# Начисляет бонус атомарно: счет хранится числом в хэше accounts,
+# каждое начисление дописывается в журнал пользователя,
+# а новый счет сразу попадает в сортированное множество лидерборда.
+# Счет, которого еще нет в accounts, берется из json в users_info.
+# Если передан ключ начисления (KEYS[5]), бонус по нему начисляется только один раз.
+ADD_BONUS_SCRIPT = """
+local accounts_key, users_info_key, ledger_key, leaderboard_key = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local field, bonus = ARGV[1], tonumber(ARGV[2])
 
-    user_info_dict['account'] = total_account
-    r_conn.hset('users_info', f'id_{user_id}', json.dumps(user_info_dict))
+if #KEYS >= 5 and not redis.call('SET', KEYS[5], 1, 'NX', 'EX', tonumber(ARGV[4])) then
+    -- повторная доставка того же задания: бонус уже начислен
+    return tonumber(redis.call('HGET', accounts_key, field) or '0')
+end
+
+if redis.call('HEXISTS', accounts_key, field) == 0 then
+    local seed = 0
+    local user_info = redis.call('HGET', users_info_key, field)
+    if user_info then
+        local ok, info = pcall(cjson.decode, user_info)
+        if ok and type(info) == 'table' then
+            seed = math.floor(tonumber(info['account']) or 0)
+        end
+    end
+    redis.call('HSET', accounts_key, field, seed)
+end
+
+local total = redis.call('HINCRBY', accounts_key, field, bonus)
+redis.call('RPUSH', ledger_key, cjson.encode({ts = tonumber(ARGV[3]), bonus = bonus, total = total}))
+redis.call('ZADD', leaderboard_key, total, field)
+return total
+"""
+
+def upload_account(bonus, user_id, r_conn, credit_id=None, credit_ttl=86400):
+    add_bonus_script = r_conn.register_script(ADD_BONUS_SCRIPT)
+    keys = [ACCOUNTS, 'users_info', f'account_ledger_id_{user_id}', LEADERBOARD]
+    if credit_id is not None:
+        keys.append(f'account_credit_{credit_id}')
+    return add_bonus_script(
+        keys=keys,
+        args=[f'id_{user_id}', int(bonus), int(time.time()), credit_ttl]
+    )
+
+def get_account(user_id, r_conn):
+    total_account = r_conn.hget(ACCOUNTS, f'id_{user_id}')
+    if total_account is not None:
+        return int(total_account)
+    # бонусов еще не начисляли - счет мог остаться только в json пользователя
+    user_info = r_conn.hget('users_info', f'id_{user_id}')
+    if user_info is None:
+        return None
+    account = json.loads(user_info).get('account')
+    return int(account) if account is not None else None
 
 def upload_user_info(user_id, bdate, city, country, sex, bonus, r_conn):
     if not r_conn.hgetall('users_info') or r_conn.hget('users_info', f'id_{user_id}') is None:
         r_conn.hset('users_info', f'id_{user_id}', )
 
+def get_leaderboard_rank(user_id, r_conn):
+    # место и счет игрока за O(log n), без чтения всех счетов
+    pipe = r_conn.pipeline(transaction=False)
+    pipe.zrevrank(LEADERBOARD, f'id_{user_id}')
+    pipe.zscore(LEADERBOARD, f'id_{user_id}')
+    pipe.zcard(LEADERBOARD)
+    rank, score, total_players = pipe.execute()
+    if rank is None:
+        return None
+    return rank + 1, int(score), total_players
+
+def get_leaderboard_top(r_conn, top_n=10):
+    return [(field, int(score)) for field, score in r_conn.zrevrange(LEADERBOARD, 0, top_n - 1, withscores=True)]
+
+# Переносит счет игрока из json в accounts, если там его еще нет, и ставит в лидерборд
+# актуальный счет; атомарно, чтобы не затереть бонус, начисленный воркером в это же время.
+MIGRATE_ACCOUNTS_SCRIPT = """
+local accounts_key, leaderboard_key = KEYS[1], KEYS[2]
+for i = 1, #ARGV, 2 do
+    local field, seed = ARGV[i], ARGV[i + 1]
+    if seed ~= '' then
+        redis.call('HSETNX', accounts_key, field, seed)
+    end
+    local total = redis.call('HGET', accounts_key, field)
+    if total then
+        redis.call('ZADD', leaderboard_key, total, field)
+    end
+end
+"""
+ACCOUNTS_MIGRATED = 'accounts_migrated'
+
+def migrate_accounts(r_conn, count=1000):
+    # счета, начисленные до появления accounts, хранятся только в json users_info:
+    # без переноса такие игроки не попадают в лидерборд и "Мое место"
+    if r_conn.exists(ACCOUNTS_MIGRATED):
+        return 0
+    migrate_script = r_conn.register_script(MIGRATE_ACCOUNTS_SCRIPT)
+    migrated = 0
+    args = []
+    for field, user_info in r_conn.hscan_iter('users_info', count=count):
+        try:
+            account = json.loads(user_info).get('account')
+            seed = int(float(account)) if account is not None else ''
+        except (ValueError, TypeError, AttributeError):
+            seed = ''
+        args.extend([field, seed])
+        migrated += 1
+        if len(args) >= 2 * count:
+            migrate_script(keys=[ACCOUNTS, LEADERBOARD], args=args)
+            args = []
+    if args:
+        migrate_script(keys=[ACCOUNTS, LEADERBOARD], args=args)
+    r_conn.set(ACCOUNTS_MIGRATED, 1)
+    return migrated
+
 def clear_account(user_id, r_conn):
-    r_conn.hdel('accounts', f'id_{user_id}')
+    r_conn.hdel(ACCOUNTS, f'id_{user_id}')
+    r_conn.zrem(LEADERBOARD, f'id_{user_id}')
 
 def clear_all_account(r_conn):
-    r_conn.delete('accounts')
+    r_conn.delete(ACCOUNTS, LEADERBOARD)
 
 def clear_answer(user_id, r_conn):
     r_conn.hdel('answers', f'id_{user_id}')
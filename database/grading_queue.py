@@ -0,0 +1,67 @@
+import redis
+
+GRADING_STREAM = 'grading_jobs'
+GRADING_GROUP = 'graders'
+
+
+def create_grading_group(r_conn):
+    try:
+        r_conn.xgroup_create(GRADING_STREAM, GRADING_GROUP, id='0', mkstream=True)
+    except redis.ResponseError as e:
+        # группа уже создана другим процессом
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+def enqueue_grading_job(user_id, num_qa, question, correct_answer, answer, response_time, r_conn):
+    return r_conn.xadd(
+        GRADING_STREAM,
+        {
+            'user_id': user_id,
+            'num_qa': num_qa or '',
+            'question': question,
+            'correct_answer': correct_answer,
+            'answer': answer,
+            'response_time': response_time,
+        }
+    )
+
+
+def claim_stale_grading_jobs(consumer_name, r_conn, min_idle_ms=60000, count=10):
+    # забираем задания, которые взял упавший воркер и так и не подтвердил
+    response = r_conn.xautoclaim(
+        GRADING_STREAM,
+        GRADING_GROUP,
+        consumer_name,
+        min_idle_time=min_idle_ms,
+        start_id='0-0',
+        count=count
+    )
+    return [(job_id, job) for job_id, job in response[1] if job]
+
+
+def read_grading_jobs(consumer_name, r_conn, count=1, block_ms=5000):
+    response = r_conn.xreadgroup(
+        GRADING_GROUP,
+        consumer_name,
+        {GRADING_STREAM: '>'},
+        count=count,
+        block=block_ms
+    )
+    if not response:
+        return []
+    return response[0][1]
+
+
+def get_delivery_count(job_id, r_conn):
+    pending = r_conn.xpending_range(GRADING_STREAM, GRADING_GROUP, min=job_id, max=job_id, count=1)
+    if not pending:
+        return 0
+    return pending[0]['times_delivered']
+
+
+def ack_grading_job(job_id, r_conn):
+    pipe = r_conn.pipeline(transaction=False)
+    pipe.xack(GRADING_STREAM, GRADING_GROUP, job_id)
+    pipe.xdel(GRADING_STREAM, job_id)
+    pipe.execute()
@@ -0,0 +1,183 @@
+import logging
+import os
+from itertools import islice
+
+import numpy as np
+
+from database.client_redis_tools import (
+    QUESTION_EMBEDDINGS,
+    QUESTIONS_BANK,
+    decode_embedding,
+    encode_embedding
+)
+from giga_chat.clients import get_embeddings
+
+logger = logging.getLogger('qa dedup')
+
+
+def normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+def embed_questions(questions, sber_token, batch_size=100):
+    # нормированные векторы: косинусная близость сводится к скалярному произведению
+    embeddings_client = get_embeddings(sber_token)
+    embeddings = []
+    for start in range(0, len(questions), batch_size):
+        embeddings.extend(embeddings_client.embed_documents(texts=questions[start:start + batch_size]))
+    return normalize_rows(embeddings)
+
+def find_bank_duplicates(vectors, bank_blocks, threshold, block_size=4096):
+    # для каждого нового вопроса - самый похожий вопрос банка (-1, если похожих нет);
+    # матрица близости считается блоками, целиком новые x весь банк в памяти не бывает
+    best_index = np.full(len(vectors), -1, dtype=np.int64)
+    best_similarity = np.full(len(vectors), -np.inf, dtype=np.float32)
+    for start in range(0, len(vectors), block_size):
+        block = vectors[start:start + block_size]
+        rows = np.arange(len(block))
+        block_index = best_index[start:start + block_size]
+        block_similarity = best_similarity[start:start + block_size]
+        bank_start = 0
+        for bank_block in bank_blocks:
+            similarity = block @ bank_block.T
+            index = similarity.argmax(axis=1)
+            value = similarity[rows, index]
+            better = value > block_similarity
+            block_similarity[better] = value[better]
+            block_index[better] = index[better] + bank_start
+            bank_start += len(bank_block)
+    best_index[best_similarity < threshold] = -1
+    return best_index, best_similarity
+
+def find_batch_duplicates(vectors, threshold, block_size=4096):
+    # для каждого вопроса пачки - первый более ранний вопрос пачки, похожий на него (-1, если нет)
+    first_index = np.full(len(vectors), -1, dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        block = vectors[start:start + block_size]
+        stop = start + len(block)
+        similar = (block @ vectors[:stop].T) >= threshold
+        # сравниваем только с предыдущими вопросами
+        similar &= np.arange(stop)[None, :] < np.arange(start, stop)[:, None]
+        found = similar.any(axis=1)
+        first_index[start:stop][found] = similar.argmax(axis=1)[found]
+    return first_index
+
+def load_question_embeddings(r_conn, sber_token, chunk_size=4096):
+    nums_qa = []
+    blocks = []
+    missing = []
+    scan = r_conn.hscan_iter(QUESTIONS_BANK, count=chunk_size)
+    while True:
+        chunk = list(islice(scan, chunk_size))
+        if not chunk:
+            break
+        values = r_conn.hmget(QUESTION_EMBEDDINGS, [num_qa for num_qa, _ in chunk])
+        known = []
+        for (num_qa, question), value in zip(chunk, values):
+            if value is None:
+                missing.append((num_qa, question))
+            else:
+                known.append((num_qa, value))
+        if known:
+            nums_qa.extend(num_qa for num_qa, _ in known)
+            blocks.append(np.stack([decode_embedding(value) for _, value in known]))
+
+    # вопросы, загруженные до появления проверки на похожие, эмбеддятся один раз
+    if missing:
+        logger.info(f'embedding {len(missing)} questions of the bank.')
+    for start in range(0, len(missing), chunk_size):
+        chunk = missing[start:start + chunk_size]
+        vectors = embed_questions([question for _, question in chunk], sber_token)
+        r_conn.hset(QUESTION_EMBEDDINGS, mapping={
+            num_qa: encode_embedding(vector) for (num_qa, _), vector in zip(chunk, vectors)
+        })
+        nums_qa.extend(num_qa for num_qa, _ in chunk)
+        blocks.append(vectors)
+    return nums_qa, blocks
+
+
+class QuestionDeduplicator:
+    """Отсеивает при загрузке вопросы, близкие по смыслу к уже имеющимся.
+
+    Эмбеддинги вопросов банка на время загрузки лежат в памяти блоками;
+    новые вопросы сравниваются с ними и между собой, похожие пропускаются
+    и собираются в группы вокруг исходного вопроса для отчета администратору.
+    """
+
+    def __init__(self, r_conn, sber_token, threshold=0.92, block_size=4096):
+        self.r_conn = r_conn
+        self.sber_token = sber_token
+        self.threshold = threshold
+        self.block_size = block_size
+        # банк загружается при первой пачке, в которой есть новые вопросы
+        self.bank_nums = None
+        self.bank_blocks = None
+        # (исходный вопрос банка или пачки) -> похожие на него пропущенные вопросы
+        self.clusters = {}
+        # выставляется при ошибке эмбеддингов: дальше загрузка идет без проверки на похожие
+        self.disabled = False
+
+    def filter(self, qa_pairs):
+        """Возвращает оставленные пары и их эмбеддинги."""
+        if not qa_pairs:
+            return [], np.empty((0, 0), dtype=np.float32)
+        if self.bank_nums is None:
+            self.bank_nums, self.bank_blocks = load_question_embeddings(self.r_conn, self.sber_token,
+                                                                        self.block_size)
+        vectors = embed_questions([question for question, _ in qa_pairs], self.sber_token)
+        bank_index, _ = find_bank_duplicates(vectors, self.bank_blocks, self.threshold, self.block_size)
+        batch_index = find_batch_duplicates(vectors, self.threshold, self.block_size)
+
+        kept = []
+        originals = {}
+        for num, (question, _) in enumerate(qa_pairs):
+            if bank_index[num] >= 0:
+                original = ('bank', self.bank_nums[bank_index[num]])
+            elif batch_index[num] >= 0:
+                # если ранний вопрос сам оказался повтором, группа общая
+                original = originals.get(batch_index[num], ('new', qa_pairs[batch_index[num]][0]))
+            else:
+                kept.append(num)
+                continue
+            originals[num] = original
+            self.clusters.setdefault(original, []).append(question)
+        return [qa_pairs[num] for num in kept], vectors[kept]
+
+    def add(self, nums_qa, vectors):
+        # оставленные вопросы участвуют в сравнении со следующими пачками
+        if len(nums_qa):
+            self.bank_nums.extend(nums_qa)
+            self.bank_blocks.append(vectors)
+
+    def get_clusters(self):
+        """Группы похожих вопросов: [(исходный вопрос, [пропущенные вопросы])]."""
+        bank_nums = [num_qa for kind, num_qa in self.clusters if kind == 'bank']
+        bank_questions = dict(zip(bank_nums, self.r_conn.hmget(QUESTIONS_BANK, bank_nums))) if bank_nums else {}
+        # вопрос, оставленный в одной пачке, для следующих пачек уже вопрос банка - группы объединяются
+        clusters = {}
+        for (kind, value), duplicates in self.clusters.items():
+            original = bank_questions.get(value) if kind == 'bank' else value
+            clusters.setdefault(original, []).extend(duplicates)
+        return list(clusters.items())
+
+    def get_skipped_count(self):
+        return sum(len(duplicates) for duplicates in self.clusters.values())
+
+
+def create_question_deduplicator(r_conn, sber_token):
+    # без токена эмбеддинги не посчитать; QA_DEDUP_THRESHOLD=0 отключает проверку
+    threshold = float(os.getenv('QA_DEDUP_THRESHOLD', 0.92))
+    if sber_token is None or threshold <= 0:
+        return None
+    return QuestionDeduplicator(r_conn, sber_token, threshold=threshold,
+                                block_size=int(os.getenv('QA_DEDUP_BLOCK_SIZE', 4096)))
+
+def format_duplicate_clusters(clusters, max_length=4000):
+    lines = [f'Пропущено похожих вопросов: {sum(len(duplicates) for _, duplicates in clusters)}.']
+    for original, duplicates in clusters:
+        lines.append(f'\n{original}')
+        lines.extend(f'  ~ {question}' for question in duplicates)
+    # сообщение VK ограничено по длине, полный список не нужен
+    return '\n'.join(lines)[:max_length]
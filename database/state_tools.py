@@ -0,0 +1,54 @@
+STATE_CHAT = 'chat'
+STATE_QUIZ = 'quiz'
+STATE_ADMIN_LOGIN = 'admin_login'
+STATE_ADMIN_PASSWORD = 'admin_password'
+STATE_ADMIN = 'admin'
+STATE_ADMIN_USERS_INFO = 'admin_users_info'
+STATE_ADMIN_QA = 'admin_qa'
+STATE_ADMIN_QA_UPLOAD = 'admin_qa_upload'
+STATE_ADMIN_QA_EDIT = 'admin_qa_edit'
+STATE_ADMIN_QA_DELETE = 'admin_qa_delete'
+STATE_ADMIN_GENERATE = 'admin_generate'
+STATE_ADMIN_NUM_QA = 'admin_num_qa'
+STATE_ADMIN_CHANGE_LOGIN = 'admin_change_login'
+STATE_ADMIN_CHANGE_PASSWORD = 'admin_change_password'
+
+ADMIN_STATES = (
+    STATE_ADMIN_LOGIN,
+    STATE_ADMIN_PASSWORD,
+    STATE_ADMIN,
+    STATE_ADMIN_USERS_INFO,
+    STATE_ADMIN_QA,
+    STATE_ADMIN_QA_UPLOAD,
+    STATE_ADMIN_QA_EDIT,
+    STATE_ADMIN_QA_DELETE,
+    STATE_ADMIN_GENERATE,
+    STATE_ADMIN_NUM_QA,
+    STATE_ADMIN_CHANGE_LOGIN,
+    STATE_ADMIN_CHANGE_PASSWORD,
+)
+
+
+def load_user_state(user_id, r_conn):
+    # одно обращение к redis: состояние, данные администратора и старый флаг чата
+    pipe = r_conn.pipeline(transaction=False)
+    pipe.hget('users_state', f'id_{user_id}')
+    pipe.hgetall(f'admin_id_{user_id}')
+    pipe.hget('ruzik_chat_keys', f'id_{user_id}')
+    state, admin_info, ruzik_chat_key = pipe.execute()
+
+    if state is None:
+        # пользователь из старой схемы с флагами 'on'/'off'
+        state = STATE_QUIZ if ruzik_chat_key == 'off' else STATE_CHAT
+
+    return state, admin_info
+
+
+def save_user_state(user_id, state, r_conn, admin_info=None, admin_deleted=None):
+    pipe = r_conn.pipeline(transaction=False)
+    pipe.hset('users_state', f'id_{user_id}', state)
+    if admin_info:
+        pipe.hset(f'admin_id_{user_id}', mapping=admin_info)
+    if admin_deleted:
+        pipe.hdel(f'admin_id_{user_id}', *admin_deleted)
+    pipe.execute()
@@ -0,0 +1,162 @@
+import csv
+import json
+import uuid
+
+import openpyxl
+
+from database.admin_redis_tools import iter_chunks
+from database.client_redis_tools import ACCOUNTS, LEADERBOARD
+
+USERS_INFO = 'users_info'
+USERS_INFO_FIELDS = ['first_name', 'last_name', 'b_date', 'sex', 'city', 'country', 'account']
+USERS_INFO_COLUMNS = ['id'] + USERS_INFO_FIELDS
+
+
+def iter_users_info_rows(r_conn, chunk_size=10000, on_progress=None):
+    # пользователи читаются пачками через HSCAN, в памяти только одна пачка
+    total = r_conn.hlen(USERS_INFO) if on_progress is not None else None
+    done = 0
+    for chunk in iter_chunks(r_conn.hscan_iter(USERS_INFO, count=chunk_size), chunk_size):
+        users_id = [user_id for user_id, _ in chunk]
+        accounts = r_conn.hmget(ACCOUNTS, users_id)
+        # вся пачка разбирается одним вызовом json.loads вместо вызова на каждого пользователя
+        users_info = json.loads('[' + ','.join(value for _, value in chunk) + ']')
+        for user_id, user_info, account in zip(users_id, users_info, accounts):
+            row = [user_id] + [user_info.get(field) for field in USERS_INFO_FIELDS]
+            # актуальный счет хранится в accounts, в json профиля - только начальный
+            if account is not None:
+                row[-1] = int(account)
+            yield row
+        done += len(chunk)
+        if on_progress is not None:
+            on_progress(done, total)
+
+
+def export_users_info_xlsx(r_conn, path, on_progress=None):
+    workbook = openpyxl.Workbook(write_only=True)
+    worksheet = workbook.create_sheet()
+    # первая колонка - номер строки, как в выгрузке через pandas
+    worksheet.append([None] + USERS_INFO_COLUMNS)
+    for num, row in enumerate(iter_users_info_rows(r_conn, on_progress=on_progress)):
+        worksheet.append([num] + row)
+    workbook.save(path)
+
+
+def export_users_info_csv(r_conn, path, on_progress=None):
+    with open(path, 'w', encoding='utf-8', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(USERS_INFO_COLUMNS)
+        writer.writerows(iter_users_info_rows(r_conn, on_progress=on_progress))
+
+
+def export_users_info_parquet(r_conn, path, chunk_size=100000, on_progress=None):
+    # pyarrow нужен только для этого формата, поэтому не входит в обязательные зависимости
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(column, pa.int64() if column == 'account' else pa.string())
+                        for column in USERS_INFO_COLUMNS])
+    with pq.ParquetWriter(path, schema) as writer:
+        for rows in iter_chunks(iter_users_info_rows(r_conn, on_progress=on_progress), chunk_size):
+            columns = list(zip(*rows))
+            writer.write_table(pa.table({
+                column: [None if value is None else (int(value) if column == 'account' else str(value))
+                         for value in values]
+                for column, values in zip(USERS_INFO_COLUMNS, columns)
+            }, schema=schema))
+
+
+EXPORTERS = {
+    'xlsx': export_users_info_xlsx,
+    'csv': export_users_info_csv,
+    'parquet': export_users_info_parquet,
+}
+
+
+def export_users_info(r_conn, export_format='xlsx', on_progress=None):
+    title = f'users_info_file.{export_format}'
+    EXPORTERS[export_format](r_conn, title, on_progress=on_progress)
+    return title
+
+
+def iter_xlsx_rows(path):
+    # read_only не загружает весь лист в память
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        for row in workbook.active.iter_rows(min_row=2, values_only=True):
+            # колонка с номером строки пропускается
+            yield list(row[1:len(USERS_INFO_COLUMNS) + 1])
+    finally:
+        workbook.close()
+
+
+def iter_csv_rows(path):
+    with open(path, 'r', encoding='utf-8', newline='') as file:
+        reader = csv.reader(file)
+        next(reader, None)
+        for row in reader:
+            yield [value or None for value in row]
+
+
+def swap_staged_keys(r_conn, staged_keys):
+    # временные ключи подменяют живые одной транзакцией; пустой временный ключ значит пустую таблицу
+    existing = [r_conn.exists(staged) for staged, _ in staged_keys]
+    pipe = r_conn.pipeline()
+    for (staged, live), exists in zip(staged_keys, existing):
+        if exists:
+            pipe.rename(staged, live)
+        else:
+            pipe.delete(live)
+    pipe.execute()
+
+
+def import_users_info(r_conn, path, chunk_size=10000, on_progress=None):
+    rows = iter_csv_rows(path) if path.endswith('.csv') else iter_xlsx_rows(path)
+    # таблица пишется во временные ключи и заменяет живую только после того,
+    # как весь файл прочитан без ошибок: оборванная загрузка не оставляет полтаблицы,
+    # а счета - единственная актуальная копия баллов - не теряются
+    # у каждой загрузки свои временные ключи: фоновые задачи двух администраторов не смешиваются
+    import_id = uuid.uuid4().hex[:8]
+    staged_users_info = f'{USERS_INFO}_import_{import_id}'
+    staged_accounts = f'{ACCOUNTS}_import_{import_id}'
+    staged_leaderboard = f'{LEADERBOARD}_import_{import_id}'
+    staged_keys = [(staged_users_info, USERS_INFO),
+                   (staged_accounts, ACCOUNTS),
+                   (staged_leaderboard, LEADERBOARD)]
+    imported = 0
+    try:
+        for chunk in iter_chunks(rows, chunk_size):
+            users_info = {}
+            accounts = {}
+            for row in chunk:
+                user_id = row[0]
+                if user_id is None:
+                    continue
+                info_dict = dict(zip(USERS_INFO_FIELDS, row[1:]))
+                users_info[user_id] = json.dumps(info_dict)
+                if info_dict['account'] is not None:
+                    accounts[user_id] = int(info_dict['account'])
+            if not users_info:
+                continue
+
+            pipe = r_conn.pipeline(transaction=False)
+            pipe.hset(staged_users_info, mapping=users_info)
+            if accounts:
+                pipe.hset(staged_accounts, mapping=accounts)
+                pipe.zadd(staged_leaderboard, accounts)
+            pipe.execute()
+            imported += len(users_info)
+            # здесь же фоновая задача проверяет отмену - живые данные к этому моменту не тронуты
+            if on_progress is not None:
+                on_progress(imported, None)
+    except BaseException:
+        # отмена или ошибка в файле: временные ключи удаляются, живые остаются прежними
+        r_conn.delete(*[staged for staged, _ in staged_keys])
+        raise
+
+    if not imported:
+        # в файле нет ни одного игрока - скорее всего, загружен не тот файл
+        r_conn.delete(*[staged for staged, _ in staged_keys])
+        return 0
+    swap_staged_keys(r_conn, staged_keys)
+    return imported
@@ -0,0 +1,107 @@
+import os
+import threading
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from langchain_community.chat_models.gigachat import GigaChat
+from langchain_community.embeddings.gigachat import GigaChatEmbeddings
+
+# session_connections_* считаются только в сессии get_http_session (токен OAuth и прямые
+# запросы чата Рузика); клиенты GigaChat из get_llm/get_embeddings ходят через собственный
+# пул httpx внутри SDK, для них считается только переиспользование самих клиентов
+_stats = {
+    'session_connections_opened': 0,
+    'session_connections_requested': 0,
+    'clients_created': 0,
+    'clients_requested': 0,
+}
+_stats_lock = threading.Lock()
+
+_session = None
+_session_lock = threading.Lock()
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        _count('session_connections_opened')
+        return super()._new_conn()
+
+    def _get_conn(self, timeout=None):
+        _count('session_connections_requested')
+        return super()._get_conn(timeout=timeout)
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        _count('session_connections_opened')
+        return super()._new_conn()
+
+    def _get_conn(self, timeout=None):
+        _count('session_connections_requested')
+        return super()._get_conn(timeout=timeout)
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool,
+        }
+
+
+def get_http_session():
+    # одна keep-alive сессия на процесс вместо нового TCP+TLS соединения на каждый запрос
+    global _session
+    with _session_lock:
+        if _session is None:
+            urllib3.disable_warnings()
+            # размер пула соединений сессии на один процесс-воркер; на пул SDK не влияет
+            pool_size = int(os.getenv('GIGACHAT_POOL_SIZE', 10))
+            session = requests.Session()
+            adapter = CountingHTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.verify = False
+            _session = session
+        return _session
+
+
+def _get_client(kind, sber_token, factory):
+    _count('clients_requested')
+    with _clients_lock:
+        client = _clients.get((kind, sber_token))
+        if client is None:
+            _count('clients_created')
+            client = factory()
+            _clients[(kind, sber_token)] = client
+        return client
+
+
+def get_llm(sber_token):
+    # клиент GigaChat держит собственный пул соединений и токен, поэтому переиспользуется
+    return _get_client('llm', sber_token,
+                       lambda: GigaChat(credentials=sber_token, verify_ssl_certs=False))
+
+
+def get_embeddings(sber_token):
+    return _get_client('embeddings', sber_token,
+                       lambda: GigaChatEmbeddings(credentials=sber_token, verify_ssl_certs=False))
+
+
+def get_client_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['session_connections_reused'] = (stats['session_connections_requested']
+                                           - stats['session_connections_opened'])
+    stats['clients_reused'] = stats['clients_requested'] - stats['clients_created']
+    return stats
@@ -0,0 +1,88 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from giga_chat.clients import get_embeddings
+
+logger = logging.getLogger('embedding batcher')
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+
+class EmbeddingBatcher:
+    """Собирает тексты от одновременных проверок за короткое окно
+    и отправляет их одним запросом embed_documents."""
+
+    def __init__(self, embeddings_client, window_ms=20, max_batch=64):
+        self.embeddings_client = embeddings_client
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self.texts_count = 0
+        self.requests_count = 0
+        self._thread = threading.Thread(target=self._run, name='embedding_batcher', daemon=True)
+        self._thread.start()
+
+    def embed(self, texts):
+        future = Future()
+        self._queue.put((list(texts), future))
+        return future.result()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        size = len(batch[0][0])
+        deadline = time.monotonic() + self.window
+        while size < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                texts, future = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append((texts, future))
+            size += len(texts)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            texts = [text for item_texts, _ in batch for text in item_texts]
+            try:
+                embeddings = self.embeddings_client.embed_documents(texts=texts)
+            except Exception as exception:
+                logger.exception(exception)
+                for _, future in batch:
+                    future.set_exception(exception)
+                continue
+
+            with self._stats_lock:
+                self.texts_count += len(texts)
+                self.requests_count += 1
+
+            position = 0
+            for item_texts, future in batch:
+                future.set_result(embeddings[position:position + len(item_texts)])
+                position += len(item_texts)
+
+    def get_stats(self):
+        with self._stats_lock:
+            return {'texts': self.texts_count, 'requests': self.requests_count}
+
+
+def get_embedding_batcher(sber_token):
+    with _batchers_lock:
+        batcher = _batchers.get(sber_token)
+        if batcher is None:
+            batcher = EmbeddingBatcher(
+                get_embeddings(sber_token),
+                window_ms=int(os.getenv('EMBEDDING_BATCH_WINDOW_MS', 20)),
+                max_batch=int(os.getenv('EMBEDDING_MAX_BATCH', 64))
+            )
+            _batchers[sber_token] = batcher
+        return batcher
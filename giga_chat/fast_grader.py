@@ -0,0 +1,104 @@
+import re
+from difflib import SequenceMatcher
+
+from database.client_redis_tools import scale_text
+
+STATS_KEY = 'grading_stats'
+
+STOP_WORDS = {
+    'в', 'во', 'на', 'и', 'а', 'но', 'с', 'со', 'к', 'ко', 'по', 'из', 'за', 'от', 'до', 'о', 'об',
+    'у', 'для', 'это', 'этот', 'эта', 'то', 'так', 'же', 'ли', 'бы', 'был', 'была', 'было', 'были',
+    'год', 'году', 'года', 'годы', 'г', 'наш', 'наша', 'наше', 'наши', 'нашего', 'нашей', 'нашем',
+    'компания', 'компании', 'бренд', 'бренда', 'называется', 'название', 'ответ', 'думаю', 'наверное',
+}
+NEGATIONS = {'не', 'нет', 'ни', 'никогда', 'никто', 'ничего'}
+
+
+def normalize_answer(text):
+    text = scale_text(text).lower().replace('ё', 'е')
+    text = re.sub(r'[^\w\s]', ' ', text)
+    return ' '.join(text.split())
+
+
+def extract_numbers(text):
+    return set(re.findall(r'\d+', text))
+
+
+def get_stems(words):
+    # грубая замена стемминга: у длинных слов отбрасываем окончание
+    return {word[:5] if len(word) > 5 else word for word in words}
+
+
+def fast_grade(answer, correct_answer):
+    """Возвращает (оценка, причина) для очевидных случаев или None,
+    если ответ нужно отдать на проверку GigaChat."""
+    answer = normalize_answer(answer)
+    correct_answer = normalize_answer(correct_answer)
+
+    if not answer:
+        return 0.0, 'Пустой ответ.'
+    if answer == correct_answer:
+        return 1.0, 'Ответ совпадает с правильным.'
+
+    answer_words = answer.split()
+    correct_words = correct_answer.split()
+    # отрицание меняет смысл при полном совпадении слов, такие ответы проверяет GigaChat
+    if (NEGATIONS & set(answer_words)) != (NEGATIONS & set(correct_words)):
+        return None
+
+    answer_numbers = extract_numbers(answer)
+    correct_numbers = extract_numbers(correct_answer)
+    answer_content = get_stems(word for word in answer_words if word not in STOP_WORDS and not word.isdigit())
+    correct_content = get_stems(word for word in correct_words if word not in STOP_WORDS and not word.isdigit())
+
+    # числа должны совпадать точно: ответ с лишним или другим числом засчитывать нельзя,
+    # даже если строки почти одинаковы ("1996" и "1995" отличаются одной цифрой)
+    numbers_match = answer_numbers == correct_numbers
+
+    if correct_numbers:
+        # голое число засчитывается, только если в правильном ответе кроме числа ничего нет:
+        # "12" на "12 апреля" решает GigaChat
+        if numbers_match and (answer_content == correct_content or not correct_content):
+            return 1.0, 'Ответ содержит правильное число.'
+        if answer_numbers and not (answer_numbers & correct_numbers) and not correct_content:
+            return 0.0, 'Число в ответе не совпадает с правильным.'
+
+    if numbers_match and SequenceMatcher(None, answer, correct_answer).ratio() >= 0.9:
+        return 1.0, 'Ответ совпадает с правильным с точностью до опечаток.'
+
+    # лишние значимые слова (например, несколько вариантов сразу) без GigaChat не засчитываются
+    if numbers_match and correct_content and answer_content == correct_content:
+        return 1.0, 'Ответ содержит все ключевые слова правильного ответа.'
+
+    # промахом считаем только расхождение в одно слово, перефразировки проверяет GigaChat
+    if (len(answer_content) <= 1 and len(correct_content) <= 1
+            and not (answer_content & correct_content)
+            and not (answer_numbers & correct_numbers)
+            and SequenceMatcher(None, answer, correct_answer).ratio() < 0.35):
+        return 0.0, 'Ответ не имеет ничего общего с правильным.'
+
+    return None
+
+
+def update_fast_grader_stats(verdict, r_conn):
+    if verdict is None:
+        r_conn.hincrby(STATS_KEY, 'fast_escalated', 1)
+    elif verdict[0] > 0:
+        r_conn.hincrby(STATS_KEY, 'fast_hit', 1)
+    else:
+        r_conn.hincrby(STATS_KEY, 'fast_miss', 1)
+
+
+def get_fast_grader_stats(r_conn):
+    stats = r_conn.hgetall(STATS_KEY)
+    hit = int(stats.get('fast_hit', 0))
+    miss = int(stats.get('fast_miss', 0))
+    escalated = int(stats.get('fast_escalated', 0))
+    total = hit + miss + escalated
+    return {
+        'fast_hit': hit,
+        'fast_miss': miss,
+        'fast_escalated': escalated,
+        # доля ответов, для которых вызов GigaChat не понадобился
+        'llm_calls_saved': (hit + miss) / total if total else 0.0,
+    }
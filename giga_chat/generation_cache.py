@@ -0,0 +1,79 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from giga_chat.giga_model import QA_PROMPT_VERSION
+
+GENERATION_CACHE = 'qa_generation_cache'
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_document_hash(text):
+    return hashlib.sha256(text.strip().encode('utf-8')).hexdigest()[:24]
+
+
+class GenerationCache:
+    """Хранит в redis вопросы, сгенерированные по документу.
+
+    Пары копятся в одном списке на документ и версию промпта, поэтому повторная
+    генерация отдает начало списка, а "ещё N" - следующие N пар; GigaChat вызывается
+    только для недостающих. Документы вытесняются по TTL и по давности использования.
+    """
+
+    def __init__(self, r_conn, ttl=604800, max_documents=100):
+        self.r_conn = r_conn
+        self.ttl = ttl
+        self.max_documents = max_documents
+
+    def get_key(self, text):
+        # версия промпта входит в ключ: после правки промпта старые вопросы не отдаются
+        return f'qa_generation_v{QA_PROMPT_VERSION}_{get_document_hash(text)}'
+
+    def get_page(self, text, num, generate, offset=0):
+        """Возвращает пары [offset, offset + num) и сколько из них взято из кэша.
+
+        generate(missing, produced) вызывается, только если пар не хватает,
+        и получает уже сгенерированные пары, чтобы не повторять их."""
+        key = self.get_key(text)
+        stop = offset + num
+        produced = [tuple(json.loads(value)) for value in self.r_conn.lrange(key, 0, -1)]
+        cached = max(0, min(len(produced), stop) - offset)
+
+        new_pairs = []
+        if len(produced) < stop:
+            new_pairs = generate(stop - len(produced), produced)
+
+        pipe = self.r_conn.pipeline(transaction=False)
+        if new_pairs:
+            pipe.rpush(key, *[json.dumps(pair, ensure_ascii=False) for pair in new_pairs])
+        pipe.expire(key, self.ttl)
+        pipe.zadd(GENERATION_CACHE, {key: time.time()})
+        pipe.execute()
+        self._evict()
+
+        return (produced + new_pairs)[offset:stop], cached
+
+    def _evict(self):
+        # удаляются давно не использованные документы сверх max_documents
+        extra = self.r_conn.zcard(GENERATION_CACHE) - self.max_documents
+        if extra <= 0:
+            return
+        keys = [key for key, _ in self.r_conn.zpopmin(GENERATION_CACHE, extra)]
+        if keys:
+            self.r_conn.delete(*keys)
+
+
+def get_generation_cache(r_conn):
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = GenerationCache(
+                r_conn,
+                ttl=int(os.getenv('QA_GENERATION_CACHE_TTL', 604800)),
+                max_documents=int(os.getenv('QA_GENERATION_CACHE_SIZE', 100))
+            )
+        return _cache
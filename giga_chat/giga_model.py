@@ -2,7 +2,6 @@ import json
 import os
 import re
 import requests
-import urllib3
 import uuid
 from typing import Any, Dict, List, Optional, Sequence, Union
 
@@ -12,8 +11,6 @@ from langchain.evaluation import load_evaluator
 from langchain.evaluation.qa import QAEvalChain
 from langchain.output_parsers.regex import RegexParser
 from langchain.prompts import PromptTemplate
-from langchain_community.chat_models.gigachat import GigaChat
-from langchain_community.embeddings.gigachat import GigaChatEmbeddings
 from langchain_core.callbacks import CallbackManager, Callbacks
 from langchain_core.language_models import BaseLanguageModel
 from langchain_core.load.dump import dumpd
@@ -22,6 +19,9 @@ from langchain_core.output_parsers import BaseLLMOutputParser
 from langchain_core.pydantic_v1 import Field
 from sklearn.metrics.pairwise import cosine_similarity
 
+from giga_chat.clients import get_http_session, get_llm
+from giga_chat.embedding_batcher import get_embedding_batcher
+
 
 def get_prompt_accuracy(question: str, correct_answer: str, answer: str) -> str:
 
@@ -47,6 +47,9 @@ def get_prompt_accuracy(question: str, correct_answer: str, answer: str) -> str:
 
     return prompt
 
+# увеличивать при каждом изменении get_prompt_qa: версия входит в ключ кэша генерации
+QA_PROMPT_VERSION = 1
+
 def get_prompt_qa(doc: str, num: int) -> str:
     template = """
     Вы преподаватель, который составляет вопросы для викторины.
@@ -146,7 +149,7 @@ class QAGenerateChain(LLMChain):
         return self._parse_generation(result)
 
 def custom_evaluate_qa(answer, correct_answer, question, sber_token):
-    llm = GigaChat(credentials=sber_token, verify_ssl_certs=False)
+    llm = get_llm(sber_token)
     prompt = get_prompt_accuracy(question, correct_answer, answer)
     eval_chain = QAEvalChain.from_llm(llm=llm, prompt=prompt)
     qa = [
@@ -170,22 +173,26 @@ def custom_evaluate_qa(answer, correct_answer, question, sber_token):
     return score, reasoning
 
 def custom_generate_qa(doc, number, sber_token):
-    llm = GigaChat(credentials=sber_token, verify_ssl_certs=False)
+    llm = get_llm(sber_token)
     prompt = get_prompt_qa(doc, number)
     generate_chain = QAGenerateChain.from_llm(llm=llm, prompt=prompt)
     result = generate_chain.apply_and_parse([{"doc": doc, "num": number}])
 
     return result
 
-def get_cosine_similarity(answer, correct_answer, sber_token):
-    embeddings = GigaChatEmbeddings(credentials=sber_token, verify_ssl_certs=False)
-    answer_emb = embeddings.embed_documents(texts=[answer])
-    correct_answer_emb = embeddings.embed_documents(texts=[correct_answer])
-    cos_sim = cosine_similarity(answer_emb, correct_answer_emb)
+def get_cosine_similarity(answer, correct_answer, sber_token, correct_answer_emb=None):
+    # тексты уходят в общий батч вместе с ответами других одновременных проверок
+    batcher = get_embedding_batcher(sber_token)
+    if correct_answer_emb is None:
+        answer_emb, correct_answer_emb = batcher.embed([answer, correct_answer])
+    else:
+        # эмбеддинг правильного ответа посчитан при загрузке вопросов
+        answer_emb = batcher.embed([answer])[0]
+    cos_sim = cosine_similarity([answer_emb], [correct_answer_emb])
     return cos_sim
 
 def get_similarity_score(answer, correct_answer, question, sber_token):
-    llm = GigaChat(credentials=sber_token, verify_ssl_certs=False)
+    llm = get_llm(sber_token)
     evaluator = load_evaluator(
         'labeled_score_string',
         llm=llm,
@@ -201,7 +208,10 @@ def get_similarity_score(answer, correct_answer, question, sber_token):
     print(eval_result)
     return eval_result['score']
 
-def get_token(auth_token, scope='GIGACHAT_API_PERS'):
+class GigaChatTokenError(requests.RequestException):
+    pass
+
+def get_token_info(auth_token, scope='GIGACHAT_API_PERS'):
     # Создадим идентификатор UUID (36 знаков)
     rq_uid = str(uuid.uuid4())
 
@@ -218,24 +228,35 @@ def get_token(auth_token, scope='GIGACHAT_API_PERS'):
         'scope': scope
     }
 
+    response = get_http_session().post(url, headers=headers, data=payload, verify=False)
+    # ответ с ошибкой авторизации не должен попасть в кэш токенов как токен
+    response.raise_for_status()
+    response_data = response.json()
+    missing = [field for field in ('access_token', 'expires_at') if not response_data.get(field)]
+    if missing:
+        raise GigaChatTokenError(f'the token response has no {", ".join(missing)}; '
+                                 f'received fields: {sorted(response_data)}')
+    # expires_at приходит в миллисекундах
+    return response_data['access_token'], response_data['expires_at'] / 1000
+
+def get_token(auth_token, scope='GIGACHAT_API_PERS'):
     try:
-        urllib3.disable_warnings()
-        response = requests.post(url, headers=headers, data=payload, verify=False)
-        return response.json()['access_token']
+        access_token, _ = get_token_info(auth_token, scope)
+        return access_token
     except requests.RequestException as e:
         print(f'Ошибка: {str(e)}')
         return -1
 
-def connect_ruzik_chat(TOKEN, request, messages=None):
-
-    url = 'https://gigachat.devices.sberbank.ru/api/v1/chat/completions'
-
+def get_ruzik_chat_payload(request, messages, stream=False):
     # Если история диалога не предоставлена, инициализируем пустым списком
-    if messages is None or len(messages) == 0:
-        messages = [{
+    if messages is None:
+        messages = []
+    # список дополняется на месте, чтобы вызывающий код видел историю после потоковой передачи
+    if len(messages) == 0 or messages[0]['role'] != 'system':
+        messages.insert(0, {
             'role': 'system',
             'content': 'Отвечай как ассистент компании Рузик. Тебя зовут Рузик-чат.'
-        }]
+        })
 
     # Добавляем сообщение пользователя в историю диалога
     messages.append({
@@ -250,11 +271,18 @@ def connect_ruzik_chat(TOKEN, request, messages=None):
         'temperature': 1,  # Температура генерации
         'top_p': 0.1,  # Параметр top_p для контроля разнообразия ответов
         'n': 1,  # Количество возвращаемых ответов
-        'stream': False,  # Потоковая ли передача ответов
+        'stream': stream,  # Потоковая ли передача ответов
         'max_tokens': 512,  # Максимальное количество токенов в ответе
         'repetition_penalty': 1,  # Штраф за повторения
         'update_interval': 0  # Интервал обновления (для потоковой передачи)
     })
+    return payload, messages
+
+def connect_ruzik_chat(TOKEN, request, messages=None):
+
+    url = 'https://gigachat.devices.sberbank.ru/api/v1/chat/completions'
+
+    payload, messages = get_ruzik_chat_payload(request, messages)
 
     # Заголовки запроса
     headers = {
@@ -265,7 +293,7 @@ def connect_ruzik_chat(TOKEN, request, messages=None):
 
     # Выполнение POST-запроса и возвращение ответа
     try:
-        response = requests.post(url, headers=headers, data=payload, verify=False)
+        response = get_http_session().post(url, headers=headers, data=payload, verify=False)
         response_data = response.json()
 
         # Добавляем ответ модели в историю диалога
@@ -281,6 +309,41 @@ def connect_ruzik_chat(TOKEN, request, messages=None):
         print(f'Произошла ошибка: {str(e)}')
         return None, messages
 
+def stream_ruzik_chat(TOKEN, request, messages):
+    # Отдает ответ модели по частям (SSE), по окончании добавляет его в messages
+    url = 'https://gigachat.devices.sberbank.ru/api/v1/chat/completions'
+
+    payload, messages = get_ruzik_chat_payload(request, messages, stream=True)
+
+    headers = {
+        'Content-Type': 'application/json',
+        'Accept': 'text/event-stream',
+        'Authorization': f'Bearer {TOKEN}'
+    }
+
+    content = []
+    with get_http_session().post(url, headers=headers, data=payload, verify=False, stream=True) as response:
+        response.raise_for_status()
+        # в заголовках потока нет charset, без этого кириллица декодируется как latin-1
+        response.encoding = 'utf-8'
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith('data:'):
+                continue
+            data = line[len('data:'):].strip()
+            if data == '[DONE]':
+                break
+            chunk = json.loads(data)['choices'][0].get('delta', {}).get('content')
+            if chunk:
+                content.append(chunk)
+                yield chunk
+
+    # пустой ответ не сохраняется в историю; при ошибке сюда не доходим вовсе
+    if content:
+        messages.append({
+            'role': 'assistant',
+            'content': ''.join(content)
+        })
+
 def main():
     load_dotenv()
 
@@ -0,0 +1,37 @@
+from vk_api.utils import get_random_id
+
+from database.client_redis_tools import normalize_correct_answer, upload_account
+from giga_chat.grading_pipeline import GradingRequest, get_bonus, grade
+from vk.keyboards import create_keyboard
+
+
+def func_grade_answer(vk, SBER_TOKEN, job, r_conn, job_id=None):
+    user_id = job['user_id']
+    request = GradingRequest(
+        answer=job['answer'],
+        correct_answer=normalize_correct_answer(job['correct_answer']),
+        question=job['question'],
+        num_qa=job.get('num_qa') or None,
+        raw_correct_answer=job['correct_answer']
+    )
+    # дешевые стадии идут первыми, GigaChat вызывается только для спорных ответов
+    similarity_score, reasoning = grade(request, SBER_TOKEN, r_conn)
+    bonus, verdict_message = get_bonus(similarity_score)
+
+    if bonus > 0:
+        # задание может быть доставлено повторно, если воркер упал до подтверждения
+        upload_account(bonus, user_id, r_conn, credit_id=job_id)
+        message = f"{verdict_message} Получате {bonus} балл(а/ов).\n Причина: {reasoning}"
+    else:
+        message = f"{verdict_message} \n Причина: {reasoning}"
+    vk.messages.send(user_id=user_id,
+                     message=message,
+                     random_id=get_random_id(),
+                     keyboard=create_keyboard())
+
+def handle_grading_failed(vk, user_id):
+    message = "Не удалось проверить ответ, ответьте еще раз."
+    vk.messages.send(user_id=user_id,
+                     message=message,
+                     random_id=get_random_id(),
+                     keyboard=create_keyboard())
@@ -0,0 +1,142 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from database.admin_redis_tools import upload_answer_embeddings
+from database.client_redis_tools import get_answer_embedding
+from giga_chat.fast_grader import STATS_KEY, fast_grade, update_fast_grader_stats
+from giga_chat.giga_model import custom_evaluate_qa, get_cosine_similarity
+from giga_chat.verdict_cache import get_verdict_cache
+
+logger = logging.getLogger('grading pipeline')
+
+_config = None
+_config_lock = threading.Lock()
+
+
+class GradingRequest:
+    """Ответ игрока и все, что о нем узнали стадии проверки."""
+
+    def __init__(self, answer, correct_answer, question, num_qa=None, raw_correct_answer=None):
+        self.answer = answer
+        self.correct_answer = correct_answer
+        self.question = question
+        self.num_qa = num_qa
+        self.raw_correct_answer = raw_correct_answer or correct_answer
+        # нижняя граница оценки от дешевых стадий, LLM может ее только поднять
+        self.floor_score = 0.0
+        self.floor_reasoning = None
+
+
+def stage_lexical(request, config, sber_token, r_conn):
+    verdict = fast_grade(request.answer, request.correct_answer)
+    update_fast_grader_stats(verdict, r_conn)
+    return verdict
+
+
+def stage_cosine(request, config, sber_token, r_conn):
+    correct_answer_emb = get_answer_embedding(request.num_qa, r_conn)
+    if correct_answer_emb is None and request.num_qa is not None:
+        # вопрос загружен до появления эмбеддингов - считаем один раз и сохраняем
+        correct_answer_emb = upload_answer_embeddings(
+            r_conn, [request.num_qa], [request.raw_correct_answer], sber_token
+        )[0]
+    cos_sim = float(get_cosine_similarity(request.answer, request.correct_answer, sber_token, correct_answer_emb))
+
+    cosine_config = config['cosine']
+    reasoning = f'Ответ близок к правильному по смыслу (сходство {cos_sim:.2f}).'
+    for floor in cosine_config.get('floors', []):
+        if cos_sim >= floor['min_similarity'] and floor['score'] > request.floor_score:
+            request.floor_score = floor['score']
+            request.floor_reasoning = reasoning
+            break
+
+    accept_above = cosine_config.get('accept_above')
+    if accept_above is not None and cos_sim >= accept_above:
+        return request.floor_score, reasoning
+    reject_below = cosine_config.get('reject_below')
+    if reject_below is not None and cos_sim < reject_below:
+        return 0.0, f'Ответ далек от правильного по смыслу (сходство {cos_sim:.2f}).'
+    # сходство в полосе неопределенности - решает LLM
+    return None
+
+
+def stage_llm(request, config, sber_token, r_conn):
+    # одинаковые ответы на один вопрос оцениваются GigaChat один раз
+    verdict_cache = get_verdict_cache(r_conn)
+    return verdict_cache.get_or_evaluate(
+        verdict_cache.get_key(request.num_qa, request.question, request.correct_answer, request.answer),
+        lambda: custom_evaluate_qa(request.answer, request.correct_answer, request.question, sber_token)
+    )
+
+
+STAGES = {
+    'lexical': stage_lexical,
+    'cosine': stage_cosine,
+    'llm': stage_llm,
+}
+
+
+def load_grading_config(path=None):
+    global _config
+    with _config_lock:
+        if _config is None or path is not None:
+            path = path or os.getenv('GRADING_CONFIG', 'grading_config.json')
+            with open(path, 'r', encoding='utf-8') as file:
+                config = json.load(file)
+            unknown_stages = set(config['stages']) - set(STAGES)
+            if unknown_stages:
+                raise ValueError(f'unknown grading stages: {sorted(unknown_stages)}')
+            config['bonuses'] = sorted(config['bonuses'], key=lambda band: band['min_score'], reverse=True)
+            _config = config
+        return _config
+
+
+def record_stage(r_conn, stage_name, decided, latency_ms):
+    pipe = r_conn.pipeline(transaction=False)
+    pipe.hincrby(STATS_KEY, f'stage_{stage_name}_{"decided" if decided else "escalated"}', 1)
+    pipe.hincrbyfloat(STATS_KEY, f'stage_{stage_name}_ms', latency_ms)
+    pipe.execute()
+
+
+def grade(request, sber_token, r_conn, config=None):
+    config = config or load_grading_config()
+    score, reasoning = None, None
+    for stage_name in config['stages']:
+        start = time.monotonic()
+        verdict = STAGES[stage_name](request, config, sber_token, r_conn)
+        latency_ms = (time.monotonic() - start) * 1000
+        record_stage(r_conn, stage_name, verdict is not None, latency_ms)
+        logger.debug(f'the grading stage {stage_name} took {latency_ms:.1f} ms, verdict: {verdict}')
+        if verdict is not None:
+            score, reasoning = verdict
+            break
+
+    if score is None or score < request.floor_score:
+        score, reasoning = request.floor_score, request.floor_reasoning or reasoning or 'Нет комментарий.'
+    return score, reasoning
+
+
+def get_bonus(score, config=None):
+    config = config or load_grading_config()
+    for band in config['bonuses']:
+        if score >= band['min_score']:
+            return band['bonus'], band['message']
+    return 0, config['wrong_message']
+
+
+def get_stage_stats(r_conn):
+    stats = r_conn.hgetall(STATS_KEY)
+    stage_stats = {}
+    for stage_name in STAGES:
+        decided = int(stats.get(f'stage_{stage_name}_decided', 0))
+        escalated = int(stats.get(f'stage_{stage_name}_escalated', 0))
+        total = decided + escalated
+        stage_stats[stage_name] = {
+            'decided': decided,
+            'escalated': escalated,
+            'avg_ms': float(stats.get(f'stage_{stage_name}_ms', 0)) / total if total else 0.0,
+        }
+    return stage_stats
@@ -0,0 +1,107 @@
+import logging
+import math
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from giga_chat.fast_grader import normalize_answer
+from giga_chat.giga_model import _QA_OUTPUT_PARSER, custom_generate_qa
+
+logger = logging.getLogger('qa generation')
+
+
+def split_document(text, chunk_size=4000):
+    # режем по абзацам, чтобы вопрос не строился по половине мысли
+    chunks = []
+    current = ''
+    for paragraph in re.split(r'\n\s*\n', text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        while len(paragraph) > chunk_size:
+            if current:
+                chunks.append(current)
+                current = ''
+            chunks.append(paragraph[:chunk_size])
+            paragraph = paragraph[chunk_size:]
+        if current and len(current) + len(paragraph) + 2 > chunk_size:
+            chunks.append(current)
+            current = ''
+        current = f'{current}\n\n{paragraph}' if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def parse_generated_qa(text):
+    return [(question.strip(), answer.strip())
+            for question, answer in re.findall(_QA_OUTPUT_PARSER.regex, text)
+            if question.strip() and answer.strip()]
+
+
+def format_qa_pairs(qa_pairs):
+    return ''.join(f'Вопрос: {question}\nОтвет: {answer}\n\n' for question, answer in qa_pairs)
+
+
+def get_chunk_quotas(chunks_count, num, offset=0):
+    # вопросы распределяются по кускам равномерно; если кусков больше, чем вопросов,
+    # берутся куски через равные промежутки, со сдвигом на каждом раунде добора
+    if num <= 0 or chunks_count == 0:
+        return []
+    if num >= chunks_count:
+        base, extra = divmod(num, chunks_count)
+        return [((index + offset) % chunks_count, base + (1 if index < extra else 0))
+                for index in range(chunks_count)]
+    step = chunks_count / num
+    return [((int(index * step) + offset) % chunks_count, 1) for index in range(num)]
+
+
+def generate_qa(text, num, sber_token, max_workers=4, chunk_size=4000, max_rounds=3, on_pairs=None,
+                exclude=()):
+    """Генерирует ровно num пар вопрос-ответ (если документа хватает):
+    куски документа обрабатываются параллельно, повторы отбрасываются,
+    недостающие пары добираются следующими раундами.
+
+    exclude - пары, уже выданные по этому документу: они не повторяются,
+    а выбор кусков сдвигается, чтобы новые вопросы шли по другим частям текста."""
+    chunks = split_document(text, chunk_size)
+    qa_pairs = []
+    seen = {normalize_answer(question) for question, _ in exclude}
+    shift = len(exclude)
+
+    for round_num in range(max_rounds):
+        missing = num - len(qa_pairs)
+        if missing <= 0:
+            break
+        # модель часто возвращает меньше вопросов, чем просили, поэтому просим с запасом
+        requested = missing if round_num == 0 else math.ceil(missing * 1.5)
+        quotas = get_chunk_quotas(len(chunks), requested, offset=shift + round_num)
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='qa_generation') as executor:
+            futures = [executor.submit(custom_generate_qa, chunks[index], quota, sber_token)
+                       for index, quota in quotas]
+            try:
+                for future in as_completed(futures):
+                    try:
+                        generated = parse_generated_qa(future.result())
+                    except Exception as exception:
+                        logger.error('the generation of a document chunk failed.')
+                        logger.exception(exception)
+                        continue
+
+                    new_pairs = []
+                    for question, answer in generated:
+                        key = normalize_answer(question)
+                        if key in seen or len(qa_pairs) + len(new_pairs) >= num:
+                            continue
+                        seen.add(key)
+                        new_pairs.append((question, answer))
+                    qa_pairs.extend(new_pairs)
+                    if new_pairs and on_pairs is not None:
+                        on_pairs(new_pairs, len(qa_pairs), num)
+            except BaseException:
+                # отмена или ошибка в on_pairs - не ждем оставшиеся куски
+                for future in futures:
+                    future.cancel()
+                raise
+
+    return qa_pairs
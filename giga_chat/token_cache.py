@@ -0,0 +1,141 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+
+from giga_chat.giga_model import get_token_info
+
+logger = logging.getLogger('gigachat token')
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+class GigaChatTokenProvider:
+    """Кэширует токен доступа GigaChat до истечения срока действия.
+
+    Токен обновляется заранее, за refresh_margin секунд до истечения;
+    одновременные обновления в процессе схлопываются в один запрос,
+    а при переданном r_conn токен и блокировка обновления общие для всех процессов.
+    """
+
+    def __init__(self, auth_token, r_conn=None, scope='GIGACHAT_API_PERS', refresh_margin=120):
+        self.auth_token = auth_token
+        self.r_conn = r_conn
+        self.scope = scope
+        self.refresh_margin = refresh_margin
+        credentials_hash = hashlib.sha256(f'{auth_token}:{scope}'.encode('utf-8')).hexdigest()[:16]
+        self.redis_key = f'gigachat_token_{credentials_hash}'
+        self.lock_key = f'{self.redis_key}_lock'
+
+        self._access_token = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def get_token(self):
+        now = time.time()
+        if self._access_token is not None and now < self._expires_at - self.refresh_margin:
+            return self._access_token
+
+        if self._access_token is not None and now < self._expires_at:
+            # токен еще действует - обновляем в фоне, не задерживая запрос
+            self._refresh_in_background()
+            return self._access_token
+
+        with self._lock:
+            if self._access_token is None or time.time() >= self._expires_at:
+                self._refresh()
+            return self._access_token
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def refresh():
+            try:
+                with self._lock:
+                    self._refresh()
+            except Exception as exception:
+                logger.error('the background token refresh failed.')
+                logger.exception(exception)
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def _set_token(self, access_token, expires_at):
+        self._access_token = access_token
+        self._expires_at = expires_at
+
+    def _load_shared(self):
+        value = self.r_conn.get(self.redis_key)
+        if value is None:
+            return None
+        token_info = json.loads(value)
+        if time.time() >= token_info['expires_at'] - self.refresh_margin:
+            return None
+        return token_info['access_token'], token_info['expires_at']
+
+    def _store_shared(self, access_token, expires_at):
+        ttl_ms = int((expires_at - time.time()) * 1000)
+        if ttl_ms > 0:
+            self.r_conn.set(
+                self.redis_key,
+                json.dumps({'access_token': access_token, 'expires_at': expires_at}),
+                px=ttl_ms
+            )
+
+    def _refresh(self):
+        if self.r_conn is None:
+            self._set_token(*get_token_info(self.auth_token, self.scope))
+            return
+
+        shared = self._load_shared()
+        if shared is not None:
+            self._set_token(*shared)
+            return
+
+        # за новым токеном ходит только один процесс, остальные ждут его в redis
+        lock_value = str(uuid.uuid4())
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            if self.r_conn.set(self.lock_key, lock_value, nx=True, px=10000):
+                try:
+                    shared = self._load_shared()
+                    if shared is None:
+                        shared = get_token_info(self.auth_token, self.scope)
+                        self._store_shared(*shared)
+                    self._set_token(*shared)
+                    return
+                finally:
+                    if self.r_conn.get(self.lock_key) == lock_value:
+                        self.r_conn.delete(self.lock_key)
+
+            time.sleep(0.05)
+            shared = self._load_shared()
+            if shared is not None:
+                self._set_token(*shared)
+                return
+
+        # процесс с блокировкой завис - получаем токен сами
+        shared = get_token_info(self.auth_token, self.scope)
+        self._store_shared(*shared)
+        self._set_token(*shared)
+
+
+def get_token_provider(auth_token, r_conn=None, scope='GIGACHAT_API_PERS'):
+    with _providers_lock:
+        provider = _providers.get((auth_token, scope))
+        if provider is None:
+            provider = GigaChatTokenProvider(auth_token, r_conn=r_conn, scope=scope)
+            _providers[(auth_token, scope)] = provider
+        return provider
+
+
+def get_cached_token(auth_token, r_conn=None, scope='GIGACHAT_API_PERS'):
+    return get_token_provider(auth_token, r_conn=r_conn, scope=scope).get_token()
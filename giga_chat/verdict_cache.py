@@ -0,0 +1,159 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from giga_chat.fast_grader import STATS_KEY, normalize_answer
+
+logger = logging.getLogger('verdict cache')
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class VerdictCache:
+    """Кэширует оценку GigaChat по паре (вопрос, нормализованный ответ).
+
+    Оценки хранятся в redis с TTL и в LRU внутри процесса; одинаковые ответы,
+    пришедшие одновременно, ждут один вызов GigaChat - внутри процесса через Future,
+    между процессами через блокировку в redis.
+    """
+
+    def __init__(self, r_conn, ttl=604800, max_size=10000, lock_timeout=30):
+        self.r_conn = r_conn
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock_timeout = lock_timeout
+        self._local = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def get_key(self, num_qa, question, correct_answer, answer):
+        # правильный ответ входит в ключ, чтобы правка вопроса админом не оставляла старых оценок
+        text = f'{question}\n{correct_answer}\n{normalize_answer(answer)}'
+        answer_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()[:24]
+        return f'grading_verdict_{num_qa or "none"}_{answer_hash}'
+
+    def _get_local(self, key):
+        with self._lock:
+            verdict = self._local.get(key)
+            if verdict is not None:
+                self._local.move_to_end(key)
+            return verdict
+
+    def _set_local(self, key, verdict):
+        with self._lock:
+            self._local[key] = verdict
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_size:
+                self._local.popitem(last=False)
+
+    def _get_shared(self, key):
+        value = self.r_conn.get(key)
+        if value is None:
+            return None
+        verdict = json.loads(value)
+        self._set_local(key, verdict)
+        return verdict
+
+    def _hit(self, verdict):
+        pipe = self.r_conn.pipeline(transaction=False)
+        pipe.hincrby(STATS_KEY, 'verdict_hit', 1)
+        pipe.hincrbyfloat(STATS_KEY, 'verdict_saved_ms', verdict['latency_ms'])
+        pipe.execute()
+        return verdict['score'], verdict['reasoning']
+
+    def get_or_evaluate(self, key, evaluate):
+        verdict = self._get_local(key) or self._get_shared(key)
+        if verdict is not None:
+            return self._hit(verdict)
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._in_flight[key] = future
+
+        if not owner:
+            # такой же ответ уже проверяется в этом процессе
+            return self._hit(future.result())
+
+        try:
+            verdict = self._evaluate_once(key, evaluate)
+            future.set_result(verdict)
+        except Exception as exception:
+            future.set_exception(exception)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+        if verdict.get('cached'):
+            return self._hit(verdict)
+        self.r_conn.hincrby(STATS_KEY, 'verdict_miss', 1)
+        return verdict['score'], verdict['reasoning']
+
+    def _evaluate_once(self, key, evaluate):
+        lock_key = f'{key}_lock'
+        lock_value = str(uuid.uuid4())
+        deadline = time.time() + self.lock_timeout
+        while not self.r_conn.set(lock_key, lock_value, nx=True, px=self.lock_timeout * 1000):
+            # такой же ответ проверяет другой процесс - ждем его оценку
+            time.sleep(0.05)
+            verdict = self._get_shared(key)
+            if verdict is not None:
+                return dict(verdict, cached=True)
+            if time.time() >= deadline:
+                logger.warning(f'the verdict lock {lock_key} expired, evaluating without it.')
+                return self._evaluate(key, evaluate)
+
+        try:
+            verdict = self._get_shared(key)
+            if verdict is not None:
+                return dict(verdict, cached=True)
+            return self._evaluate(key, evaluate)
+        finally:
+            if self.r_conn.get(lock_key) == lock_value:
+                self.r_conn.delete(lock_key)
+
+    def _evaluate(self, key, evaluate):
+        start = time.monotonic()
+        score, reasoning = evaluate()
+        verdict = {
+            'score': score,
+            'reasoning': reasoning,
+            'latency_ms': round((time.monotonic() - start) * 1000, 1),
+        }
+        self.r_conn.set(key, json.dumps(verdict, ensure_ascii=False), ex=self.ttl)
+        self._set_local(key, verdict)
+        return verdict
+
+
+def get_verdict_cache(r_conn):
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = VerdictCache(
+                r_conn,
+                ttl=int(os.getenv('VERDICT_CACHE_TTL', 604800)),
+                max_size=int(os.getenv('VERDICT_CACHE_SIZE', 10000))
+            )
+        return _cache
+
+
+def get_verdict_cache_stats(r_conn):
+    stats = r_conn.hgetall(STATS_KEY)
+    hit = int(stats.get('verdict_hit', 0))
+    miss = int(stats.get('verdict_miss', 0))
+    return {
+        'verdict_hit': hit,
+        'verdict_miss': miss,
+        'verdict_hit_ratio': hit / (hit + miss) if hit + miss else 0.0,
+        'verdict_saved_ms': float(stats.get('verdict_saved_ms', 0)),
+    }
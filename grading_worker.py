@@ -0,0 +1,145 @@
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import redis
+from dotenv import load_dotenv
+
+import vk_api
+
+from database.grading_queue import (
+    ack_grading_job,
+    claim_stale_grading_jobs,
+    create_grading_group,
+    get_delivery_count,
+    read_grading_jobs
+)
+from giga_chat.clients import get_client_stats
+from giga_chat.embedding_batcher import get_embedding_batcher
+from giga_chat.fast_grader import get_fast_grader_stats
+from giga_chat.grading import func_grade_answer, handle_grading_failed
+from giga_chat.grading_pipeline import get_stage_stats, load_grading_config
+from giga_chat.verdict_cache import get_verdict_cache_stats
+
+logger = logging.getLogger('grading worker')
+
+
+def process_job(vk, SBER_TOKEN, job_id, job, r_conn, max_deliveries):
+    try:
+        func_grade_answer(vk, SBER_TOKEN, job, r_conn, job_id=job_id)
+    except Exception as exception:
+        logger.error(f'the grading job {job_id} failed.')
+        logger.exception(exception)
+        # задание остается неподтвержденным и будет повторено, пока не исчерпаны попытки
+        if get_delivery_count(job_id, r_conn) < max_deliveries:
+            return
+        logger.error(f'the grading job {job_id} dropped after {max_deliveries} attempts.')
+        # без ответа игрок так и ждал бы результата проверки
+        try:
+            handle_grading_failed(vk, job['user_id'])
+        except Exception as exception:
+            logger.error(f'the grading job {job_id} failure notice failed.')
+            logger.exception(exception)
+    ack_grading_job(job_id, r_conn)
+
+
+def consume_jobs(consumer_name, vk, SBER_TOKEN, r_conn, claim_idle_ms, max_deliveries):
+    jobs_done = 0
+
+    while True:
+        try:
+            jobs = claim_stale_grading_jobs(consumer_name, r_conn, min_idle_ms=claim_idle_ms)
+            if not jobs:
+                jobs = read_grading_jobs(consumer_name, r_conn)
+
+            for job_id, job in jobs:
+                process_job(vk, SBER_TOKEN, job_id, job, r_conn, max_deliveries)
+                jobs_done += 1
+                if jobs_done % 100 == 0:
+                    logger.info(f'the grading worker {consumer_name} gigachat clients: {get_client_stats()}, '
+                                f'embedding batches: {get_embedding_batcher(SBER_TOKEN).get_stats()}, '
+                                f'fast grader: {get_fast_grader_stats(r_conn)}, '
+                                f'verdict cache: {get_verdict_cache_stats(r_conn)}, '
+                                f'grading stages: {get_stage_stats(r_conn)}')
+
+        except Exception as exception:
+            logger.error(f'the grading worker {consumer_name} crashed with an error.')
+            logger.exception(exception)
+
+
+def run_worker(consumer_name):
+    load_dotenv()
+    VK_GROUP_TOKEN = os.getenv('VK_GROUP_TOKEN')
+    SBER_TOKEN = os.getenv('SBER_TOKEN')
+    host = os.getenv('host')
+    port = os.getenv('port')
+    # через сколько мс задание упавшего воркера забирает другой воркер
+    GRADING_CLAIM_IDLE_MS = int(os.getenv('GRADING_CLAIM_IDLE_MS', 60000))
+    GRADING_MAX_DELIVERIES = int(os.getenv('GRADING_MAX_DELIVERIES', 3))
+    GRADING_WORKER_THREADS = int(os.getenv('GRADING_WORKER_THREADS', 8))
+    db = 0
+
+    r_conn = redis.Redis(
+        host=host,
+        port=port,
+        db=db,
+        charset='utf-8',
+        decode_responses=True
+    )
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO,
+        filename=f'grading_{consumer_name}.log',
+        filemode='a'
+    )
+
+    authorize = vk_api.VkApi(token=VK_GROUP_TOKEN)
+    vk = authorize.get_api()
+    create_grading_group(r_conn)
+    # ошибка в конфиге проверки должна остановить воркер сразу, а не на первом ответе
+    load_grading_config()
+    logger.info(f'the grading worker {consumer_name} started.')
+
+    # несколько потоков в процессе, чтобы их эмбеддинги собирались в общие батчи
+    threads = []
+    for num in range(GRADING_WORKER_THREADS):
+        thread = threading.Thread(
+            target=consume_jobs,
+            args=(f'{consumer_name}_{num}', vk, SBER_TOKEN, r_conn, GRADING_CLAIM_IDLE_MS, GRADING_MAX_DELIVERIES),
+            daemon=True
+        )
+        thread.start()
+        threads.append(thread)
+
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        logger.info(f'the grading worker {consumer_name} stopped.')
+
+
+def main():
+    load_dotenv()
+    # число процессов-воркеров на этой машине
+    GRADING_WORKERS = int(os.getenv('GRADING_WORKERS', multiprocessing.cpu_count()))
+    host_name = socket.gethostname()
+
+    processes = []
+    for num in range(GRADING_WORKERS):
+        consumer_name = f'{host_name}_{num}'
+        process = multiprocessing.Process(target=run_worker, args=(consumer_name,), daemon=True)
+        process.start()
+        processes.append(process)
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == '__main__':
+    main()
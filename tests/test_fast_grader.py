@@ -0,0 +1,23 @@
+from giga_chat.fast_grader import fast_grade
+
+
+def test_bare_number_is_not_accepted_when_correct_answer_has_words():
+    assert fast_grade('12', '12 апреля') is None
+
+
+def test_number_with_matching_words_is_accepted():
+    assert fast_grade('12 апреля', '12 апреля')[0] == 1.0
+    assert fast_grade('основана в 1995', 'Основана в 1995 году')[0] == 1.0
+
+
+def test_bare_number_is_accepted_when_correct_answer_is_a_number():
+    assert fast_grade('в 2000 году', '2000')[0] == 1.0
+
+
+def test_wrong_or_extra_numbers_are_not_accepted():
+    assert fast_grade('основана в 1996 году', 'Основана в 1995 году') is None
+    assert fast_grade('1999 2000', '2000') is None
+
+
+def test_extra_content_words_are_not_accepted():
+    assert fast_grade('Рузик Барсик', 'Рузик') is None
@@ -0,0 +1,55 @@
+import grading_worker
+
+
+class FakeMessages:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, **kwargs):
+        self.sent.append(kwargs)
+
+
+class FakeVk:
+    def __init__(self):
+        self.messages = FakeMessages()
+
+
+JOB = {'user_id': '42', 'question': 'Как зовут кота?', 'correct_answer': 'Рузик', 'answer': 'Барсик'}
+
+
+def fail_grading(*args, **kwargs):
+    raise RuntimeError('GigaChat is unavailable')
+
+
+def setup_worker(monkeypatch, delivery_count):
+    acked = []
+    monkeypatch.setattr(grading_worker, 'func_grade_answer', fail_grading)
+    monkeypatch.setattr(grading_worker, 'get_delivery_count', lambda job_id, r_conn: delivery_count)
+    monkeypatch.setattr(grading_worker, 'ack_grading_job', lambda job_id, r_conn: acked.append(job_id))
+    return acked
+
+
+def test_dropped_job_notifies_user_and_is_acked(monkeypatch):
+    acked = setup_worker(monkeypatch, delivery_count=5)
+    vk = FakeVk()
+    grading_worker.process_job(vk, 'token', '1-0', JOB, None, max_deliveries=5)
+    assert acked == ['1-0']
+    assert len(vk.messages.sent) == 1
+    assert vk.messages.sent[0]['user_id'] == '42'
+    assert 'ответьте еще раз' in vk.messages.sent[0]['message']
+
+
+def test_failed_job_with_attempts_left_is_retried_silently(monkeypatch):
+    acked = setup_worker(monkeypatch, delivery_count=2)
+    vk = FakeVk()
+    grading_worker.process_job(vk, 'token', '1-0', JOB, None, max_deliveries=5)
+    assert acked == []
+    assert vk.messages.sent == []
+
+
+def test_dropped_job_is_acked_when_notice_fails(monkeypatch):
+    acked = setup_worker(monkeypatch, delivery_count=5)
+    vk = FakeVk()
+    monkeypatch.setattr(vk.messages, 'send', fail_grading)
+    grading_worker.process_job(vk, 'token', '1-0', JOB, None, max_deliveries=5)
+    assert acked == ['1-0']
@@ -0,0 +1,112 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from vk_api.utils import get_random_id
+
+logger = logging.getLogger('admin jobs')
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class AdminJob:
+    def __init__(self, vk, admin_id, title, progress_interval=5):
+        self.job_id = uuid.uuid4().hex[:8]
+        self.vk = vk
+        self.admin_id = admin_id
+        self.title = title
+        self.progress_interval = progress_interval
+        self.status = 'queued'
+        self._cancelled = threading.Event()
+        self._last_report = 0
+
+    def send(self, message):
+        self.vk.messages.send(user_id=self.admin_id,
+                              message=f'[{self.job_id}] {message}',
+                              random_id=get_random_id())
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def check_cancelled(self):
+        if self._cancelled.is_set():
+            raise JobCancelled()
+
+    def report_progress(self, done, total=None):
+        # вызывается между пачками работы: здесь же проверяется отмена
+        self.check_cancelled()
+        now = time.monotonic()
+        if now - self._last_report < self.progress_interval:
+            return
+        self._last_report = now
+        if total:
+            self.send(f'{self.title}: {done} из {total} ({done * 100 // total}%)')
+        else:
+            self.send(f'{self.title}: обработано {done}')
+
+
+class AdminJobRunner:
+    """Выполняет тяжелые действия администратора в фоне.
+
+    Каждая задача получает id, о начале, ходе и завершении задачи
+    администратору приходят сообщения; задачи можно отменить командой "Отмена".
+    """
+
+    def __init__(self, max_workers=2, progress_interval=5):
+        self.progress_interval = progress_interval
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='admin_job')
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, vk, admin_id, title, func, *args, **kwargs):
+        job = AdminJob(vk, admin_id, title, self.progress_interval)
+        with self._lock:
+            self._jobs[job.job_id] = job
+        job.send(f'Задача "{title}" запущена. Чтобы отменить ее, напишите "Отмена".')
+        self._executor.submit(self._run, job, func, args, kwargs)
+        return job.job_id
+
+    def _run(self, job, func, args, kwargs):
+        job.status = 'running'
+        try:
+            job.check_cancelled()
+            func(job, *args, **kwargs)
+            job.status = 'done'
+            job.send(f'Задача "{job.title}" завершена.')
+        except JobCancelled:
+            job.status = 'cancelled'
+            job.send(f'Задача "{job.title}" отменена.')
+        except Exception as exception:
+            job.status = 'failed'
+            logger.error(f'the admin job {job.job_id} ({job.title}) failed.')
+            logger.exception(exception)
+            job.send(f'Задача "{job.title}" завершилась с ошибкой.')
+        finally:
+            with self._lock:
+                self._jobs.pop(job.job_id, None)
+
+    def cancel_admin_jobs(self, admin_id):
+        with self._lock:
+            jobs = [job for job in self._jobs.values() if job.admin_id == admin_id]
+        for job in jobs:
+            job.cancel()
+        return len(jobs)
+
+
+def get_admin_job_runner():
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = AdminJobRunner(
+                max_workers=int(os.getenv('ADMIN_JOB_WORKERS', 2)),
+                progress_interval=int(os.getenv('ADMIN_JOB_PROGRESS_INTERVAL', 5))
+            )
+        return _runner
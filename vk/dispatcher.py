@@ -0,0 +1,85 @@
+import asyncio
+import collections
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from vk_api.bot_longpoll import VkBotEventType
+
+logger = logging.getLogger('vk bot')
+
+
+class UserEventDispatcher:
+    """Обрабатывает события разных пользователей параллельно,
+    а события одного пользователя - строго по очереди."""
+
+    def __init__(self, max_concurrency=16):
+        self.max_concurrency = max_concurrency
+        # обработчики синхронные (redis, vk_api), поэтому выполняются в потоках
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency,
+                                            thread_name_prefix='vk_handler')
+        # отдельный поток для блокирующего longpoll.listen()
+        self._intake_executor = ThreadPoolExecutor(max_workers=1,
+                                                   thread_name_prefix='vk_longpoll')
+        # очереди событий пользователей живут дольше одного run(): события, принятые
+        # до переподключения longpoll, не теряются и обрабатываются в прежнем порядке
+        self._queues = {}
+        self._tasks = set()
+        self._semaphore = None
+        self._handler = None
+
+    def dispatch(self, user_id, event):
+        queue = self._queues.get(user_id)
+        if queue is None:
+            queue = collections.deque()
+            self._queues[user_id] = queue
+            self._start_worker(user_id, queue)
+        queue.append(event)
+
+    def _start_worker(self, user_id, queue):
+        task = asyncio.create_task(self._user_worker(user_id, queue))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _user_worker(self, user_id, queue):
+        loop = asyncio.get_running_loop()
+        try:
+            while queue:
+                event = queue.popleft()
+                async with self._semaphore:
+                    try:
+                        await loop.run_in_executor(self._executor, self._handler, event)
+                    except Exception as exception:
+                        logger.error(f'the handler of the user_{user_id} crashed with an error.')
+                        logger.exception(exception)
+        finally:
+            # очередь пуста - освобождаем пользователя, следующее событие создаст новую задачу;
+            # непустая очередь остается до следующего run()
+            if not queue:
+                self._queues.pop(user_id, None)
+
+    async def run(self, longpoll, handler):
+        loop = asyncio.get_running_loop()
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._handler = handler
+        # события, оставшиеся с прошлого запуска, обрабатываются первыми
+        for user_id, queue in list(self._queues.items()):
+            self._start_worker(user_id, queue)
+        events = longpoll.listen()
+        next_event = functools.partial(next, events, None)
+
+        try:
+            while True:
+                event = await loop.run_in_executor(self._intake_executor, next_event)
+                if event is None:
+                    break
+                # новые текстовые сообщения, адресованные ему
+                if event.type == VkBotEventType.MESSAGE_NEW:
+                    user_id = event.obj['message']['from_id']
+                    self.dispatch(user_id, event)
+        finally:
+            # прием остановлен, в том числе ошибкой longpoll: дожидаемся уже принятых событий,
+            # иначе asyncio.run отменит задачи пользователей, а их обработчики продолжат
+            # работать в потоках параллельно с задачами следующего запуска
+            if self._tasks:
+                await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -0,0 +1,57 @@
+import functools
+
+from vk_api.keyboard import VkKeyboard, VkKeyboardColor
+
+
+# клавиатуры не меняются, поэтому json каждой собирается один раз
+@functools.lru_cache(maxsize=None)
+def create_keyboard():
+    # одноразовая клавиатура
+    keyboard = VkKeyboard(one_time=True)
+    keyboard.add_button("Вопрос", color=VkKeyboardColor.PRIMARY)
+    keyboard.add_button("Стоп", color=VkKeyboardColor.NEGATIVE)
+
+    keyboard.add_line()
+    keyboard.add_button("На счете", color=VkKeyboardColor.POSITIVE)
+    keyboard.add_button("Мое место", color=VkKeyboardColor.SECONDARY)
+
+    return keyboard.get_keyboard()
+
+@functools.lru_cache(maxsize=None)
+def create_admin_keyboard():
+    # одноразовая клавиатура
+    keyboard = VkKeyboard(one_time=True)
+    keyboard.add_button("Данные игроков", color=VkKeyboardColor.PRIMARY)
+    keyboard.add_button("Вопросы и ответы", color=VkKeyboardColor.NEGATIVE)
+    keyboard.add_line()
+    keyboard.add_button("Генерация вопросов", color=VkKeyboardColor.POSITIVE)
+    keyboard.add_line()
+    keyboard.add_button("Изменить логин и пароль", color=VkKeyboardColor.SECONDARY)
+
+    return keyboard.get_keyboard()
+
+@functools.lru_cache(maxsize=None)
+def create_qa_admin_keyboard():
+    keyboard = VkKeyboard(one_time=True)
+    keyboard.add_button("Добавлять вопросы и ответы", color=VkKeyboardColor.PRIMARY)
+    keyboard.add_line()
+    keyboard.add_button("Редактировать вопросы и ответы", color=VkKeyboardColor.NEGATIVE)
+    keyboard.add_line()
+    keyboard.add_button("Удалять вопросы и ответы", color=VkKeyboardColor.POSITIVE)
+    keyboard.add_line()
+    keyboard.add_button("Назад", color=VkKeyboardColor.SECONDARY)
+    return keyboard.get_keyboard()
+
+@functools.lru_cache(maxsize=None)
+def create_num_qa_keyboard():
+    keyboard = VkKeyboard(one_time=True)
+    keyboard.add_button("Ещё 10", color=VkKeyboardColor.PRIMARY)
+    keyboard.add_button("Назад", color=VkKeyboardColor.SECONDARY)
+    return keyboard.get_keyboard()
+
+@functools.lru_cache(maxsize=None)
+def create_request_admin_keyboard():
+    keyboard = VkKeyboard(one_time=True)
+    keyboard.add_button("Да", color=VkKeyboardColor.POSITIVE)
+    keyboard.add_button("Нет", color=VkKeyboardColor.NEGATIVE)
+    return keyboard.get_keyboard()
@@ -0,0 +1,178 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import requests
+
+logger = logging.getLogger('vk profiles')
+
+VK_API_URL = 'https://api.vk.com/method/'
+VK_API_VERSION = 5.131
+PROFILE_FIELDS = 'sex, bdate, city, country'
+# users.get и groups.getMembers отдают не больше 1000 профилей за вызов
+MAX_PROFILES_PER_CALL = 1000
+
+_services = {}
+_services_lock = threading.Lock()
+
+
+class VkProfileError(Exception):
+    pass
+
+
+def parse_user_info(user_info):
+    first_name = user_info['first_name']
+    last_name = user_info['last_name']
+    sex = user_info.get('sex')
+    if sex == 1:
+        sex = 'жен'
+    elif sex == 2:
+        sex = 'муж'
+    else:
+        sex = 'None'
+    city = user_info.get('city', {}).get('title')
+    country = user_info.get('country', {}).get('title')
+    b_date = user_info.get('bdate', {})
+
+    return first_name, last_name, b_date, sex, city, country
+
+
+class ProfileService:
+    """Получает профили пользователей VK пачками и кэширует их.
+
+    Запросы, пришедшие за время window_ms, объединяются в один вызов users.get
+    (до 1000 id); профили хранятся в LRU внутри процесса (не больше max_size)
+    и, если передан r_conn, в redis с TTL.
+    """
+
+    def __init__(self, vk_token, r_conn=None, ttl=86400, window_ms=50, fields=PROFILE_FIELDS, max_size=10000):
+        self.vk_token = vk_token
+        self.r_conn = r_conn
+        self.ttl = ttl
+        self.max_size = max_size
+        self.window = window_ms / 1000
+        self.fields = fields
+        self._session = requests.Session()
+        self._local = OrderedDict()
+        self._local_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='vk_profiles', daemon=True)
+        self._thread.start()
+
+    def _call(self, method, **params):
+        params.update({'access_token': self.vk_token, 'v': VK_API_VERSION})
+        # post, потому что список из 1000 id не помещается в url
+        res = self._session.post(VK_API_URL + method, data=params).json()
+        if 'error' in res:
+            raise VkProfileError(f"{method}: [{res['error'].get('error_code')}] {res['error'].get('error_msg')}")
+        return res['response']
+
+    def _get_cached(self, user_id):
+        with self._local_lock:
+            cached = self._local.get(user_id)
+            if cached is not None:
+                if cached[0] > time.time():
+                    self._local.move_to_end(user_id)
+                    return cached[1]
+                del self._local[user_id]
+        if self.r_conn is not None:
+            value = self.r_conn.get(f'vk_profile_id_{user_id}')
+            if value is not None:
+                profile = tuple(json.loads(value))
+                self._set_local(user_id, profile)
+                return profile
+        return None
+
+    def _set_local(self, user_id, profile):
+        with self._local_lock:
+            self._local[user_id] = (time.time() + self.ttl, profile)
+            self._local.move_to_end(user_id)
+            while len(self._local) > self.max_size:
+                self._local.popitem(last=False)
+
+    def _store(self, profiles):
+        for user_id, profile in profiles.items():
+            self._set_local(user_id, profile)
+        if self.r_conn is not None and profiles:
+            pipe = self.r_conn.pipeline(transaction=False)
+            for user_id, profile in profiles.items():
+                pipe.set(f'vk_profile_id_{user_id}', json.dumps(profile, ensure_ascii=False), ex=self.ttl)
+            pipe.execute()
+
+    def get_user_info(self, user_id):
+        user_id = str(user_id)
+        profile = self._get_cached(user_id)
+        if profile is not None:
+            return profile
+        future = Future()
+        self._queue.put((user_id, future))
+        return future.result()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        user_ids = {batch[0][0]}
+        deadline = time.monotonic() + self.window
+        while len(user_ids) < MAX_PROFILES_PER_CALL:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                user_id, future = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append((user_id, future))
+            user_ids.add(user_id)
+        return batch, user_ids
+
+    def _run(self):
+        while True:
+            batch, user_ids = self._collect()
+            try:
+                users = self._call('users.get', user_ids=','.join(user_ids), fields=self.fields)
+                profiles = {str(user_info['id']): parse_user_info(user_info) for user_info in users}
+                self._store(profiles)
+            except Exception as exception:
+                logger.exception(exception)
+                for _, future in batch:
+                    future.set_exception(exception)
+                continue
+
+            for user_id, future in batch:
+                if user_id in profiles:
+                    future.set_result(profiles[user_id])
+                else:
+                    future.set_exception(VkProfileError(f'the user {user_id} was not found.'))
+
+    def prefetch_group_members(self, group_id):
+        # профили участников сообщества загружаются заранее, по 1000 за вызов
+        offset = 0
+        while True:
+            res = self._call('groups.getMembers', group_id=group_id, offset=offset,
+                             count=MAX_PROFILES_PER_CALL, fields=self.fields)
+            members = res.get('items', [])
+            self._store({str(user_info['id']): parse_user_info(user_info) for user_info in members})
+            offset += len(members)
+            if not members or offset >= res.get('count', 0):
+                break
+        logger.info(f'prefetched {offset} profiles of the group {group_id}.')
+        return offset
+
+
+def get_profile_service(vk_token, r_conn=None):
+    with _services_lock:
+        service = _services.get(vk_token)
+        if service is None:
+            service = ProfileService(
+                vk_token,
+                r_conn=r_conn,
+                ttl=int(os.getenv('PROFILE_CACHE_TTL', 86400)),
+                window_ms=int(os.getenv('PROFILE_BATCH_WINDOW_MS', 50)),
+                max_size=int(os.getenv('PROFILE_CACHE_SIZE', 10000))
+            )
+            _services[vk_token] = service
+        return service
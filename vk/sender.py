@@ -0,0 +1,188 @@
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from vk_api.exceptions import ApiError
+
+logger = logging.getLogger('vk sender')
+
+# коды ошибок VK API, после которых запрос стоит повторить позже
+TOO_MANY_REQUESTS_CODE = 6
+FLOOD_CONTROL_CODE = 9
+RETRY_CODES = (TOO_MANY_REQUESTS_CODE, FLOOD_CONTROL_CODE)
+
+# execute принимает не больше 25 вызовов API и ограничен по длине кода
+EXECUTE_MAX_CALLS = 25
+EXECUTE_MAX_CODE_LENGTH = 60000
+
+
+class VkSendError(Exception):
+    def __init__(self, code, message):
+        super().__init__(f'[{code}] {message}')
+        self.code = code
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class VkMessageSender:
+    """Очередь исходящих вызовов VK API.
+
+    Вызовы возвращают Future сразу, а фоновый поток отправляет их пачками
+    через execute (до 25 вызовов за запрос) не чаще rate запросов в секунду
+    и повторяет вызовы, упавшие из-за ограничений частоты.
+    """
+
+    def __init__(self, vk_session, rate=20, max_retries=5, retry_delay=1.0):
+        self.vk_session = vk_session
+        # vk_api.VkApi сам выдерживает RPS_DELAY (0.34 с) между запросами сессии, то есть
+        # не больше ~3 запросов в секунду; частоту здесь задает TokenBucket, поэтому паузу
+        # сессии приводим к той же частоте
+        self.vk_session.RPS_DELAY = 1 / rate
+        self.bucket = TokenBucket(rate)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._queue = queue.Queue()
+        self._carry = None
+        self._stats_lock = threading.Lock()
+        self._stats = {'calls': 0, 'requests': 0, 'retries': 0, 'failed': 0}
+        self._thread = threading.Thread(target=self._run, name='vk_sender', daemon=True)
+        self._thread.start()
+
+    def call(self, method, **params):
+        future = Future()
+        self._queue.put((method, params, future, 0))
+        return future
+
+    def _count(self, name, value=1):
+        with self._stats_lock:
+            self._stats[name] += value
+
+    def _collect(self):
+        batch = [self._carry or self._queue.get()]
+        self._carry = None
+        code_length = len(self._get_code(batch))
+        while len(batch) < EXECUTE_MAX_CALLS:
+            try:
+                call = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            call_length = len(self._get_code([call]))
+            if code_length + call_length > EXECUTE_MAX_CODE_LENGTH:
+                # длинное сообщение уйдет следующей пачкой
+                self._carry = call
+                break
+            batch.append(call)
+            code_length += call_length
+        return batch
+
+    def _get_code(self, batch):
+        calls = ','.join(
+            f'API.{method}({json.dumps(params, ensure_ascii=False)})'
+            for method, params, _, _ in batch
+        )
+        return f'return [{calls}];'
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            self.bucket.acquire()
+            self._count('calls', len(batch))
+            self._count('requests')
+            try:
+                self._execute(batch)
+            except ApiError as exception:
+                for call in batch:
+                    self._retry_or_fail(call, exception)
+            except Exception as exception:
+                logger.exception(exception)
+                for call in batch:
+                    self._fail(call, exception)
+
+    def _execute(self, batch):
+        if len(batch) == 1:
+            method, params, future, _ = batch[0]
+            future.set_result(self.vk_session.method(method, params))
+            return
+
+        response = self.vk_session.method('execute', {'code': self._get_code(batch)}, raw=True)
+        results = response.get('response') or [False] * len(batch)
+        # ошибки отдельных вызовов идут в execute_errors в порядке упавших вызовов
+        errors = iter(response.get('execute_errors', []))
+        for call, result in zip(batch, results):
+            if result is False:
+                error = next(errors, {})
+                self._retry_or_fail(call, VkSendError(error.get('error_code'), error.get('error_msg')))
+            else:
+                call[2].set_result(result)
+
+    def _retry_or_fail(self, call, error):
+        method, params, future, attempt = call
+        if getattr(error, 'code', None) in RETRY_CODES and attempt < self.max_retries:
+            # random_id не меняется, поэтому повтор не задублирует сообщение
+            delay = self.retry_delay * 2 ** attempt
+            logger.warning(f'the VK call {method} hit the rate limit, retrying in {delay} s.')
+            self._count('retries')
+            timer = threading.Timer(delay, self._queue.put, args=((method, params, future, attempt + 1),))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._fail(call, error)
+
+    def _fail(self, call, error):
+        method, _, future, _ = call
+        logger.error(f'the VK call {method} failed: {error}')
+        self._count('failed')
+        future.set_exception(error)
+
+    def get_stats(self):
+        with self._stats_lock:
+            return dict(self._stats)
+
+
+class QueuedMessagesApi:
+    def __init__(self, messages_api, sender):
+        self._messages_api = messages_api
+        self._sender = sender
+
+    def send(self, **params):
+        return self._sender.call('messages.send', **params)
+
+    def edit(self, **params):
+        return self._sender.call('messages.edit', **params)
+
+    def __getattr__(self, name):
+        return getattr(self._messages_api, name)
+
+
+class QueuedVkApi:
+    """Обертка над vk_api: messages.send и messages.edit уходят в очередь отправки,
+    остальные методы вызываются как обычно."""
+
+    def __init__(self, vk, sender):
+        self._vk = vk
+        self.messages = QueuedMessagesApi(vk.messages, sender)
+
+    def __getattr__(self, name):
+        return getattr(self._vk, name)
@@ -5,55 +5,50 @@ import requests
 from dotenv import load_dotenv
 import vk_api
 
-def get_user_info(user_id, vk_token, fields="sex, bdate, city, country"):
-    res = requests.get(
-        'https://api.vk.com/method/users.get',
-        params={
-            'user_ids': user_id,
-            'fields': fields,
-            'access_token': vk_token,
-            'v': 5.131,
-        },
-    ).json()
+from database.client_redis_tools import get_leaderboard_top
+from vk.profile_service import get_profile_service
+
 
-    user_info = res['response'][0]
+class VkWallPostError(Exception):
+    pass
 
-    first_name = user_info['first_name']
-    last_name = user_info['last_name']
-    sex = user_info['sex']
-    if sex == 1:
-        sex = 'жен'
-    elif sex == 2:
-        sex = 'муж'
-    else:
-        sex = 'None'
-    city = user_info.get('city', {}).get('title')
-    country = user_info.get('country', {}).get('title')
-    b_date = user_info.get('bdate', {})
+def get_user_info(user_id, vk_token, r_conn=None):
+    # запросы одновременно пришедших игроков объединяются в один users.get, профили кэшируются
+    return get_profile_service(vk_token, r_conn=r_conn).get_user_info(user_id)
 
-    return first_name, last_name, b_date, sex, city, country
+def upload_leaderboard(vk_token, group_id, r_conn, top_n=10):
+    # берем только первые top_n мест из сортированного множества
+    top = get_leaderboard_top(r_conn, top_n)
+    if not top:
+        return None
+    users_info = r_conn.hmget('users_info', [field for field, _ in top])
 
-def upload_leaderboard(vk_token, group_id, r_conn):
+    lines = []
+    for place, ((field, score), user_info) in enumerate(zip(top, users_info), start=1):
+        if user_info is not None:
+            user_info = json.loads(user_info)
+            name = f"{user_info.get('first_name')} {user_info.get('last_name')}"
+        else:
+            name = field
+        lines.append(f'{place}. {name} - {score}')
+    message = 'Лидерборд:\n' + '\n'.join(lines)
 
-    leaderboard_dict = r_conn.hgetall('accounts')
-    sorted_leaderboard_dict = sorted(leaderboard_dict.items(), key=lambda x:x[1])
-    leaderboard_file = json.dumps(leaderboard_dict)
     owner_id = f'-{group_id}'
     from_group = 1
-    res = requests.get(
+    res = requests.post(
         'https://api.vk.com/method/wall.post',
-        params={
+        data={
             'owner_id': owner_id,
             'from_group': from_group,
-            'message': 'Лидерборд',
+            'message': message,
             'access_token': vk_token,
             'v': 5.131,
         },
     ).json()
-    # authorize.method('wall.post', {
-    #     'owner_id': -int(group_id),
-    #     'message': 'Лидерборд:'
-    # })
+    # VK отвечает 200 и на ошибку (неверный токен, нет прав на стену) - ошибка только в теле ответа
+    if 'error' in res:
+        raise VkWallPostError(f"wall.post: [{res['error'].get('error_code')}] {res['error'].get('error_msg')}")
+    return res
 
 
 def main():
@@ -1,10 +1,14 @@
+import asyncio
 import datetime
+import functools
 import json
 import logging
 import os
-import random
+import re
 import redis
 import requests
+import threading
+import time
 import urllib.request
 from dotenv import load_dotenv
 
@@ -12,82 +16,76 @@ import pandas as pd
 import openpyxl
 import vk_api
 from vk_api.bot_longpoll import VkBotLongPoll, VkBotEventType
-from vk_api.keyboard import VkKeyboard, VkKeyboardColor
 from vk_api.utils import get_random_id
 
 from database.admin_redis_tools import (
-    clear_answers,
+    add_qa_to_bank,
+    clear_qa_bank,
     clear_qa_from_dir,
-    clear_questions,
-    delete_select_correct_answer,
-    delete_select_question,
+    migrate_legacy_user_qa,
     upload_all_files_of_qa,
-    upload_one_file_of_qa
+    upload_one_file_of_qa,
+    watch_qa_directory
 )
 
+from database.chat_history import append_chat_history, load_chat_history
+
 from database.client_redis_tools import (
-    get_last_correct_answer,
-    get_last_question,
+    draw_question,
+    get_account,
+    get_last_qa,
+    get_leaderboard_rank,
     get_user_qa,
-    get_users_info,
-    scale_text,
-    upload_account,
-    upload_last_correct_answer,
-    upload_last_question
+    migrate_accounts
+)
+
+from database.grading_queue import enqueue_grading_job
+from database.qa_dedup import format_duplicate_clusters
+from database.users_info_io import export_users_info, import_users_info
+
+from database.state_tools import (
+    ADMIN_STATES,
+    STATE_ADMIN,
+    STATE_ADMIN_CHANGE_LOGIN,
+    STATE_ADMIN_CHANGE_PASSWORD,
+    STATE_ADMIN_GENERATE,
+    STATE_ADMIN_LOGIN,
+    STATE_ADMIN_NUM_QA,
+    STATE_ADMIN_PASSWORD,
+    STATE_ADMIN_QA,
+    STATE_ADMIN_QA_DELETE,
+    STATE_ADMIN_QA_EDIT,
+    STATE_ADMIN_QA_UPLOAD,
+    STATE_ADMIN_USERS_INFO,
+    STATE_CHAT,
+    STATE_QUIZ,
+    load_user_state,
+    save_user_state
 )
 
 from giga_chat.giga_model import (
     connect_ruzik_chat,
-    custom_evaluate_qa,
-    custom_generate_qa,
-    get_cosine_similarity,
-    get_token
+    stream_ruzik_chat
 )
+from giga_chat.generation_cache import get_generation_cache
+from giga_chat.qa_generation import format_qa_pairs, generate_qa
+from giga_chat.token_cache import get_cached_token
 from langchain_community.document_loaders import TextLoader
-from vk.vk_tools import get_user_info
+from vk.admin_jobs import get_admin_job_runner
+from vk.dispatcher import UserEventDispatcher
+from vk.keyboards import (
+    create_admin_keyboard,
+    create_keyboard,
+    create_num_qa_keyboard,
+    create_qa_admin_keyboard,
+    create_request_admin_keyboard
+)
+from vk.profile_service import get_profile_service
+from vk.sender import QueuedVkApi, VkMessageSender
+from vk.vk_tools import get_user_info, upload_leaderboard
 
 logger = logging.getLogger('vk bot')
 
-def create_keyboard():
-    # одноразовая клавиатура
-    keyboard = VkKeyboard(one_time=True)
-    keyboard.add_button("Вопрос", color=VkKeyboardColor.PRIMARY)
-    keyboard.add_button("Стоп", color=VkKeyboardColor.NEGATIVE)
-
-    keyboard.add_line()
-    keyboard.add_button("На счете", color=VkKeyboardColor.POSITIVE)
-
-    return keyboard.get_keyboard()
-
-def create_admin_keyboard():
-    # одноразовая клавиатура
-    keyboard = VkKeyboard(one_time=True)
-    keyboard.add_button("Данные игроков", color=VkKeyboardColor.PRIMARY)
-    keyboard.add_button("Вопросы и ответы", color=VkKeyboardColor.NEGATIVE)
-    keyboard.add_line()
-    keyboard.add_button("Генерация вопросов", color=VkKeyboardColor.POSITIVE)
-    keyboard.add_line()
-    keyboard.add_button("Изменить логин и пароль", color=VkKeyboardColor.SECONDARY)
-
-    return keyboard.get_keyboard()
-
-def create_qa_admin_keyboard():
-    keyboard = VkKeyboard(one_time=True)
-    keyboard.add_button("Добавлять вопросы и ответы", color=VkKeyboardColor.PRIMARY)
-    keyboard.add_line()
-    keyboard.add_button("Редактировать вопросы и ответы", color=VkKeyboardColor.NEGATIVE)
-    keyboard.add_line()
-    keyboard.add_button("Удалять вопросы и ответы", color=VkKeyboardColor.POSITIVE)
-    keyboard.add_line()
-    keyboard.add_button("Назад", color=VkKeyboardColor.SECONDARY)
-    return keyboard.get_keyboard()
-
-def create_request_admin_keyboard():
-    keyboard = VkKeyboard(one_time=True)
-    keyboard.add_button("Да", color=VkKeyboardColor.POSITIVE)
-    keyboard.add_button("Нет", color=VkKeyboardColor.NEGATIVE)
-    return keyboard.get_keyboard()
-
 def handle_user_start(vk, user_id):
     message = "Начинаем викторину!"
     vk.messages.send(user_id=user_id,
@@ -96,12 +94,9 @@ def handle_user_start(vk, user_id):
                      keyboard=create_keyboard())
 def user_func_start(VK_USER_TOKEN, user_id, r_conn):
     logger.info(f'the user_{user_id} started quiz.')
-    # только первый раз составляет список вопросов для каждого пользователя
-    if not r_conn.hgetall(f'questions_id_{user_id}'):
-        upload_all_files_of_qa(r_conn, directory_name='questions_data', user_id=user_id)
-
-    if not r_conn.hgetall('users_info') or r_conn.hget('users_info', f'id_{user_id}') is None:
-        first_name, last_name, b_date, sex, city, country = get_user_info(user_id, VK_USER_TOKEN)
+    # вопросы берутся из общего банка, новому пользователю ничего копировать не нужно
+    if not r_conn.hexists('users_info', f'id_{user_id}'):
+        first_name, last_name, b_date, sex, city, country = get_user_info(user_id, VK_USER_TOKEN, r_conn=r_conn)
         info_dict = {'first_name': first_name,
                      'last_name': last_name,
                      'b_date': b_date,
@@ -121,45 +116,19 @@ def handle_user_stop(vk, user_id):
                      message=message,
                      random_id=get_random_id())
 
-def choice_question(user_id, r_conn):
-    nums_question = r_conn.hkeys(f'questions_id_{user_id}')
-
-    if not nums_question:
-        return None
-
-    num_question = random.choice(nums_question)
-    return num_question
-
 def func_question(user_id, r_conn):
+    # выбор вопроса, его выдача и сохранение последнего вопроса - одно обращение к redis
+    qa = draw_question(user_id, r_conn)
 
-    num_qa = choice_question(user_id, r_conn)
-
-    if num_qa is not None:
-        # сохраняем последний вопрос пользователя
-        r_conn.hset(
-            'num_of_last_question',
-            f'id_{user_id}',
-            num_qa
-        )
-
-        question = r_conn.hget(f'questions_id_{user_id}', num_qa)
-        # answer_num = question_num.replace('question', 'answer')
-        answer = r_conn.hget(f'correct_answers_id_{user_id}', num_qa)
+    if qa is not None:
+        num_qa, question, answer = qa
 
         logger.info(f"the user_{user_id}'s question: {question}")
         logger.info(f"the user_{user_id}'s correct answer: {answer}")
+        return question
+    return None
 
-        upload_last_question(user_id, question, r_conn)
-        upload_last_correct_answer(user_id, answer, r_conn)
-
-        # удаляем выданный вопрос
-        delete_select_question(user_id, num_qa, r_conn)
-        delete_select_correct_answer(user_id, num_qa, r_conn)
-        return 1
-    return 0
-
-def handle_successfully_uploaded_question(vk, user_id, r_conn):
-    question = get_last_question(user_id, r_conn)
+def handle_successfully_uploaded_question(vk, user_id, question):
     vk.messages.send(user_id=user_id,
                      message=question,
                      random_id=get_random_id(),
@@ -171,78 +140,32 @@ def handle_incorrect_upload_question(vk, user_id):
                      message=message,
                      random_id=get_random_id())
 
-def func_user_answer(vk, SBER_TOKEN, received_message, user_id, r_conn):
-    current_time = datetime.datetime.now()
-    response_time = current_time.strftime("%Y-%m-%d %H:%M:%S.%f")
+def handle_accepted_answer(vk, user_id):
+    message = "Ответ принят, проверяем..."
+    vk.messages.send(user_id=user_id,
+                     message=message,
+                     random_id=get_random_id())
 
-    # print("Дата и время ответа:", response_time)
+def handle_no_question(vk, user_id):
+    message = "Сначала получите вопрос."
+    vk.messages.send(user_id=user_id,
+                     message=message,
+                     random_id=get_random_id(),
+                     keyboard=create_keyboard())
 
-    question = get_last_question(user_id, r_conn)
-    correct_answer = get_last_correct_answer(user_id, r_conn)
-    correct_answer = scale_text(correct_answer).lower().strip('.')
+def func_user_answer(vk, received_message, user_id, r_conn):
+    current_time = datetime.datetime.now()
+    response_time = current_time.strftime("%Y-%m-%d %H:%M:%S.%f")
 
-    # print('Вопрос:', question)
-    # print('Правильный ответ:', correct_answer)
-    # print('Пользовательский ответ:', received_message)
+    num_qa, question, correct_answer = get_last_qa(user_id, r_conn)
+    if question is None or correct_answer is None:
+        handle_no_question(vk, user_id)
+        return
 
     logger.info(f"the user_{user_id}'s answer: {received_message}")
-    cos_sim = get_cosine_similarity(received_message, correct_answer, SBER_TOKEN)
-    # print(cos_sim)
-    # similarity_score = get_similarity_score(received_message, correct_answer, question, llm)
-    similarity_score, reasoning = custom_evaluate_qa(received_message, correct_answer, question, SBER_TOKEN)
-
-    # print(cos_sim, similarity_score, reasoning)
-    if cos_sim >= 0.98 or similarity_score > 0.8:
-        bonus = 100
-        upload_account(bonus, user_id, r_conn)
-        message = f"Ответили верно! Получате {bonus} балл(а/ов).\n Причина: {reasoning}"
-        vk.messages.send(user_id=user_id,
-                         message=message,
-                         random_id=get_random_id(),
-                         keyboard=create_keyboard())
 
-    elif cos_sim >= 0.97 or similarity_score >= 0.7:
-        bonus = 70
-        upload_account(bonus, user_id, r_conn)
-        message = f"Ответили, почти верно! Получате {bonus} балл(а/ов).\n Причина: {reasoning}"
-        vk.messages.send(user_id=user_id,
-                         message=message,
-                         random_id=get_random_id(),
-                         keyboard=create_keyboard())
-
-    elif similarity_score >= 0.5:
-        bonus = 50
-        upload_account(bonus, user_id, r_conn)
-        message = f"Ответили, частично верно! Получате {bonus} балл(а/ов).\n Причина: {reasoning}"
-        vk.messages.send(user_id=user_id,
-                         message=message,
-                         random_id=get_random_id(),
-                         keyboard=create_keyboard())
-
-    elif similarity_score >= 0.3:
-        bonus = 30
-        upload_account(bonus, user_id, r_conn)
-        message = f"Ответили, почти неверно! Получате {bonus} балл(а/ов).\n Причина: {reasoning}"
-        vk.messages.send(user_id=user_id,
-                         message=message,
-                         random_id=get_random_id(),
-                         keyboard=create_keyboard())
-
-    elif similarity_score >= 0.1:
-        bonus = 10
-        upload_account(bonus, user_id, r_conn)
-        message = f"Ммм... Получате {bonus} балл(а/ов).\n Причина: {reasoning}"
-        vk.messages.send(user_id=user_id,
-                         message=message,
-                         random_id=get_random_id(),
-                         keyboard=create_keyboard())
-
-    else:
-        message = f"Нет, неверно! \n Причина: {reasoning}"
-        vk.messages.send(user_id=user_id,
-                         message=message,
-                         random_id=get_random_id(),
-                         keyboard=create_keyboard())
+    # проверку выполняют воркеры grading_worker.py, бот только ставит задание в очередь
+    enqueue_grading_job(user_id, num_qa, question, correct_answer, received_message, response_time, r_conn)
 
     # сохранение ответов пользователя
     qa_info = json.dumps({
@@ -256,15 +179,11 @@ def func_user_answer(vk, SBER_TOKEN, received_message, user_id, r_conn):
         qa_info
     )
 
-    # correct_answer_num = r_conn.hget('num_of_last_question', f'id_{user_id}')
-    # db.delete_select_correct_answer(user_id, correct_answer_num, r_conn)
+    handle_accepted_answer(vk, user_id)
 
 def func_show_user_account(vk, user_id, r_conn):
-    users_info_dict = json.loads(
-        r_conn.hget('users_info', f'id_{user_id}')
-    )
-
-    total_account = int(users_info_dict['account'])
+    # счет читается одним полем хэша accounts, без разбора json профиля
+    total_account = get_account(user_id, r_conn)
 
     if total_account is not None:
         message = f"На счете у вас {total_account} балл(а/ов)."
@@ -279,34 +198,80 @@ def func_show_user_account(vk, user_id, r_conn):
                          random_id=get_random_id(),
                          keyboard=create_keyboard())
 
-def switch_ruzik_chat(user_id, r_conn):
-    if r_conn.hget('ruzik_chat_keys', f'id_{user_id}') == 'on':
-        return True
-    return False
+def func_show_user_rank(vk, user_id, r_conn):
+    rank = get_leaderboard_rank(user_id, r_conn)
 
-def switch_admin(user_id, r_conn):
-    if r_conn.hget(f'admin_id_{user_id}', 'admin_key') == 'on':
-        return True
-    return False
+    if rank is not None:
+        place, total_account, total_players = rank
+        message = f"Вы на {place} месте из {total_players}, на счете {total_account} балл(а/ов)."
+    else:
+        message = "Вы еще не в лидерборде. Ответьте верно на вопрос, чтобы получить баллы."
+    vk.messages.send(user_id=user_id,
+                     message=message,
+                     random_id=get_random_id(),
+                     keyboard=create_keyboard())
 
 def handle_ruzik_chat(vk, SBER_TOKEN, received_message, user_id, r_conn):
-    messages = []
-    if r_conn.hgetall('ruzik_chat_messages') and r_conn.hget('ruzik_chat_messages', f'id_{user_id}') is not None:
-        messages = json.loads(r_conn.hget('ruzik_chat_messages', f'id_{user_id}')).get('messages')
-        # messages = r_conn.hget('ruzik_chat_messages', f'id_{user_id}')
-
-    chat_token = get_token(SBER_TOKEN)
-
-    response, messages = connect_ruzik_chat(chat_token, received_message, messages)
-    # r_conn.hset('ruzik_chat_messages', f'id_{user_id}', messages)
-    json_messages = json.dumps({'messages': messages})
+    # в запрос уходят только последние реплики в пределах бюджета токенов
+    token_budget = int(os.getenv('RUZIK_CHAT_TOKEN_BUDGET', 1500))
+    history_len = int(os.getenv('RUZIK_CHAT_HISTORY_LEN', 50))
+    messages = load_chat_history(user_id, r_conn, token_budget=token_budget, max_len=history_len)
+
+    # токен живет ~30 минут, поэтому берется из кэша, а не запрашивается на каждое сообщение
+    chat_token = get_cached_token(SBER_TOKEN, r_conn)
+
+    stream = os.getenv('RUZIK_CHAT_STREAM', '1') == '1'
+    if stream:
+        # первая часть ответа уходит сразу, дальше сообщение дописывается правками
+        send_streamed_reply(vk, user_id, stream_ruzik_chat(chat_token, received_message, messages))
+    else:
+        response, messages = connect_ruzik_chat(chat_token, received_message, messages)
 
-    r_conn.hset('ruzik_chat_messages', f'id_{user_id}', json_messages)
+    if messages[-1]['role'] == 'assistant':
+        # дописываем только новую пару реплик, старая история не перезаписывается
+        append_chat_history(user_id, messages[-2:], r_conn, max_len=history_len)
 
-    message = messages[-1]['content']
-    vk.messages.send(user_id=user_id,
-                     message=message,
-                     random_id=get_random_id())
+    if not stream:
+        message = messages[-1]['content']
+        vk.messages.send(user_id=user_id,
+                         message=message,
+                         random_id=get_random_id())
+
+def send_streamed_reply(vk, user_id, chunks):
+    # не чаще одной правки в секунду, чтобы не упереться в лимиты VK API
+    edit_interval = float(os.getenv('RUZIK_CHAT_EDIT_INTERVAL', 1.0))
+    text = ''
+    sent_text = ''
+    message_id = None
+    last_edit = 0
+    try:
+        for chunk in chunks:
+            text += chunk
+            if message_id is None:
+                if text.strip():
+                    # id сообщения нужен для правок, поэтому здесь дожидаемся отправки
+                    message_id = vk.messages.send(user_id=user_id,
+                                                  message=text,
+                                                  random_id=get_random_id()).result()
+                    sent_text = text
+                    last_edit = time.monotonic()
+            elif time.monotonic() - last_edit >= edit_interval:
+                vk.messages.edit(peer_id=user_id, message_id=message_id, message=text)
+                sent_text = text
+                last_edit = time.monotonic()
+    except (requests.RequestException, ValueError, KeyError, IndexError) as exception:
+        # истекший токен, обрыв соединения или испорченная строка потока
+        logger.error(f"the ruzik chat stream for the user_{user_id} failed.")
+        logger.exception(exception)
+        text = f'{text}\n\nОтвет прервался. Попробуйте еще раз.' if text.strip() \
+            else 'Не удалось получить ответ. Попробуйте еще раз.'
+
+    if message_id is None:
+        vk.messages.send(user_id=user_id,
+                         message=text.strip() or 'Не удалось получить ответ. Попробуйте еще раз.',
+                         random_id=get_random_id())
+    elif text != sent_text:
+        vk.messages.edit(peer_id=user_id, message_id=message_id, message=text)
 
 def handle_admin_login(vk, user_id):
     message = "Введите логин:"
@@ -444,10 +409,12 @@ def handle_func_generate_qa(vk, user_id):
                      keyboard=create_admin_keyboard())
 
 def handle_func_num_qa(vk, user_id):
-    message = "Введите количество вопросов, которые вы хотите получить."
+    message = ("Введите количество вопросов, которые вы хотите получить.\n"
+               "Чтобы получить следующие вопросы по тому же тексту, напишите \"Ещё 10\".")
     vk.messages.send(user_id=user_id,
                      message=message,
-                     random_id=get_random_id())
+                     random_id=get_random_id(),
+                     keyboard=create_num_qa_keyboard())
 
 def handle_back_admin(vk, user_id):
     message = "Вернулись в главный экран."
@@ -488,96 +455,22 @@ def handle_successfully_uploaded_users_info(vk, user_id):
                      random_id=get_random_id(),
                      keyboard=create_admin_keyboard())
 
+def handle_cancelled_jobs(vk, admin_id, cancelled):
+    if cancelled:
+        message = f"Отменяем задачи: {cancelled}."
+    else:
+        message = "Нет запущенных задач."
+    vk.messages.send(user_id=admin_id,
+                     message=message,
+                     random_id=get_random_id())
+
 def handle_request_upload_users_info(vk, admin_id):
-    message = "Загрузив xlsx файл, можете заменить информации о данных пользователей."
+    message = "Загрузив xlsx или csv файл, можете заменить информации о данных пользователей."
     vk.messages.send(user_id=admin_id,
                      message=message,
                      random_id=get_random_id(),
                      keyboard=create_admin_keyboard())
 
-def exit_admin(user_id, r_conn):
-    r_conn.hset(f'admin_id_{user_id}', 'login_key', 'off')
-    r_conn.hset(f'admin_id_{user_id}', 'password_key', 'off')
-    r_conn.hset(f'admin_id_{user_id}', 'func_upload_qa_key', 'off')
-    r_conn.hset(f'admin_id_{user_id}', 'request_delete_key', 'off')
-    r_conn.hset(f'admin_id_{user_id}', 'func_delete_qa_key', 'off')
-    r_conn.hset(f'admin_id_{user_id}', 'func_edit_key', 'off')
-    r_conn.hset(f'admin_id_{user_id}', 'func_qa_key', 'off')
-    r_conn.hset(f'admin_id_{user_id}', 'admin_key', 'off')
-    r_conn.hset(f'admin_id_{user_id}', 'users_info_key', 'off')
-    r_conn.hset(f'admin_id_{user_id}', 'generate_qa_key', 'off')
-    r_conn.hset(f'admin_id_{user_id}', 'num_qa_key', 'off')
-    r_conn.hset(f'admin_id_{user_id}', 'change_login_key', 'off')
-    r_conn.hset(f'admin_id_{user_id}', 'change_password_key', 'off')
-    r_conn.hdel(f'admin_id_{user_id}', 'edit_user_id')
-
-def check_login_key(user_id, r_conn):
-    if r_conn.hget(f'admin_id_{user_id}', 'login_key') == 'on':
-        return True
-    return False
-
-def check_password_key(user_id, r_conn):
-    if r_conn.hget(f'admin_id_{user_id}', 'password_key') == 'on':
-        return True
-    return False
-
-
-def check_qa(user_id, r_conn):
-    if r_conn.hget(f'admin_id_{user_id}', 'func_qa_key') == 'on':
-        return True
-    return False
-
-def check_func_generate_qa(user_id, r_conn):
-    if r_conn.hget(f'admin_id_{user_id}', 'generate_qa_key') == 'on':
-        return True
-    return False
-
-def check_num_qa(user_id, r_conn):
-    if r_conn.hget(f'admin_id_{user_id}', 'num_qa_key') == 'on':
-        return True
-    return False
-
-def check_upload_key(user_id, r_conn):
-    if r_conn.hget(f'admin_id_{user_id}', 'func_upload_qa_key') == 'on':
-        return True
-    return False
-
-def check_users_info(user_id, r_conn):
-    if r_conn.hget(f'admin_id_{user_id}', 'users_info_key') == 'on':
-        return True
-    return False
-def check_clear_qa(user_id, r_conn):
-    if r_conn.hget(f'admin_id_{user_id}', 'func_delete_qa_key') == 'on':
-        return True
-    return False
-
-def check_edit_qa(user_id, r_conn):
-    if r_conn.hget(f'admin_id_{user_id}', 'func_edit_key') == 'on':
-        return True
-    return False
-def check_admin_login(received_message, admin_id, r_conn):
-    if r_conn.hget(f'admin_id_{admin_id}', 'login') == received_message:
-        return True
-    return False
-
-def check_admin_password(received_message, admin_id, r_conn):
-    if r_conn.hget(f'admin_id_{admin_id}', 'password') == received_message:
-        return True
-    return False
-
-def check_admin_change_login(admin_id, r_conn):
-    if r_conn.hget(f'admin_id_{admin_id}', 'change_login_key') == 'on':
-        return True
-    return False
-
-def check_admin_change_password(admin_id, r_conn):
-    if r_conn.hget(f'admin_id_{admin_id}', 'change_password_key') == 'on':
-        return True
-    return False
-
-def str_to_dict(value):
-    return json.loads(value)
-
 def handle_successfully_get_qa(vk, admin_id, title):
     upload_url = vk.docs.getMessagesUploadServer(type='doc', peer_id=admin_id)['upload_url']
     req = requests.post(upload_url, files={'file': open(title, 'rb')}).json()
@@ -589,7 +482,8 @@ def handle_successfully_get_qa(vk, admin_id, title):
                      keyboard=create_qa_admin_keyboard())
 
 def handle_request_upload_qa(vk, admin_id):
-    message = "Загрузив xlsx файл с таким же форматом, можете заменить набор вопросов и ответов для текущего пользователя."
+    message = ("Загрузив xlsx файл с таким же форматом, можете изменить набор вопросов для текущего пользователя."
+               "\n Удаленные строки больше не будут выдаваться ему, строки без id добавятся в общий банк вопросов.")
     vk.messages.send(user_id=admin_id,
                      message=message,
                      random_id=get_random_id(),
@@ -620,7 +514,7 @@ def handle_successfully_back(vk, admin_id):
                      message=message,
                      random_id=get_random_id(),
                      keyboard=create_admin_keyboard())
-def admin_func_upload_qa(event, r_conn):
+def admin_func_upload_qa(event, r_conn, SBER_TOKEN, on_progress=None, on_duplicates=None):
     event_obj = event.obj['message']
     document = event_obj['attachments']
     if len(document) >= 1 and document[0]['type'] == 'doc':
@@ -630,8 +524,7 @@ def admin_func_upload_qa(event, r_conn):
         path_directory = os.path.abspath(f'./{directory_name}')
         path_directory = path_directory.replace('\\', '/')
         urllib.request.urlretrieve(url, f'{path_directory}/{title}')
-        users_ids = list(r_conn.hgetall('users_info').keys())
-        upload_one_file_of_qa(users_ids, r_conn, title)
+        upload_one_file_of_qa(r_conn, title, SBER_TOKEN, on_progress=on_progress, on_duplicates=on_duplicates)
         return 1
     return 0
 
@@ -641,92 +534,69 @@ def admin_func_delete_qa(vk, event, r_conn):
     received_message = event_obj['text']
 
     if received_message == "Да":
-        users_id = list(r_conn.hgetall('users_info').keys())
-        clear_questions(users_id, r_conn)
-        clear_answers(users_id, r_conn)
+        users_id = list(r_conn.hkeys('users_info'))
+        clear_qa_bank(users_id, r_conn)
         clear_qa_from_dir()
-        r_conn.hset(f'admin_id_{user_id}', 'func_delete_qa_key', 'off')
         handle_successfully_deleted_qa(vk, user_id)
     else:
-        r_conn.hset(f'admin_id_{user_id}', 'func_delete_qa_key', 'off')
         handle_no_deleted_qa(vk, user_id)
-def upload_xlsx_file_of_qa(user_id, r_conn, title):
+def upload_xlsx_file_of_qa(user_id, r_conn, title, SBER_TOKEN):
     directory_name = 'questions_data'
     path_directory = os.path.abspath(f'./{directory_name}')
     path_directory = path_directory.replace('\\', '/')
 
     workbook = openpyxl.load_workbook(f'{path_directory}/{title}')
     worksheet = workbook.active
-    qa_counter = 0
+    questions, _ = get_user_qa(user_id, r_conn)
+    kept_ids = set()
+    new_qa = []
 
-    # Загрузка данных в Redis
     for row in range(2, worksheet.max_row + 1):
-        question = worksheet.cell(row=row, column=1).value
-        answer = worksheet.cell(row=row, column=2).value
-        r_conn.hset(f'questions_{user_id}', f'{qa_counter}', question)
-        r_conn.hset(f'correct_answers_{user_id}', f'{qa_counter}', answer)
-        qa_counter += 1
-
-def upload_xlsx_file_of_users_info(r_conn, title):
+        num_qa = worksheet.cell(row=row, column=1).value
+        question = worksheet.cell(row=row, column=2).value
+        answer = worksheet.cell(row=row, column=3).value
+        if num_qa is not None:
+            kept_ids.add(str(num_qa))
+        elif question and answer:
+            new_qa.append((question, answer))
+
+    # строки, удаленные из файла, больше не выдаются этому пользователю
+    removed_ids = [num_qa for num_qa in questions if num_qa not in kept_ids]
+    if removed_ids:
+        r_conn.sadd(f'qa_served_{user_id}', *removed_ids)
+    # строки без id - новые вопросы, они попадают в общий банк
+    add_qa_to_bank(r_conn, new_qa, SBER_TOKEN)
+
+def upload_xlsx_file_of_users_info(r_conn, title, on_progress=None):
     directory_name = 'questions_data'
     path_directory = os.path.abspath(f'./{directory_name}')
     path_directory = path_directory.replace('\\', '/')
 
-    workbook = openpyxl.load_workbook(f'{path_directory}/{title}')
-    worksheet = workbook.active
-
-    # Загрузка данных в Redis
-    for row in range(2, worksheet.max_row + 1):
-        user_id = worksheet.cell(row=row, column=2).value
-        first_name = worksheet.cell(row=row, column=3).value
-        last_name = worksheet.cell(row=row, column=4).value
-        b_date = worksheet.cell(row=row, column=5).value
-        sex = worksheet.cell(row=row, column=6).value
-        city = worksheet.cell(row=row, column=7).value
-        country = worksheet.cell(row=row, column=8).value
-        account = worksheet.cell(row=row, column=9).value
-        info_dict = {'first_name': first_name,
-                     'last_name': last_name,
-                     'b_date': b_date,
-                     'sex': sex,
-                     'city': city,
-                     'country': country,
-                     'account': account
-                     }
-
-        r_conn.hset('users_info',
-                    user_id,
-                    json.dumps(info_dict))
-def admin_func_edit_qa(event, r_conn):
+    # файл читается построчно и пишется в redis пачками
+    return import_users_info(r_conn, f'{path_directory}/{title}', on_progress=on_progress)
+def admin_func_edit_qa(event, r_conn, SBER_TOKEN, edit_user_id=None):
     event_obj = event.obj['message']
     document = event_obj['attachments']
-    admin_id = event_obj['from_id']
     if len(document) >= 1 and document[0]['type'] == 'doc':
-        if r_conn.hgetall(f'admin_id_{admin_id}') and r_conn.hget(f'admin_id_{admin_id}', 'edit_user_id') is not None:
-            user_id = r_conn.hget(f'admin_id_{admin_id}', 'edit_user_id')
+        if edit_user_id is not None:
+            user_id = edit_user_id
             title = document[0]['doc']['title']
             url = document[0]['doc']['url']
             directory_name = 'questions_data'
             path_directory = os.path.abspath(f'./{directory_name}')
             path_directory = path_directory.replace('\\', '/')
             urllib.request.urlretrieve(url, f'{path_directory}/{title}')
-            r_conn.delete(f'questions_{user_id}')
-            r_conn.delete(f'correct_answers_{user_id}')
-            r_conn.hdel(f'admin_id_{admin_id}', 'edit_user_id')
-            upload_xlsx_file_of_qa(user_id, r_conn, title)
+            upload_xlsx_file_of_qa(user_id, r_conn, title, SBER_TOKEN)
             os.remove(f'{path_directory}/{title}')
             return 2, None
         else:
             return 0, None
 
     elif event.type == VkBotEventType.MESSAGE_NEW:
-        event_obj = event.obj['message']
-        admin_id = event_obj['from_id']
         user_id = event_obj['text']
         user_id = f'id_{user_id}'
-        r_conn.hset(f'admin_id_{admin_id}', 'edit_user_id', user_id)
 
-        if user_id not in list(r_conn.hgetall('users_info').keys()):
+        if not r_conn.hexists('users_info', user_id):
             return 0, None
 
         questions, answers = get_user_qa(user_id, r_conn)
@@ -735,95 +605,382 @@ def admin_func_edit_qa(event, r_conn):
         qa_df = pd.concat([questions_df, answers_df], names=['questions', 'answers'], axis=1)
 
         title = f'qa_{user_id}.xlsx'
-        qa_df.to_excel(title, index=False)
+        qa_df.to_excel(title, index_label='id')
         return 1, title
     return 0, None
 
-def admin_func_upload_users_info(event, r_conn):
+def admin_func_upload_users_info(event, r_conn, on_progress=None):
     event_obj = event.obj['message']
     document = event_obj['attachments']
     if len(document) >= 1 and document[0]['type'] == 'doc':
-        if r_conn.hgetall('users_info'):
+        if r_conn.exists('users_info'):
             title = document[0]['doc']['title']
             url = document[0]['doc']['url']
             directory_name = 'questions_data'
             path_directory = os.path.abspath(f'./{directory_name}')
             path_directory = path_directory.replace('\\', '/')
             urllib.request.urlretrieve(url, f'{path_directory}/{title}')
-            r_conn.delete('users_info')
-            upload_xlsx_file_of_users_info(r_conn, title)
-            return 1
+            # старые данные заменяются только целиком загруженным файлом
+            return 1 if upload_xlsx_file_of_users_info(r_conn, title, on_progress=on_progress) else 0
     return 0
 
-def admin_func_get_users_info(r_conn):
-    users_info_dict = get_users_info(r_conn)
-    df = pd.DataFrame.from_dict(users_info_dict, orient='index').reset_index()
-    df.columns = ['id', 0]
-    df_id = df['id']
-    df = df[0].apply(str_to_dict).apply(pd.Series)
-    df = pd.concat([df_id, df], axis=1)
-    df.columns = ['id', 'first_name', 'last_name', 'b_date', 'sex', 'city', 'country', 'account']
-    df.to_excel('users_info_file.xlsx')
-
-def admin_func_qa(vk, event, r_conn):
-    event_obj = event.obj['message']
-    user_id = event_obj['from_id']
-    received_message = event_obj['text']
-    if received_message == "Добавлять вопросы и ответы":
-        r_conn.hset(f'admin_id_{user_id}', 'func_upload_qa_key', 'on')
-        r_conn.hset(f'admin_id_{user_id}', 'func_edit_key', 'off')
-        r_conn.hset(f'admin_id_{user_id}', 'func_delete_qa_key', 'off')
-        handle_upload_qa(vk, user_id)
-    elif received_message == "Редактировать вопросы и ответы":
-        r_conn.hset(f'admin_id_{user_id}', 'func_edit_key', 'on')
-        r_conn.hset(f'admin_id_{user_id}', 'func_upload_qa_key', 'off')
-        r_conn.hset(f'admin_id_{user_id}', 'func_delete_qa_key', 'off')
-        handle_request_edit_qa(vk, user_id)
-    elif received_message == "Удалять вопросы и ответы":
-        r_conn.hset(f'admin_id_{user_id}', 'func_delete_qa_key', 'on')
-        r_conn.hset(f'admin_id_{user_id}', 'func_upload_qa_key', 'off')
-        r_conn.hset(f'admin_id_{user_id}', 'func_edit_key', 'off')
-        handle_request_delete_qa(vk, user_id)
-    elif received_message == "Назад":
-        r_conn.hset(f'admin_id_{user_id}', 'func_qa_key', 'off')
-        r_conn.hset(f'admin_id_{user_id}', 'func_upload_qa_key', 'off')
-        r_conn.hset(f'admin_id_{user_id}', 'func_edit_key', 'off')
-        r_conn.hset(f'admin_id_{user_id}', 'func_delete_qa_key', 'off')
-        r_conn.hdel(f'admin_id_{user_id}', 'edit_user_id')
-        handle_successfully_back(vk, user_id)
-    elif check_upload_key(user_id, r_conn):
-        admin_func_upload_qa(event, r_conn)
-        r_conn.hset(f'admin_id_{user_id}', 'func_upload_qa_key', 'off')
-        handle_successfully_uploaded_qa(vk, user_id)
-    elif check_clear_qa(user_id, r_conn):
-        admin_func_delete_qa(vk, event, r_conn)
-        r_conn.hset(f'admin_id_{user_id}', 'func_qa_key', 'off')
-    elif check_edit_qa(user_id, r_conn):
-        event_obj = event.obj['message']
-        admin_id = event_obj['peer_id']
-        func, title = admin_func_edit_qa(event, r_conn)
-        if func == 1:
-            handle_successfully_get_qa(vk, admin_id, title)
-            handle_request_upload_qa(vk, admin_id)
-            os.remove(title)
-        elif func == 2:
-            handle_successfully_uploaded_qa(vk, admin_id)
-            r_conn.hset(f'admin_id_{user_id}', 'func_edit_key', 'off')
-        else:
-            handle_incorrect_edit_qa(vk, admin_id)
-    else:
-        handle_incorrect_func(vk, user_id)
-def admin_func_upload_text(event, r_conn):
+def admin_func_get_users_info(r_conn, on_progress=None):
+    # выгрузка идет пачками через HSCAN, без DataFrame на всех игроков
+    return export_users_info(r_conn, os.getenv('USERS_INFO_EXPORT_FORMAT', 'xlsx'), on_progress=on_progress)
+
+def admin_func_upload_text(event):
     event_obj = event.obj['message']
     document = event_obj['attachments']
-    admin_id = event_obj['from_id']
     if len(document) >= 1 and document[0]['type'] == 'doc':
         title = document[0]['doc']['title']
         url = document[0]['doc']['url']
         urllib.request.urlretrieve(url, title)
-        r_conn.hset(f'admin_id_{admin_id}', 'text_name', title)
-        return 1
-    return 0
+        return title
+    return None
+
+# Тяжелые действия администратора выполняются фоновыми задачами,
+# чтобы не занимать обработчик событий на время выгрузок и генерации.
+def job_admin_users_info(job, vk, r_conn, peer_id, user_id):
+    title = admin_func_get_users_info(r_conn, on_progress=job.report_progress)
+    handle_successfully_get_users_info(vk, peer_id, title)
+    handle_request_upload_users_info(vk, user_id)
+
+def job_admin_upload_users_info(job, vk, event, r_conn, user_id):
+    if admin_func_upload_users_info(event, r_conn, on_progress=job.report_progress):
+        handle_successfully_uploaded_users_info(vk, user_id)
+    else:
+        handle_incorrect_users_info(vk, user_id)
+
+def job_admin_upload_qa(job, vk, event, r_conn, SBER_TOKEN, user_id):
+    # похожие на имеющиеся вопросы не загружаются, администратор получает их список
+    admin_func_upload_qa(event, r_conn, SBER_TOKEN, on_progress=job.report_progress,
+                         on_duplicates=lambda clusters: job.send(format_duplicate_clusters(clusters)))
+    handle_successfully_uploaded_qa(vk, user_id)
+
+def job_admin_delete_qa(job, vk, event, r_conn):
+    admin_func_delete_qa(vk, event, r_conn)
+
+def job_admin_generate_qa(job, vk, SBER_TOKEN, r_conn, title, num, offset, user_id):
+    loader = TextLoader(title, encoding='UTF-8')
+    text = '\n\n'.join(document.page_content for document in loader.load())
+
+    def send_partial(new_pairs, done, total):
+        # готовые вопросы показываем сразу, не дожидаясь всего документа
+        job.check_cancelled()
+        job.send(f'Готово {done} из {total}:\n\n{format_qa_pairs(new_pairs)}'[:4000])
+
+    def generate(missing, produced):
+        return generate_qa(
+            text, missing, SBER_TOKEN,
+            max_workers=int(os.getenv('QA_GENERATION_WORKERS', 4)),
+            chunk_size=int(os.getenv('QA_GENERATION_CHUNK_SIZE', 4000)),
+            on_pairs=send_partial,
+            exclude=produced
+        )
+
+    # по этому тексту вопросы могли уже генерироваться: GigaChat вызывается только для недостающих
+    qa_pairs, cached = get_generation_cache(r_conn).get_page(text, num, generate, offset=offset)
+    if cached:
+        job.send(f'Из ранее сгенерированных взято {cached} вопросов.')
+    if len(qa_pairs) < num:
+        job.send(f'По документу удалось составить {len(qa_pairs)} вопросов из {num}.')
+    handle_successfully_get_generated_qa(vk, user_id, format_qa_pairs(qa_pairs))
+    handle_func_num_qa(vk, user_id)
+
+class EventContext:
+    def __init__(self, vk, event, r_conn, VK_USER_TOKEN, SBER_TOKEN):
+        event_obj = event.obj['message']
+        self.vk = vk
+        self.event = event
+        self.r_conn = r_conn
+        self.VK_USER_TOKEN = VK_USER_TOKEN
+        self.SBER_TOKEN = SBER_TOKEN
+        self.received_message = event_obj['text'] # это и есть ответ
+        self.user_id = event_obj['from_id'] # id участника
+        self.peer_id = event_obj['peer_id']
+
+        self.state, self.admin_info = load_user_state(self.user_id, r_conn)
+        self.next_state = self.state
+        self.admin_updates = {}
+        self.admin_deleted = []
+
+    def set_state(self, state, **admin_fields):
+        self.next_state = state
+        self.admin_updates.update(admin_fields)
+
+    def save(self):
+        # одна запись в redis, и только если что-то изменилось
+        if self.next_state != self.state or self.admin_updates or self.admin_deleted:
+            save_user_state(self.user_id, self.next_state, self.r_conn,
+                            admin_info=self.admin_updates,
+                            admin_deleted=self.admin_deleted)
+
+def event_admin_enter(ctx):
+    if ctx.state == STATE_ADMIN_CHANGE_LOGIN:
+        handle_incorrect_changed_login(ctx.vk, ctx.user_id)
+        return
+
+    admin_fields = {}
+    if 'login' not in ctx.admin_info:
+        admin_fields['login'] = 'ruzik_admin'
+        admin_fields['password'] = '0000'
+    if ctx.state not in ADMIN_STATES:
+        # запоминаем, куда вернуться после выхода из администратора
+        admin_fields['return_state'] = ctx.state
+
+    ctx.set_state(STATE_ADMIN_LOGIN, **admin_fields)
+    handle_admin_login(ctx.vk, ctx.user_id)
+
+def event_admin_exit(ctx):
+    ctx.set_state(ctx.admin_info.get('return_state', STATE_CHAT))
+    ctx.admin_deleted.append('edit_user_id')
+    handle_admin_stop(ctx.vk, ctx.user_id)
+
+def event_admin_login(ctx):
+    if ctx.admin_info.get('login') == ctx.received_message:
+        ctx.set_state(STATE_ADMIN_PASSWORD)
+        handle_admin_password(ctx.vk, ctx.user_id)
+    else:
+        handle_incorrect_admin_login(ctx.vk, ctx.user_id)
+
+def event_admin_password(ctx):
+    if ctx.admin_info.get('password') == ctx.received_message:
+        ctx.set_state(STATE_ADMIN)
+        handle_admin_start(ctx.vk, ctx.user_id)
+    else:
+        handle_incorrect_admin_password(ctx.vk, ctx.user_id)
+
+def event_admin_back(ctx):
+    handle_successfully_back(ctx.vk, ctx.user_id)
+
+def event_admin_users_info(ctx):
+    ctx.set_state(STATE_ADMIN_USERS_INFO)
+    get_admin_job_runner().submit(ctx.vk, ctx.user_id, 'Выгрузка данных игроков', job_admin_users_info,
+                                  ctx.vk, ctx.r_conn, ctx.peer_id, ctx.user_id)
+
+def event_admin_upload_users_info(ctx):
+    get_admin_job_runner().submit(ctx.vk, ctx.user_id, 'Загрузка данных игроков', job_admin_upload_users_info,
+                                  ctx.vk, ctx.event, ctx.r_conn, ctx.user_id)
+
+def event_admin_cancel_jobs(ctx):
+    cancelled = get_admin_job_runner().cancel_admin_jobs(ctx.user_id)
+    handle_cancelled_jobs(ctx.vk, ctx.user_id, cancelled)
+
+def event_admin_qa(ctx):
+    ctx.set_state(STATE_ADMIN_QA)
+    handle_func_qa(ctx.vk, ctx.user_id)
+
+def event_admin_generate(ctx):
+    ctx.set_state(STATE_ADMIN_GENERATE)
+    handle_func_generate_qa(ctx.vk, ctx.user_id)
+
+def event_admin_change_login_request(ctx):
+    ctx.set_state(STATE_ADMIN_CHANGE_LOGIN)
+    handle_change_login(ctx.vk, ctx.user_id)
+
+def event_admin_change_login(ctx):
+    ctx.set_state(STATE_ADMIN_CHANGE_PASSWORD, login=ctx.received_message)
+    handle_successfully_changed_login(ctx.vk, ctx.received_message, ctx.user_id)
+    handle_change_password(ctx.vk, ctx.user_id)
+
+def event_admin_change_password(ctx):
+    ctx.set_state(STATE_ADMIN, password=ctx.received_message)
+    handle_successfully_changed_password(ctx.vk, ctx.received_message, ctx.user_id)
+
+def event_admin_qa_upload_request(ctx):
+    ctx.set_state(STATE_ADMIN_QA_UPLOAD)
+    handle_upload_qa(ctx.vk, ctx.user_id)
+
+def event_admin_qa_edit_request(ctx):
+    ctx.set_state(STATE_ADMIN_QA_EDIT)
+    handle_request_edit_qa(ctx.vk, ctx.user_id)
+
+def event_admin_qa_delete_request(ctx):
+    ctx.set_state(STATE_ADMIN_QA_DELETE)
+    handle_request_delete_qa(ctx.vk, ctx.user_id)
+
+def event_admin_qa_back(ctx):
+    ctx.set_state(STATE_ADMIN)
+    ctx.admin_deleted.append('edit_user_id')
+    handle_successfully_back(ctx.vk, ctx.user_id)
+
+def event_admin_qa_incorrect(ctx):
+    handle_incorrect_func(ctx.vk, ctx.user_id)
+
+def event_admin_qa_upload(ctx):
+    ctx.set_state(STATE_ADMIN_QA)
+    get_admin_job_runner().submit(ctx.vk, ctx.user_id, 'Загрузка вопросов и ответов', job_admin_upload_qa,
+                                  ctx.vk, ctx.event, ctx.r_conn, ctx.SBER_TOKEN, ctx.user_id)
+
+def event_admin_qa_delete(ctx):
+    ctx.set_state(STATE_ADMIN)
+    if ctx.received_message == "Да":
+        get_admin_job_runner().submit(ctx.vk, ctx.user_id, 'Удаление вопросов и ответов', job_admin_delete_qa,
+                                      ctx.vk, ctx.event, ctx.r_conn)
+    else:
+        admin_func_delete_qa(ctx.vk, ctx.event, ctx.r_conn)
+
+def event_admin_qa_edit(ctx):
+    func, title = admin_func_edit_qa(ctx.event, ctx.r_conn, ctx.SBER_TOKEN, ctx.admin_info.get('edit_user_id'))
+    if func == 1:
+        ctx.set_state(STATE_ADMIN_QA_EDIT, edit_user_id=f'id_{ctx.received_message}')
+        handle_successfully_get_qa(ctx.vk, ctx.peer_id, title)
+        handle_request_upload_qa(ctx.vk, ctx.peer_id)
+        os.remove(title)
+    elif func == 2:
+        ctx.set_state(STATE_ADMIN_QA)
+        ctx.admin_deleted.append('edit_user_id')
+        handle_successfully_uploaded_qa(ctx.vk, ctx.peer_id)
+    else:
+        handle_incorrect_edit_qa(ctx.vk, ctx.peer_id)
+
+def event_admin_upload_text(ctx):
+    title = admin_func_upload_text(ctx.event)
+    if title is not None:
+        ctx.set_state(STATE_ADMIN_NUM_QA, text_name=title, qa_offset=0)
+    else:
+        ctx.set_state(STATE_ADMIN_NUM_QA)
+    handle_func_num_qa(ctx.vk, ctx.user_id)
+
+def event_admin_num_qa(ctx):
+    received_message = ctx.received_message
+    more_qa = MORE_QA_COMMAND.match(received_message.strip())
+    if received_message.isdigit() or more_qa:
+        if more_qa:
+            # следующая страница вопросов по тому же тексту
+            num = int(more_qa.group(1))
+            offset = int(ctx.admin_info.get('qa_offset', 0))
+        else:
+            num = int(received_message)
+            offset = 0
+        ctx.set_state(STATE_ADMIN_NUM_QA, qa_offset=offset + num)
+        title = ctx.admin_info.get('text_name')
+        get_admin_job_runner().submit(ctx.vk, ctx.user_id, 'Генерация вопросов', job_admin_generate_qa,
+                                      ctx.vk, ctx.SBER_TOKEN, ctx.r_conn, title, num, offset, ctx.user_id)
+    elif received_message in ["назад", "Назад"]:
+        ctx.set_state(STATE_ADMIN)
+        handle_back_admin(ctx.vk, ctx.user_id)
+    else:
+        handle_incorrect_num_qa(ctx.vk, ctx.user_id)
+
+def event_user_start(ctx):
+    user_func_start(ctx.VK_USER_TOKEN, ctx.user_id, ctx.r_conn)
+    handle_user_start(ctx.vk, ctx.user_id)
+    # off the ruzik chat
+    ctx.set_state(STATE_QUIZ)
+
+def event_user_stop(ctx):
+    handle_user_stop(ctx.vk, ctx.user_id)
+    # on the ruzik chat
+    ctx.set_state(STATE_CHAT)
+
+def event_ruzik_chat(ctx):
+    handle_ruzik_chat(ctx.vk, ctx.SBER_TOKEN, ctx.received_message, ctx.user_id, ctx.r_conn)
+
+def event_question(ctx):
+    question = func_question(ctx.user_id, ctx.r_conn)
+    if question is not None:
+        handle_successfully_uploaded_question(ctx.vk, ctx.user_id, question)
+    else:
+        handle_incorrect_upload_question(ctx.vk, ctx.user_id)
+        # on the ruzik chat
+        ctx.set_state(STATE_CHAT)
+
+def event_show_user_account(ctx):
+    func_show_user_account(ctx.vk, ctx.user_id, ctx.r_conn)
+
+def event_show_user_rank(ctx):
+    func_show_user_rank(ctx.vk, ctx.user_id, ctx.r_conn)
+
+def event_user_answer(ctx):
+    func_user_answer(ctx.vk, ctx.received_message, ctx.user_id, ctx.r_conn)
+
+ADMIN_COMMANDS = ['админ', 'вход в админ', 'Админ']
+EXIT_ADMIN_COMMANDS = ["выйти", "Выйти"]
+CANCEL_JOB_COMMANDS = ["отмена", "Отмена"]
+MORE_QA_COMMAND = re.compile(r'^ещ[её]\s*(\d+)$', re.IGNORECASE)
+START_COMMANDS = ["начать", "start", "старт", "Начать", "Start", "Старт"]
+STOP_COMMANDS = ["закончить", "стоп", "end", "stop", "Закончить", "Стоп", "End", "Stop"]
+
+ADMIN_MENU = {
+    "Данные игроков": event_admin_users_info,
+    "Вопросы и ответы": event_admin_qa,
+    "Генерация вопросов": event_admin_generate,
+    "Изменить логин и пароль": event_admin_change_login_request,
+}
+
+ADMIN_QA_MENU = {
+    "Добавлять вопросы и ответы": event_admin_qa_upload_request,
+    "Редактировать вопросы и ответы": event_admin_qa_edit_request,
+    "Удалять вопросы и ответы": event_admin_qa_delete_request,
+    "Назад": event_admin_qa_back,
+}
+
+# обработчик по умолчанию для каждого состояния
+STATE_HANDLERS = {
+    STATE_CHAT: event_ruzik_chat,
+    STATE_QUIZ: event_user_answer,
+    STATE_ADMIN_LOGIN: event_admin_login,
+    STATE_ADMIN_PASSWORD: event_admin_password,
+    STATE_ADMIN: event_admin_back,
+    STATE_ADMIN_USERS_INFO: event_admin_upload_users_info,
+    STATE_ADMIN_QA: event_admin_qa_incorrect,
+    STATE_ADMIN_QA_UPLOAD: event_admin_qa_upload,
+    STATE_ADMIN_QA_EDIT: event_admin_qa_edit,
+    STATE_ADMIN_QA_DELETE: event_admin_qa_delete,
+    STATE_ADMIN_GENERATE: event_admin_upload_text,
+    STATE_ADMIN_NUM_QA: event_admin_num_qa,
+    STATE_ADMIN_CHANGE_LOGIN: event_admin_change_login,
+    STATE_ADMIN_CHANGE_PASSWORD: event_admin_change_password,
+}
+
+# обработчики команд: (состояние, текст сообщения) -> обработчик
+COMMAND_HANDLERS = {}
+for state in STATE_HANDLERS:
+    for command in ADMIN_COMMANDS:
+        COMMAND_HANDLERS[(state, command)] = event_admin_enter
+for state in ADMIN_STATES:
+    for command in EXIT_ADMIN_COMMANDS:
+        COMMAND_HANDLERS[(state, command)] = event_admin_exit
+for state in ADMIN_STATES:
+    if state in (STATE_ADMIN_LOGIN, STATE_ADMIN_PASSWORD):
+        continue
+    for command, handler in ADMIN_MENU.items():
+        COMMAND_HANDLERS[(state, command)] = handler
+for state in (STATE_ADMIN_QA, STATE_ADMIN_QA_UPLOAD, STATE_ADMIN_QA_EDIT, STATE_ADMIN_QA_DELETE):
+    for command, handler in ADMIN_QA_MENU.items():
+        COMMAND_HANDLERS[(state, command)] = handler
+for state in ADMIN_STATES:
+    if state in (STATE_ADMIN_LOGIN, STATE_ADMIN_PASSWORD):
+        continue
+    for command in CANCEL_JOB_COMMANDS:
+        COMMAND_HANDLERS[(state, command)] = event_admin_cancel_jobs
+for state in (STATE_CHAT, STATE_QUIZ):
+    for command in START_COMMANDS:
+        COMMAND_HANDLERS[(state, command)] = event_user_start
+    for command in STOP_COMMANDS:
+        COMMAND_HANDLERS[(state, command)] = event_user_stop
+COMMAND_HANDLERS[(STATE_QUIZ, "Вопрос")] = event_question
+COMMAND_HANDLERS[(STATE_QUIZ, "На счете")] = event_show_user_account
+COMMAND_HANDLERS[(STATE_QUIZ, "Мое место")] = event_show_user_rank
+
+def post_leaderboard_periodically(VK_USER_TOKEN, GROUP_ID, r_conn, interval, top_n):
+    while True:
+        time.sleep(interval)
+        try:
+            upload_leaderboard(VK_USER_TOKEN, GROUP_ID, r_conn, top_n)
+            logger.info('the leaderboard was posted.')
+        except Exception as exception:
+            logger.error('the leaderboard post failed.')
+            logger.exception(exception)
+
+def handle_event(vk, event, r_conn, VK_USER_TOKEN, SBER_TOKEN):
+    ctx = EventContext(vk, event, r_conn, VK_USER_TOKEN, SBER_TOKEN)
+    handler = COMMAND_HANDLERS.get((ctx.state, ctx.received_message))
+    if handler is None:
+        handler = STATE_HANDLERS.get(ctx.state, event_ruzik_chat)
+    handler(ctx)
+    ctx.save()
 
 def main():
 
@@ -834,6 +991,15 @@ def main():
     SBER_TOKEN = os.getenv('SBER_TOKEN')
     host = os.getenv('host')
     port = os.getenv('port')
+    # сколько обработчиков событий разных пользователей выполняются одновременно
+    MAX_CONCURRENT_HANDLERS = int(os.getenv('MAX_CONCURRENT_HANDLERS', 16))
+    # лимит VK для ключа сообщества - 20 запросов в секунду
+    VK_SEND_RATE = float(os.getenv('VK_SEND_RATE', 20))
+    # раз в сколько секунд публиковать лидерборд на стене сообщества, 0 - не публиковать
+    LEADERBOARD_POST_INTERVAL = int(os.getenv('LEADERBOARD_POST_INTERVAL', 0))
+    LEADERBOARD_TOP_N = int(os.getenv('LEADERBOARD_TOP_N', 10))
+    # раз в сколько секунд проверять questions_data на новые файлы, 0 - не проверять
+    QA_WATCH_INTERVAL = int(os.getenv('QA_WATCH_INTERVAL', 0))
     db = 0
 
     r_conn = redis.Redis(
@@ -851,159 +1017,53 @@ def main():
         filemode='w'
     )
 
+    if os.getenv('PROFILE_PREFETCH', '0') == '1':
+        # профили участников сообщества загружаются заранее, до первого старта викторины
+        threading.Thread(
+            target=get_profile_service(VK_USER_TOKEN, r_conn=r_conn).prefetch_group_members,
+            args=(GROUP_ID,),
+            daemon=True
+        ).start()
+
+    # общий банк вопросов загружается один раз, а не для каждого нового игрока;
+    # при перезапуске добавляются только новые и измененные файлы
+    try:
+        upload_all_files_of_qa(r_conn, sber_token=SBER_TOKEN)
+    except Exception as exception:
+        # бот запускается с уже загруженным банком; файл разберется при следующем запуске
+        logger.error('the question bank upload at startup failed.')
+        logger.exception(exception)
+    # прогресс игроков из старых копий вопросов переносится после загрузки банка
+    migrate_legacy_user_qa(r_conn)
+    if QA_WATCH_INTERVAL > 0:
+        threading.Thread(
+            target=watch_qa_directory,
+            kwargs={'r_conn': r_conn, 'sber_token': SBER_TOKEN, 'interval': QA_WATCH_INTERVAL},
+            daemon=True
+        ).start()
+
+    # разовый перенос счетов из json users_info в accounts и лидерборд
+    migrate_accounts(r_conn)
+    if LEADERBOARD_POST_INTERVAL > 0:
+        threading.Thread(
+            target=post_leaderboard_periodically,
+            args=(VK_USER_TOKEN, GROUP_ID, r_conn, LEADERBOARD_POST_INTERVAL, LEADERBOARD_TOP_N),
+            daemon=True
+        ).start()
+
+    dispatcher = UserEventDispatcher(max_concurrency=MAX_CONCURRENT_HANDLERS)
+    # обработчики не ждут ответа VK, сообщения отправляются из общей очереди
+    sender = VkMessageSender(vk_api.VkApi(token=VK_GROUP_TOKEN), rate=VK_SEND_RATE)
+
     while True:
         try:
             logger.debug('the bot started')
             authorize = vk_api.VkApi(token=VK_GROUP_TOKEN)
-            vk = authorize.get_api()
+            vk = QueuedVkApi(authorize.get_api(), sender)
             longpoll = VkBotLongPoll(authorize, group_id=GROUP_ID)
-            for event in longpoll.listen():
-                # новые текстовые сообщения, адресованные ему
-                if event.type == VkBotEventType.MESSAGE_NEW:
-                    event_obj = event.obj['message']
-                    received_message = event_obj['text'] # это и есть ответ
-                    # уникальный идентификационный номер
-                    user_id = event_obj['from_id'] # id участника
-                    peer_id = event_obj['peer_id']
-
-                    if not r_conn.hgetall('ruzik_chat_keys') or r_conn.hget('ruzik_chat_keys', f'id_{user_id}') is None:
-                        r_conn.hset('ruzik_chat_keys', f'id_{user_id}', 'on')
-
-                    if received_message in ['админ', 'вход в админ', 'Админ']:
-                        if check_admin_change_login(user_id, r_conn):
-                            handle_incorrect_changed_login(vk, user_id)
-                            continue
-
-                        if not r_conn.hgetall(f'admin_id_{user_id}'):
-                            r_conn.hset(f'admin_id_{user_id}', 'login', 'ruzik_admin')
-                            r_conn.hset(f'admin_id_{user_id}', 'password', '0000')
-                            r_conn.hset(f'admin_id_{user_id}', 'change_login_key', 'off')
-                            r_conn.hset(f'admin_id_{user_id}', 'change_password_key', 'off')
-                            r_conn.hset(f'admin_id_{user_id}', 'login_key', 'off')
-                            r_conn.hset(f'admin_id_{user_id}', 'password_key', 'off')
-                            r_conn.hset(f'admin_id_{user_id}', 'func_upload_qa_key', 'off')
-                            r_conn.hset(f'admin_id_{user_id}', 'request_delete_key', 'off')
-                            r_conn.hset(f'admin_id_{user_id}', 'func_delete_qa_key', 'off')
-                            r_conn.hset(f'admin_id_{user_id}', 'admin_key', 'off')
-                            r_conn.hset(f'admin_id_{user_id}', 'func_qa_key', 'off')
-                            r_conn.hset(f'admin_id_{user_id}', 'users_info_key', 'off')
-                            r_conn.hset(f'admin_id_{user_id}', 'generate_qa_key', 'off')
-                            r_conn.hset(f'admin_id_{user_id}', 'num_qa_key', 'off')
-
-                        r_conn.hset(f'admin_id_{user_id}', 'login_key', 'on')
-                        handle_admin_login(vk, user_id)
-                    elif ((check_login_key(user_id, r_conn) or check_password_key(user_id, r_conn) or switch_admin(user_id, r_conn))
-                          and received_message in ["выйти", "Выйти"]):
-                        exit_admin(user_id, r_conn)
-                        handle_admin_stop(vk, user_id)
-                    elif check_login_key(user_id, r_conn):
-                        if check_admin_login(received_message, user_id, r_conn):
-                            r_conn.hset(f'admin_id_{user_id}', 'login_key', 'off')
-                            r_conn.hset(f'admin_id_{user_id}', 'password_key', 'on')
-                            handle_admin_password(vk, user_id)
-                        else:
-                            handle_incorrect_admin_login(vk, user_id)
-                    elif check_password_key(user_id, r_conn):
-                        if check_admin_password(received_message, user_id, r_conn):
-                            r_conn.hset(f'admin_id_{user_id}', 'password_key', 'off')
-                            r_conn.hset(f'admin_id_{user_id}', 'admin_key', 'on')
-                            handle_admin_start(vk, user_id)
-                        else:
-                            handle_incorrect_admin_password(vk, user_id)
-                    elif switch_admin(user_id, r_conn):
-                        if received_message == "Данные игроков":
-                            admin_func_get_users_info(r_conn)
-                            r_conn.hset(f'admin_id_{user_id}', 'users_info_key', 'on')
-                            r_conn.hset(f'admin_id_{user_id}', 'func_qa_key', 'off')
-                            r_conn.hset(f'admin_id_{user_id}', 'generate_qa_key', 'off')
-                            r_conn.hset(f'admin_id_{user_id}', 'change_login_key', 'off')
-                            title = 'users_info_file.xlsx'
-                            handle_successfully_get_users_info(vk, peer_id, title)
-                            handle_request_upload_users_info(vk, user_id)
-                            # os.remove(title)
-                        elif received_message == "Вопросы и ответы":
-                            r_conn.hset(f'admin_id_{user_id}', 'func_qa_key', 'on')
-                            r_conn.hset(f'admin_id_{user_id}', 'users_info_key', 'off')
-                            r_conn.hset(f'admin_id_{user_id}', 'generate_qa_key', 'off')
-                            r_conn.hset(f'admin_id_{user_id}', 'num_qa_key', 'off')
-                            r_conn.hset(f'admin_id_{user_id}', 'change_login_key', 'off')
-                            handle_func_qa(vk, user_id)
-                        elif received_message == "Генерация вопросов":
-                            r_conn.hset(f'admin_id_{user_id}', 'generate_qa_key', 'on')
-                            r_conn.hset(f'admin_id_{user_id}', 'num_qa_key', 'off')
-                            r_conn.hset(f'admin_id_{user_id}', 'func_qa_key', 'off')
-                            r_conn.hset(f'admin_id_{user_id}', 'users_info_key', 'off')
-                            r_conn.hset(f'admin_id_{user_id}', 'change_login_key', 'off')
-                            handle_func_generate_qa(vk, user_id)
-                        elif received_message == "Изменить логин и пароль":
-                            r_conn.hset(f'admin_id_{user_id}', 'change_login_key', 'on')
-                            r_conn.hset(f'admin_id_{user_id}', 'func_qa_key', 'off')
-                            r_conn.hset(f'admin_id_{user_id}', 'users_info_key', 'off')
-                            r_conn.hset(f'admin_id_{user_id}', 'generate_qa_key', 'off')
-                            r_conn.hset(f'admin_id_{user_id}', 'num_qa_key', 'off')
-                            handle_change_login(vk, user_id)
-                        elif check_admin_change_login(user_id, r_conn):
-                            r_conn.hset(f'admin_id_{user_id}', 'login', received_message)
-                            r_conn.hset(f'admin_id_{user_id}', 'change_login_key', 'off')
-                            r_conn.hset(f'admin_id_{user_id}', 'change_password_key', 'on')
-                            handle_successfully_changed_login(vk, received_message, user_id)
-                            handle_change_password(vk, user_id)
-                        elif check_admin_change_password(user_id, r_conn):
-                            r_conn.hset(f'admin_id_{user_id}', 'password', received_message)
-                            r_conn.hset(f'admin_id_{user_id}', 'change_password_key', 'off')
-                            handle_successfully_changed_password(vk, received_message, user_id)
-                        elif check_users_info(user_id, r_conn):
-                            if admin_func_upload_users_info(event, r_conn):
-                                handle_successfully_uploaded_users_info(vk, user_id)
-                            else:
-                                handle_incorrect_users_info(vk, user_id)
-                        elif check_qa(user_id, r_conn):
-                            admin_func_qa(vk, event, r_conn)
-                        elif check_func_generate_qa(user_id, r_conn):
-                            admin_func_upload_text(event, r_conn)
-                            handle_func_num_qa(vk, user_id)
-                            r_conn.hset(f'admin_id_{user_id}', 'num_qa_key', 'on')
-                            r_conn.hset(f'admin_id_{user_id}', 'generate_qa_key', 'off')
-                        elif check_num_qa(user_id, r_conn):
-                            if received_message.isdigit():
-                                num = received_message
-                                title = r_conn.hget(f'admin_id_{user_id}', 'text_name')
-                                loader = TextLoader(title, encoding='UTF-8')
-                                doc = loader.load()
-                                text_file = custom_generate_qa(doc, int(num), SBER_TOKEN)
-                                handle_successfully_get_generated_qa(vk, user_id, text_file)
-                                handle_func_num_qa(vk, user_id)
-                            elif received_message in ["назад", "Назад"]:
-                                handle_back_admin(vk, user_id)
-                                r_conn.hset(f'admin_id_{user_id}', 'num_qa_key', 'off')
-                                # os.remove(title)
-                            else:
-                                handle_incorrect_num_qa(vk, user_id)
-                        else:
-                            handle_successfully_back(vk, user_id)
-
-                    elif received_message in ["начать", "start", "старт", "Начать", "Start", "Старт"]:
-                        user_func_start(VK_USER_TOKEN, user_id, r_conn)
-                        handle_user_start(vk, user_id)
-                        # off the ruzik chat
-                        r_conn.hset('ruzik_chat_keys', f'id_{user_id}', 'off')
-                    elif received_message in ["закончить", "стоп", "end", "stop", "Закончить", "Стоп", "End", "Stop"]:
-                        handle_user_stop(vk, user_id)
-                        # on the ruzik chat
-                        r_conn.hset('ruzik_chat_keys', f'id_{user_id}', 'on')
-                    elif switch_ruzik_chat(user_id, r_conn):
-                        handle_ruzik_chat(vk, SBER_TOKEN, received_message, user_id, r_conn)
-                    elif received_message == "Вопрос":
-                        if func_question(user_id, r_conn):
-                            handle_successfully_uploaded_question(vk, user_id, r_conn)
-                        else:
-                            handle_incorrect_upload_question(vk, user_id)
-                            # on the ruzik chat
-                            r_conn.hset('ruzik_chat_keys', f'id_{user_id}', 'on')
-                    elif received_message == "На счете":
-                        func_show_user_account(vk, user_id, r_conn)
-                    else:
-                        func_user_answer(vk, SBER_TOKEN, received_message, user_id, r_conn)
+            handler = functools.partial(handle_event, vk, r_conn=r_conn,
+                                        VK_USER_TOKEN=VK_USER_TOKEN, SBER_TOKEN=SBER_TOKEN)
+            asyncio.run(dispatcher.run(longpoll, handler))
 
         except KeyboardInterrupt:
             logger.info('the bot stopped.')